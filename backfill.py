@@ -0,0 +1,568 @@
+"""
+backfill.py
+
+Created on: 2026-10-17
+Edited on: 2026-10-17
+Author: R. Andrew Ballard (c) 2025 "Andwardo"
+Version: v1.0.0
+
+Bulk loader for telemetry captured outside the live MQTT path
+Broker message archives, device buffers uploaded after an outage and JSONL
+dumps are loaded straight into PostgreSQL instead of being republished one
+message at a time. Each input is read as a stream (plain, .gz, .bz2 or .xz),
+chunks of lines are parsed and validated by a pool of worker processes that
+turn them into COPY text, and every transaction COPYs a large batch into a
+temporary staging table and inserts it with ON CONFLICT DO NOTHING, so rows
+already stored are skipped. "Devices", "LatestTelemetry" and the rollups are
+updated in the same transaction. The input offset is checkpointed after each
+commit, so an interrupted run resumes where it stopped.
+
+A line is either a telemetry payload (as published by the devices) or an
+envelope with the payload under "payload", as an object or a JSON string.
+
+Usage:
+    python backfill.py archive.jsonl.gz [more.jsonl ...]
+    python backfill.py --workers 8 --batch-rows 500000 dump.jsonl
+    python backfill.py --checkpoint-dir /var/lib/pgapi/backfill archive.jsonl.xz
+    python backfill.py --restart archive.jsonl.gz       # ignore the checkpoint
+    python backfill.py --dry-run archive.jsonl.gz       # parse and validate only
+"""
+
+import argparse
+import asyncio
+import bz2
+import gzip
+import json
+import logging
+import lzma
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+from typing import Any, AsyncIterator, BinaryIO, Dict, Iterator, List, Optional, Set, Tuple
+
+import asyncpg
+
+from log_pipeline import excerpt, log_limiter
+from partitions import MAINTENANCE_LOCK_ID, add_months, create_partition, month_start
+from rollups import merge_rollups
+from telemetry_writer import (
+    NOTIFY_TELEMETRY_SQL,
+    TELEMETRY_CHANNEL,
+    TelemetryRow,
+    check_row,
+    telemetry_record,
+    telemetry_row,
+)
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CHUNK_LINES = 20000
+DEFAULT_BATCH_ROWS = 250000
+DEFAULT_MONTHS_AHEAD = 3
+
+CHECKPOINT_SUFFIX = ".pos"
+
+# Invalid records reported per chunk; the rest are only counted
+MAX_CHUNK_ERRORS = 5
+
+STAGING_TABLE = "backfill_staging"
+INSERTED_TABLE = "backfill_inserted"
+
+# Temporary tables are not WAL-logged and are emptied by every commit
+CREATE_STAGING_SQL = f"""
+    CREATE TEMPORARY TABLE IF NOT EXISTS {STAGING_TABLE} (
+        device_id VARCHAR(255),
+        ts DOUBLE PRECISION,
+        fw_version VARCHAR(50),
+        wifi_ssid VARCHAR(255),
+        wifi_rssi INTEGER,
+        uptime_ms BIGINT,
+        free_heap INTEGER,
+        battery_voltage REAL,
+        led_power BOOLEAN,
+        led_water BOOLEAN,
+        led_pads BOOLEAN
+    ) ON COMMIT DELETE ROWS
+"""
+CREATE_INSERTED_SQL = f"""
+    CREATE TEMPORARY TABLE IF NOT EXISTS {INSERTED_TABLE} (LIKE "TelemetryData") ON COMMIT DELETE ROWS
+"""
+
+# Every staged row moves last_seen, including the ones already stored
+UPSERT_DEVICES_SQL = f"""
+    INSERT INTO "Devices" (device_id, last_seen, "createdAt", "updatedAt")
+    SELECT device_id, to_timestamp(MAX(ts)), CURRENT_TIMESTAMP, CURRENT_TIMESTAMP
+    FROM {STAGING_TABLE}
+    GROUP BY device_id
+    ORDER BY device_id
+    ON CONFLICT (device_id)
+    DO UPDATE SET
+        last_seen = GREATEST("Devices".last_seen, EXCLUDED.last_seen),
+        "updatedAt" = CURRENT_TIMESTAMP
+"""
+
+# Rows already stored, or repeated within the batch, are skipped; the inserted ones are
+# kept for the rollups and "LatestTelemetry"
+INSERT_TELEMETRY_SQL = f"""
+    WITH inserted AS (
+        INSERT INTO "TelemetryData" (
+            device_id, timestamp, fw_version, wifi_ssid, wifi_rssi,
+            uptime_ms, free_heap, battery_voltage,
+            led_power, led_water, led_pads,
+            "createdAt", "updatedAt"
+        )
+        SELECT device_id, to_timestamp(ts), fw_version, wifi_ssid, wifi_rssi,
+               uptime_ms, free_heap, battery_voltage,
+               led_power, led_water, led_pads,
+               CURRENT_TIMESTAMP, CURRENT_TIMESTAMP
+        FROM {STAGING_TABLE}
+        ON CONFLICT (device_id, timestamp) DO NOTHING
+        RETURNING *
+    )
+    INSERT INTO {INSERTED_TABLE} SELECT * FROM inserted
+"""
+
+# Newest inserted row per device, unless a newer one is already there; returns the
+# rows that replaced the previous latest, in TelemetryRow order, to NOTIFY them
+UPSERT_LATEST_SQL = f"""
+    INSERT INTO "LatestTelemetry" (
+        device_id, timestamp, fw_version, wifi_ssid, wifi_rssi,
+        uptime_ms, free_heap, battery_voltage,
+        led_power, led_water, led_pads, "updatedAt"
+    )
+    SELECT DISTINCT ON (device_id)
+           device_id, timestamp, fw_version, wifi_ssid, wifi_rssi,
+           uptime_ms, free_heap, battery_voltage,
+           led_power, led_water, led_pads, CURRENT_TIMESTAMP
+    FROM {INSERTED_TABLE}
+    ORDER BY device_id, timestamp DESC
+    ON CONFLICT (device_id)
+    DO UPDATE SET
+        timestamp = EXCLUDED.timestamp,
+        fw_version = EXCLUDED.fw_version,
+        wifi_ssid = EXCLUDED.wifi_ssid,
+        wifi_rssi = EXCLUDED.wifi_rssi,
+        uptime_ms = EXCLUDED.uptime_ms,
+        free_heap = EXCLUDED.free_heap,
+        battery_voltage = EXCLUDED.battery_voltage,
+        led_power = EXCLUDED.led_power,
+        led_water = EXCLUDED.led_water,
+        led_pads = EXCLUDED.led_pads,
+        "updatedAt" = CURRENT_TIMESTAMP
+    WHERE "LatestTelemetry".timestamp <= EXCLUDED.timestamp
+    RETURNING device_id, EXTRACT(EPOCH FROM timestamp)::float8, fw_version, wifi_ssid, wifi_rssi,
+              uptime_ms, free_heap, battery_voltage, led_power, led_water, led_pads
+"""
+
+_COPY_ESCAPES = str.maketrans({"\\": "\\\\", "\t": "\\t", "\n": "\\n", "\r": "\\r"})
+
+
+def _copy_value(value: Any) -> str:
+    if value is None:
+        return "\\N"
+    if value is True:
+        return "t"
+    if value is False:
+        return "f"
+    if isinstance(value, str):
+        return value.translate(_COPY_ESCAPES)
+    return repr(value)
+
+
+def parse_record(line: bytes) -> TelemetryRow:
+    record = json.loads(line)
+    if not isinstance(record, dict):
+        raise ValueError("record is not a JSON object")
+    if "device_id" not in record and "payload" in record:
+        record = record["payload"]
+        if isinstance(record, str):
+            record = json.loads(record)
+        if not isinstance(record, dict):
+            raise ValueError("payload is not a JSON object")
+    if "timestamp" not in record:
+        raise ValueError("timestamp is required")
+    row = telemetry_row(record)
+    check_row(row)
+    return row
+
+
+def parse_chunk(
+    chunk: bytes,
+    expire_before: Optional[float] = None
+) -> Tuple[bytes, int, int, int, Set[Tuple[int, int]], List[Tuple[int, str]]]:
+    """Worker process: lines of JSON -> (COPY text, rows, invalid, expired, months present, first errors)
+
+    Rows older than expire_before (epoch seconds) belong to partitions that
+    retention has already expired; they are counted and left out. Months are
+    (year, month) pairs, so the loader can create their partitions. Errors are
+    (line index within the chunk, message).
+    """
+    lines = []
+    invalid = 0
+    expired = 0
+    months: Set[Tuple[int, int]] = set()
+    errors: List[Tuple[int, str]] = []
+    for index, line in enumerate(chunk.split(b"\n")):
+        if not line.strip():
+            continue
+        try:
+            row = parse_record(line)
+        except (ValueError, TypeError, OverflowError) as e:
+            invalid += 1
+            if len(errors) < MAX_CHUNK_ERRORS:
+                errors.append((index, excerpt(e)))
+            continue
+        if expire_before is not None and row[1] < expire_before:
+            expired += 1
+            continue
+        moment = datetime.fromtimestamp(row[1], timezone.utc)
+        months.add((moment.year, moment.month))
+        lines.append("\t".join(_copy_value(value) for value in row))
+    text = "\n".join(lines) + "\n" if lines else ""
+    return text.encode(), len(lines), invalid, expired, months, errors
+
+
+def open_archive(path: str) -> BinaryIO:
+    """Binary stream of an input file, decompressed by its suffix; all of them support forward seek()"""
+    if path.endswith(".gz"):
+        return gzip.open(path, "rb")
+    if path.endswith(".bz2"):
+        return bz2.open(path, "rb")
+    if path.endswith((".xz", ".lzma")):
+        return lzma.open(path, "rb")
+    return open(path, "rb")
+
+
+def read_chunks(stream: BinaryIO, offset: int, chunk_lines: int) -> Iterator[Tuple[bytes, int, int]]:
+    """(chunk, offset just past it, lines in it), starting at offset in the decompressed stream
+
+    A final line without a newline is still read - archives are complete files.
+    """
+    stream.seek(offset)
+    while True:
+        lines = []
+        for line in stream:
+            lines.append(line)
+            if len(lines) >= chunk_lines:
+                break
+        if not lines:
+            return
+        chunk = b"".join(lines)
+        offset += len(chunk)
+        yield chunk, offset, len(lines)
+
+
+class Checkpoint:
+    """Progress through one input file, in a JSON sidecar written after each commit"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.offset = 0
+        self.lines = 0
+        self.rows_inserted = 0
+        self.rows_duplicate = 0
+        self.rows_invalid = 0
+        self.rows_expired = 0
+
+    def load(self) -> None:
+        try:
+            with open(self.path) as checkpoint_file:
+                state = json.load(checkpoint_file)
+        except FileNotFoundError:
+            return
+        self.offset = state["offset"]
+        self.lines = state["lines"]
+        self.rows_inserted = state["rows_inserted"]
+        self.rows_duplicate = state["rows_duplicate"]
+        self.rows_invalid = state["rows_invalid"]
+        self.rows_expired = state.get("rows_expired", 0)
+
+    def save(self) -> None:
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as checkpoint_file:
+            json.dump(self.stats(), checkpoint_file)
+        os.replace(tmp_path, self.path)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "offset": self.offset,
+            "lines": self.lines,
+            "rows_inserted": self.rows_inserted,
+            "rows_duplicate": self.rows_duplicate,
+            "rows_invalid": self.rows_invalid,
+            "rows_expired": self.rows_expired,
+        }
+
+
+async def _copy_source(parts: List[bytes]) -> AsyncIterator[bytes]:
+    for part in parts:
+        yield part
+
+
+class Backfill:
+    """Loads input files through a worker pool into PostgreSQL, one large transaction per batch
+
+    Up to workers * 2 chunks are in flight at a time, so memory stays bounded
+    and workers keep parsing while a batch is being written. With
+    retention_months, rows of months that partition retention has already
+    expired are skipped rather than loaded into partitions it would only
+    expire again.
+    """
+
+    def __init__(
+        self,
+        conn: Optional[asyncpg.Connection],
+        workers: int = os.cpu_count() or 1,
+        chunk_lines: int = DEFAULT_CHUNK_LINES,
+        batch_rows: int = DEFAULT_BATCH_ROWS,
+        months_ahead: int = DEFAULT_MONTHS_AHEAD,
+        retention_months: int = 0,
+        dry_run: bool = False
+    ):
+        self.conn = conn
+        self.workers = max(1, workers)
+        self.chunk_lines = chunk_lines
+        self.batch_rows = batch_rows
+        self.months_ahead = months_ahead
+        self.retention_months = retention_months
+        self.dry_run = dry_run
+
+        self._partitioned: Set[Tuple[int, int]] = set()
+
+        self.batches = 0
+        self.rows_parsed = 0
+        self.rows_inserted = 0
+        self.rows_duplicate = 0
+        self.rows_invalid = 0
+        self.rows_expired = 0
+        self.write_seconds = 0.0
+
+    async def prepare(self) -> None:
+        await self.conn.execute(CREATE_STAGING_SQL)
+        await self.conn.execute(CREATE_INSERTED_SQL)
+
+    def expire_before(self) -> Optional[float]:
+        """Start of the oldest month partition retention keeps, as epoch seconds (None: keep all)"""
+        if self.retention_months <= 0:
+            return None
+        return add_months(month_start(datetime.now(timezone.utc)), -self.retention_months).timestamp()
+
+    async def load(self, path: str, checkpoint: Checkpoint) -> None:
+        loop = asyncio.get_running_loop()
+        started = time.monotonic()
+        expire_before = self.expire_before()
+        resumed_at = checkpoint.lines
+        if checkpoint.offset:
+            logger.info(f"{path}: resuming at line {checkpoint.lines} (offset {checkpoint.offset})")
+
+        parts: List[bytes] = []
+        rows = 0
+        months: Set[Tuple[int, int]] = set()
+        pending: List[Tuple[asyncio.Future, int, int]] = []
+        line = checkpoint.lines
+        offset = checkpoint.offset
+
+        with open_archive(path) as stream, ProcessPoolExecutor(self.workers) as executor:
+            chunks = read_chunks(stream, checkpoint.offset, self.chunk_lines)
+            exhausted = False
+            while True:
+                # Keep every worker busy, bounded to two chunks each
+                while not exhausted and len(pending) < self.workers * 2:
+                    chunk = next(chunks, None)
+                    if chunk is None:
+                        exhausted = True
+                        break
+                    data, end, count = chunk
+                    pending.append((loop.run_in_executor(executor, parse_chunk, data, expire_before), end, count))
+                if not pending:
+                    break
+
+                future, offset, count = pending.pop(0)
+                text, chunk_rows, invalid, expired, chunk_months, errors = await future
+                for index, error in errors:
+                    log_limiter.log(logger, logging.WARNING, "backfill_invalid",
+                                    f"{path}:{line + index + 1}: invalid record, {error}")
+                if expired:
+                    log_limiter.log(logger, logging.WARNING, "backfill_expired",
+                                    f"{path}: skipped {expired} rows in lines {line + 1}-{line + count}, "
+                                    f"older than the {self.retention_months} month retention")
+                line += count
+                checkpoint.rows_invalid += invalid
+                checkpoint.rows_expired += expired
+                self.rows_invalid += invalid
+                self.rows_expired += expired
+                if chunk_rows:
+                    parts.append(text)
+                    rows += chunk_rows
+                    months |= chunk_months
+
+                if rows >= self.batch_rows:
+                    await self._write(parts, rows, months, checkpoint, offset, line)
+                    parts, rows, months = [], 0, set()
+                    self._progress(path, checkpoint, (line - resumed_at) / (time.monotonic() - started))
+
+            if offset != checkpoint.offset:
+                await self._write(parts, rows, months, checkpoint, offset, line)
+                self._progress(path, checkpoint, (line - resumed_at) / (time.monotonic() - started))
+
+    def _progress(self, path: str, checkpoint: Checkpoint, lines_per_second: float) -> None:
+        logger.info(
+            f"{path}: line {checkpoint.lines}, {checkpoint.rows_inserted} inserted, {checkpoint.rows_duplicate} duplicate, "
+            f"{checkpoint.rows_invalid} invalid, {checkpoint.rows_expired} expired ({lines_per_second:.0f} lines/s)"
+        )
+
+    async def _write(
+        self,
+        parts: List[bytes],
+        rows: int,
+        months: Set[Tuple[int, int]],
+        checkpoint: Checkpoint,
+        offset: int,
+        lines: int
+    ) -> None:
+        """Store one batch, then record that the input up to offset is done"""
+        inserted = 0
+        if rows and not self.dry_run:
+            await self._ensure_partitions(months)
+            started = time.monotonic()
+            inserted = await self._store(parts)
+            self.write_seconds += time.monotonic() - started
+            self.batches += 1
+
+        self.rows_parsed += rows
+        checkpoint.offset = offset
+        checkpoint.lines = lines
+        if self.dry_run:
+            return
+        self.rows_inserted += inserted
+        self.rows_duplicate += rows - inserted
+        checkpoint.rows_inserted += inserted
+        checkpoint.rows_duplicate += rows - inserted
+        checkpoint.save()
+
+    async def _store(self, parts: List[bytes]) -> int:
+        async with self.conn.transaction():
+            await self.conn.copy_to_table(STAGING_TABLE, source=_copy_source(parts), format="text")
+            await self.conn.execute(UPSERT_DEVICES_SQL)
+            result = await self.conn.execute(INSERT_TELEMETRY_SQL)
+            inserted = int(result.split()[-1])
+            if not inserted:
+                return 0
+
+            await merge_rollups(self.conn, INSERTED_TABLE)
+            latest = await self.conn.fetch(UPSERT_LATEST_SQL)
+            if latest:
+                await self.conn.execute(
+                    NOTIFY_TELEMETRY_SQL,
+                    TELEMETRY_CHANNEL,
+                    [json.dumps(telemetry_record(tuple(record)), separators=(",", ":")) for record in latest]
+                )
+        return inserted
+
+    async def _ensure_partitions(self, months: Set[Tuple[int, int]]) -> None:
+        """Create the monthly partitions a batch needs, up to months_ahead
+
+        Months beyond that (bad device clocks) go to the default partition, as
+        on the live path, until partition maintenance reaches them and moves
+        them out. A month already covered by the legacy partition can't get its
+        own and is skipped.
+        """
+        last = add_months(month_start(datetime.now(timezone.utc)), self.months_ahead)
+        missing = sorted(
+            month for month in months - self._partitioned
+            if datetime(month[0], month[1], 1, tzinfo=timezone.utc) <= last
+        )
+        if not missing:
+            return
+
+        await self.conn.execute("SELECT pg_advisory_lock($1)", MAINTENANCE_LOCK_ID)
+        try:
+            for year, month in missing:
+                try:
+                    async with self.conn.transaction():
+                        await create_partition(self.conn, datetime(year, month, 1, tzinfo=timezone.utc))
+                except asyncpg.PostgresError as e:
+                    logger.info(f"No partition for {year:04d}-{month:02d}, rows go to an existing one: {e}")
+                self._partitioned.add((year, month))
+        finally:
+            await self.conn.execute("SELECT pg_advisory_unlock($1)", MAINTENANCE_LOCK_ID)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "batches": self.batches,
+            "rows_parsed": self.rows_parsed,
+            "rows_inserted": self.rows_inserted,
+            "rows_duplicate": self.rows_duplicate,
+            "rows_invalid": self.rows_invalid,
+            "rows_expired": self.rows_expired,
+            "write_seconds": round(self.write_seconds, 1),
+        }
+
+
+def checkpoint_path(path: str, checkpoint_dir: Optional[str]) -> str:
+    """Sidecar next to the input, or named after it in checkpoint_dir"""
+    if checkpoint_dir is None:
+        return path + CHECKPOINT_SUFFIX
+    return os.path.join(checkpoint_dir, os.path.basename(path) + CHECKPOINT_SUFFIX)
+
+
+async def _main(args: argparse.Namespace) -> None:
+    conn = None
+    if not args.dry_run:
+        from env import DB_HOST, DB_PORT, DB_NAME, DB_USER, DB_PASSWORD
+
+        conn = await asyncpg.connect(
+            host=DB_HOST,
+            port=int(DB_PORT),
+            database=DB_NAME,
+            user=DB_USER,
+            password=DB_PASSWORD
+        )
+    if args.checkpoint_dir:
+        os.makedirs(args.checkpoint_dir, exist_ok=True)
+
+    backfill = Backfill(
+        conn,
+        workers=args.workers,
+        chunk_lines=args.chunk_lines,
+        batch_rows=args.batch_rows,
+        months_ahead=args.months_ahead,
+        retention_months=args.retention_months,
+        dry_run=args.dry_run
+    )
+    started = time.monotonic()
+    try:
+        if conn is not None:
+            await backfill.prepare()
+        for path in args.paths:
+            checkpoint = Checkpoint(checkpoint_path(path, args.checkpoint_dir))
+            if not args.restart and not args.dry_run:
+                checkpoint.load()
+            await backfill.load(path, checkpoint)
+            logger.info(f"{path}: done, {checkpoint.stats()}")
+    finally:
+        if conn is not None:
+            await conn.close()
+
+    elapsed = time.monotonic() - started
+    stats = backfill.stats()
+    print(f"{'Validated' if args.dry_run else 'Loaded'} {stats['rows_parsed']} telemetry rows in {elapsed:.1f}s "
+          f"({stats['rows_parsed'] / max(elapsed, 1e-9) * 60:.0f} rows/min): {stats}")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("paths", nargs="+", help="JSONL input files, optionally .gz, .bz2 or .xz compressed")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="Parser processes (default: one per core)")
+    parser.add_argument("--chunk-lines", type=int, default=DEFAULT_CHUNK_LINES, help="Lines per worker task")
+    parser.add_argument("--batch-rows", type=int, default=DEFAULT_BATCH_ROWS, help="Rows per transaction")
+    parser.add_argument("--months-ahead", type=int, default=DEFAULT_MONTHS_AHEAD,
+                        help="Latest month (from now) to create a partition for")
+    parser.add_argument("--retention-months", type=int, default=int(os.getenv("TELEMETRY_RETENTION_MONTHS", "0")),
+                        help="Skip rows of partitions retention has expired (default: TELEMETRY_RETENTION_MONTHS, 0: keep all)")
+    parser.add_argument("--checkpoint-dir", help="Directory for checkpoints (default: next to each input)")
+    parser.add_argument("--restart", action="store_true", help="Ignore existing checkpoints and start from the top")
+    parser.add_argument("--dry-run", action="store_true", help="Parse and validate only, without a database")
+    asyncio.run(_main(parser.parse_args()))
@@ -0,0 +1,170 @@
+"""
+bench_api.py
+
+Created on: 2026-10-17
+Edited on: 2026-10-17
+Author: R. Andrew Ballard (c) 2025 "Andwardo"
+Version: v1.0.0
+
+API benchmark: closed-loop load against the /api/data endpoints
+
+--concurrency clients each send requests back to back over a keep-alive
+connection for --duration seconds, picking endpoints round-robin and device
+ids at random from /api/data/devices. Reports throughput, latency
+percentiles and error counts per endpoint, plus pool wait time taken from
+the Server-Timing header the API adds to every response.
+
+Usage (from the repository root, with the API running):
+    python -m benchmarks.bench_api --url http://127.0.0.1:58000 \\
+        --concurrency 16 --duration 30 [--endpoints history,latest,fleet] [--json api.json]
+"""
+
+import argparse
+import http.client
+import json
+import os
+import random
+import re
+import sys
+import threading
+import time
+from collections import defaultdict
+from typing import Any, Callable, Dict, List, Tuple
+from urllib.parse import urlsplit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.report import print_report, summarize  # noqa: E402
+
+_POOL_TIMING = re.compile(r"pool;dur=([0-9.]+)")
+
+# Endpoint name -> path builder taking (device_id, now)
+ENDPOINTS: Dict[str, Callable[[str, int], str]] = {
+    "history": lambda d, now: f"/api/data/history?device_id={d}&limit=100&total=none",
+    "history_all": lambda d, now: "/api/data/history?limit=100",
+    "latest": lambda d, now: f"/api/data/latest?device_id={d}",
+    "fleet": lambda d, now: "/api/data/fleet?limit=100",
+    "resample": lambda d, now: f"/api/data/resample?device_id={d}&start={now - 3600}&end={now}&step=60",
+    "series": lambda d, now: f"/api/data/series?device_id={d}&metric=battery_voltage,wifi_rssi&start={now - 86400}&end={now}&points=500",
+    "aggregate": lambda d, now: f"/api/data/aggregate?device_id={d}&start={now - 86400}&end={now}&bucket=1h",
+    "devices": lambda d, now: "/api/data/devices",
+}
+
+
+def fetch_device_ids(host: str, port: int, limit: int) -> List[str]:
+    conn = http.client.HTTPConnection(host, port, timeout=30)
+    try:
+        conn.request("GET", "/api/data/devices")
+        response = conn.getresponse()
+        devices = json.loads(response.read())
+    finally:
+        conn.close()
+    return [d["device_id"] for d in devices[:limit]]
+
+
+def client_loop(
+    host: str,
+    port: int,
+    endpoints: List[str],
+    device_ids: List[str],
+    deadline: float,
+    offset: int,
+    samples: Dict[str, List[Tuple[float, float, int]]],
+    lock: threading.Lock
+) -> None:
+    """One closed-loop client; appends (latency, pool wait, status) per request"""
+    conn = http.client.HTTPConnection(host, port, timeout=60)
+    local: Dict[str, List[Tuple[float, float, int]]] = defaultdict(list)
+    index = offset
+    while time.monotonic() < deadline:
+        name = endpoints[index % len(endpoints)]
+        index += 1
+        path = ENDPOINTS[name](random.choice(device_ids), int(time.time()))
+
+        started = time.perf_counter()
+        try:
+            conn.request("GET", path)
+            response = conn.getresponse()
+            response.read()
+            status = response.status
+            match = _POOL_TIMING.search(response.getheader("Server-Timing") or "")
+            pool_wait = float(match.group(1)) if match else 0.0
+        except (OSError, http.client.HTTPException):
+            conn.close()
+            conn = http.client.HTTPConnection(host, port, timeout=60)
+            status, pool_wait = 0, 0.0
+        local[name].append(((time.perf_counter() - started) * 1000, pool_wait, status))
+    conn.close()
+
+    with lock:
+        for name, results in local.items():
+            samples[name].extend(results)
+
+
+def run(args: argparse.Namespace) -> Dict[str, Any]:
+    url = urlsplit(args.url)
+    host, port = url.hostname, url.port or 80
+    endpoints = [e.strip() for e in args.endpoints.split(",") if e.strip()]
+    unknown = [e for e in endpoints if e not in ENDPOINTS]
+    if unknown:
+        raise SystemExit(f"Unknown endpoints: {', '.join(unknown)} (choose from {', '.join(ENDPOINTS)})")
+
+    device_ids = fetch_device_ids(host, port, args.max_devices)
+    if not device_ids:
+        raise SystemExit("No devices in the database - run bench_ingest first")
+
+    print(f"{args.concurrency} clients for {args.duration}s against {args.url} ({len(device_ids)} devices)")
+    samples: Dict[str, List[Tuple[float, float, int]]] = defaultdict(list)
+    lock = threading.Lock()
+    deadline = time.monotonic() + args.duration
+    threads = [
+        threading.Thread(
+            target=client_loop,
+            args=(host, port, endpoints, device_ids, deadline, i, samples, lock),
+            daemon=True
+        )
+        for i in range(args.concurrency)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    results = {}
+    for name, entries in samples.items():
+        ok = [e for e in entries if 200 <= e[2] < 400 or e[2] == 404]
+        results[name] = {
+            "requests": len(entries),
+            "requests_per_second": len(entries) / args.duration,
+            "errors": len(entries) - len(ok),
+            "latency_ms": summarize([e[0] for e in ok]),
+            "pool_wait_ms": summarize([e[1] for e in ok]),
+        }
+
+    return {
+        "benchmark": "api",
+        "settings": {
+            "url": args.url,
+            "concurrency": args.concurrency,
+            "duration": args.duration,
+            "endpoints": ",".join(endpoints),
+        },
+        "endpoints": results,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="http://127.0.0.1:8000", help="API base URL")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--duration", type=float, default=30.0)
+    parser.add_argument("--endpoints", default="history,latest,fleet,aggregate", help=f"Any of: {','.join(ENDPOINTS)}")
+    parser.add_argument("--max-devices", type=int, default=1000, help="Device ids to sample requests from")
+    parser.add_argument("--json", help="Also write the result to this file")
+    args = parser.parse_args()
+
+    result = run(args)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(result, f, indent=2)
+    print_report({"api": result})
@@ -0,0 +1,201 @@
+"""
+bench_ingest.py
+
+Created on: 2026-10-17
+Edited on: 2026-10-17
+Author: R. Andrew Ballard (c) 2025 "Andwardo"
+Version: v1.0.0
+
+Ingest benchmark: a synthetic DCM-1 fleet publishing to the broker, measured at the database
+
+Publishes the documented telemetry JSON for --devices devices at --rate messages
+per second each, for --duration seconds, then waits for the rows to land in
+"TelemetryData" and reports sustained throughput and ingest lag. Lag is
+publish time (sent as a fractional timestamp) to "createdAt", the start of
+the batch transaction that wrote the row.
+
+Every run uses fresh device ids (bench-<run>-NNNNN), so it can be pointed at a
+database that already has data.
+
+Usage (from the repository root, with mqtt_subscriber.py running):
+    python -m benchmarks.bench_ingest --dsn postgresql://bench@localhost:55432/bench \\
+        --port 51883 --devices 500 --rate 1 --duration 60 [--json ingest.json]
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import time
+import uuid
+from typing import Any, Dict, List
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import asyncpg  # noqa: E402
+import paho.mqtt.client as mqtt  # noqa: E402
+from paho.mqtt.client import CallbackAPIVersion  # noqa: E402
+
+from benchmarks.report import print_report  # noqa: E402
+
+TOPIC = "pianoguard/{device_id}/telemetry"
+
+LANDED_SQL = """
+    SELECT COUNT(*)
+    FROM "TelemetryData"
+    WHERE device_id = ANY($1::varchar[]) AND timestamp >= to_timestamp($2)
+"""
+
+LAG_SQL = """
+    SELECT COUNT(*) AS row_count,
+           EXTRACT(EPOCH FROM MAX("createdAt") - MIN("createdAt")) AS span,
+           percentile_disc(ARRAY[0.5, 0.95, 0.99]) WITHIN GROUP (
+               ORDER BY EXTRACT(EPOCH FROM "createdAt" - timestamp)
+           ) AS lag,
+           MAX(EXTRACT(EPOCH FROM "createdAt" - timestamp)) AS max_lag
+    FROM "TelemetryData"
+    WHERE device_id = ANY($1::varchar[]) AND timestamp >= to_timestamp($2)
+"""
+
+
+def telemetry_payload(device_id: str, sequence: int) -> Dict[str, Any]:
+    """Documented telemetry message with plausible, slowly varying values"""
+    return {
+        "device_id": device_id,
+        "timestamp": time.time(),
+        "fw_version": "1.0.0",
+        "wifi_ssid": "BenchNetwork",
+        "wifi_rssi": random.randint(-80, -40),
+        "uptime_ms": sequence * 1000,
+        "free_heap": random.randint(40000, 60000),
+        "battery_voltage": round(random.uniform(11.8, 12.8), 2),
+        "status": {
+            "power": True,
+            "water": random.random() < 0.1,
+            "pads": random.random() < 0.5,
+        },
+    }
+
+
+def publish_fleet(
+    broker: str,
+    port: int,
+    device_ids: List[str],
+    rate: float,
+    duration: float,
+    qos: int
+) -> Dict[str, Any]:
+    """Publish at devices * rate messages per second, spread evenly, round-robin over devices"""
+    client = mqtt.Client(
+        callback_api_version=CallbackAPIVersion.VERSION2,
+        client_id=f"pianoguard_bench-{uuid.uuid4().hex[:8]}",
+        clean_session=True
+    )
+    client.connect(broker, port)
+    client.loop_start()
+
+    total_rate = len(device_ids) * rate
+    published = 0
+    started = time.monotonic()
+    try:
+        while True:
+            elapsed = time.monotonic() - started
+            if elapsed >= duration:
+                break
+            due = int(elapsed * total_rate) - published
+            if due <= 0:
+                time.sleep(min(0.001, 1 / total_rate))
+                continue
+            for _ in range(due):
+                device_id = device_ids[published % len(device_ids)]
+                payload = telemetry_payload(device_id, published // len(device_ids))
+                client.publish(TOPIC.format(device_id=device_id), json.dumps(payload), qos=qos)
+                published += 1
+        elapsed = time.monotonic() - started
+    finally:
+        client.loop_stop()
+        client.disconnect()
+
+    return {"published": published, "publish_seconds": elapsed}
+
+
+async def measure_ingest(
+    dsn: str,
+    device_ids: List[str],
+    since: float,
+    expected: int,
+    timeout: float
+) -> Dict[str, Any]:
+    """Wait for the published rows to land (or timeout), then compute throughput and lag"""
+    conn = await asyncpg.connect(dsn)
+    try:
+        deadline = time.monotonic() + timeout
+        landed = 0
+        while time.monotonic() < deadline:
+            landed = await conn.fetchval(LANDED_SQL, device_ids, since)
+            if landed >= expected:
+                break
+            await asyncio.sleep(0.5)
+
+        row = await conn.fetchrow(LAG_SQL, device_ids, since)
+    finally:
+        await conn.close()
+
+    lag = row["lag"] or [None, None, None]
+    span = float(row["span"] or 0)
+    return {
+        "rows_landed": row["row_count"],
+        "sustained_rows_per_second": row["row_count"] / span if span else None,
+        "lag_ms": {
+            "p50": float(lag[0]) * 1000 if lag[0] is not None else None,
+            "p95": float(lag[1]) * 1000 if lag[1] is not None else None,
+            "p99": float(lag[2]) * 1000 if lag[2] is not None else None,
+            "max": float(row["max_lag"]) * 1000 if row["max_lag"] is not None else None,
+        },
+    }
+
+
+def run(args: argparse.Namespace) -> Dict[str, Any]:
+    run_id = uuid.uuid4().hex[:6]
+    device_ids = [f"bench-{run_id}-{i:05d}" for i in range(args.devices)]
+    since = time.time() - 1
+
+    print(f"Publishing {args.devices} devices x {args.rate} msg/s for {args.duration}s (run {run_id})")
+    published = publish_fleet(args.broker, args.port, device_ids, args.rate, args.duration, args.qos)
+    print(f"Published {published['published']} messages, waiting for them to land")
+    ingest = asyncio.run(measure_ingest(args.dsn, device_ids, since, published["published"], args.drain_timeout))
+
+    return {
+        "benchmark": "ingest",
+        "settings": {
+            "devices": args.devices,
+            "rate": args.rate,
+            "duration": args.duration,
+            "qos": args.qos,
+        },
+        "published": published["published"],
+        "published_per_second": published["published"] / published["publish_seconds"],
+        **ingest,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--dsn", required=True, help="Database the subscriber writes to")
+    parser.add_argument("--broker", default="localhost")
+    parser.add_argument("--port", type=int, default=1883)
+    parser.add_argument("--devices", type=int, default=100)
+    parser.add_argument("--rate", type=float, default=1.0, help="Messages per second per device")
+    parser.add_argument("--duration", type=float, default=30.0, help="Seconds to publish for")
+    parser.add_argument("--qos", type=int, choices=(0, 1), default=0)
+    parser.add_argument("--drain-timeout", type=float, default=60.0, help="Seconds to wait for rows to land")
+    parser.add_argument("--json", help="Also write the result to this file")
+    args = parser.parse_args()
+
+    result = run(args)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(result, f, indent=2)
+    print_report({"ingest": result})
@@ -0,0 +1,109 @@
+"""
+report.py
+
+Created on: 2026-10-17
+Edited on: 2026-10-17
+Author: R. Andrew Ballard (c) 2025 "Andwardo"
+Version: v1.0.0
+
+Benchmark report: combines bench_ingest / bench_api JSON results into one table,
+optionally against a baseline run to catch regressions
+
+Usage (from the repository root):
+    python -m benchmarks.report results/ingest.json results/api.json
+    python -m benchmarks.report results/*.json --baseline baseline/*.json
+"""
+
+import argparse
+import json
+import statistics
+from typing import Dict, List, Optional
+
+
+def summarize(samples: List[float]) -> Dict[str, Optional[float]]:
+    """p50/p95/p99/max of samples (nearest-rank), all None when there are none"""
+    if not samples:
+        return {"p50": None, "p95": None, "p99": None, "max": None}
+    ordered = sorted(samples)
+
+    def rank(fraction: float) -> float:
+        return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+    return {"p50": statistics.median(ordered), "p95": rank(0.95), "p99": rank(0.99), "max": ordered[-1]}
+
+
+def load(paths: List[str]) -> Dict[str, dict]:
+    """Results keyed by benchmark name ("ingest", "api")"""
+    results = {}
+    for path in paths:
+        with open(path) as f:
+            result = json.load(f)
+        results[result["benchmark"]] = result
+    return results
+
+
+def _fmt(value: Optional[float], unit: str = "") -> str:
+    return "-" if value is None else f"{value:,.2f}{unit}"
+
+
+def _delta(value: Optional[float], baseline: Optional[float]) -> str:
+    if value is None or not baseline:
+        return ""
+    return f"{(value - baseline) / baseline * 100:+.1f}%"
+
+
+def rows(results: Dict[str, dict]) -> Dict[str, Optional[float]]:
+    """Flatten results into metric name -> value"""
+    flat: Dict[str, Optional[float]] = {}
+
+    ingest = results.get("ingest")
+    if ingest:
+        flat["ingest published msg/s"] = ingest["published_per_second"]
+        flat["ingest sustained rows/s"] = ingest["sustained_rows_per_second"]
+        flat["ingest rows missing"] = ingest["published"] - ingest["rows_landed"]
+        for key in ("p50", "p95", "p99", "max"):
+            flat[f"ingest lag {key} (ms)"] = ingest["lag_ms"][key]
+
+    api = results.get("api")
+    if api:
+        for name, endpoint in sorted(api["endpoints"].items()):
+            flat[f"{name} req/s"] = endpoint["requests_per_second"]
+            flat[f"{name} errors"] = endpoint["errors"]
+            for key in ("p50", "p95", "p99"):
+                flat[f"{name} latency {key} (ms)"] = endpoint["latency_ms"][key]
+            for key in ("p50", "p99"):
+                flat[f"{name} pool wait {key} (ms)"] = endpoint["pool_wait_ms"][key]
+
+    return flat
+
+
+def print_report(results: Dict[str, dict], baseline: Optional[Dict[str, dict]] = None) -> None:
+    current = rows(results)
+    previous = rows(baseline) if baseline else {}
+
+    for name in ("ingest", "api"):
+        if name in results:
+            settings = ", ".join(f"{k}={v}" for k, v in sorted(results[name]["settings"].items()))
+            print(f"{name}: {settings}")
+    print()
+
+    width = max((len(name) for name in current), default=20)
+    header = f"{'metric':<{width}}  {'value':>14}"
+    if baseline:
+        header += f"  {'baseline':>14}  {'change':>8}"
+    print(header)
+    print("-" * len(header))
+    for name, value in current.items():
+        line = f"{name:<{width}}  {_fmt(value):>14}"
+        if baseline:
+            line += f"  {_fmt(previous.get(name)):>14}  {_delta(value, previous.get(name)):>8}"
+        print(line)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("results", nargs="+", help="JSON files written by bench_ingest / bench_api --json")
+    parser.add_argument("--baseline", nargs="+", help="JSON files from an earlier run to compare against")
+    args = parser.parse_args()
+
+    print_report(load(args.results), load(args.baseline) if args.baseline else None)
@@ -0,0 +1,95 @@
+#!/bin/bash
+# benchmarks/run_local.sh
+#
+# Runs the ingest and API benchmarks on a dev box against a throwaway stack:
+# a temporary PostgreSQL cluster, a local mosquitto, mqtt_subscriber.py and
+# the API under gunicorn, all on non-default ports and torn down on exit.
+#
+# Needs PostgreSQL server binaries (initdb/pg_ctl) and mosquitto installed.
+#
+# Usage (from anywhere):
+#   benchmarks/run_local.sh
+#   DEVICES=1000 RATE=2 DURATION=120 CONCURRENCY=32 benchmarks/run_local.sh
+#   BASELINE="benchmarks/results/<earlier run>/*.json" benchmarks/run_local.sh
+
+set -euo pipefail
+
+cd "$(dirname "$0")/.."
+PYTHON=${PYTHON:-python}
+
+# Load shape
+DEVICES=${DEVICES:-200}
+RATE=${RATE:-1}                  # messages per second per device
+DURATION=${DURATION:-60}         # seconds, each benchmark
+CONCURRENCY=${CONCURRENCY:-16}
+API_WORKERS=${API_WORKERS:-2}
+ENDPOINTS=${ENDPOINTS:-history,latest,fleet,aggregate}
+
+# Throwaway stack
+PG_PORT=${PG_PORT:-55432}
+MQTT_PORT=${MQTT_PORT:-51883}
+API_PORT=${API_PORT:-58000}
+PG_BIN=${PG_BIN:-$(pg_config --bindir)}
+
+WORK=$(mktemp -d /tmp/pgapi-bench.XXXXXX)
+RESULTS=${RESULTS:-benchmarks/results/$(date +%Y%m%d-%H%M%S)}
+mkdir -p "$RESULTS"
+PIDS=()
+
+cleanup() {
+    for pid in "${PIDS[@]}"; do
+        kill "$pid" 2>/dev/null || true
+    done
+    wait 2>/dev/null || true
+    "$PG_BIN/pg_ctl" -D "$WORK/pg" -m fast stop >/dev/null 2>&1 || true
+    rm -rf "$WORK"
+}
+trap cleanup EXIT
+
+echo "Starting PostgreSQL on port $PG_PORT"
+"$PG_BIN/initdb" -D "$WORK/pg" -U bench --auth=trust >/dev/null
+"$PG_BIN/pg_ctl" -D "$WORK/pg" -l "$WORK/postgres.log" -w \
+    -o "-p $PG_PORT -k $WORK -c listen_addresses=localhost ${PG_OPTS:-}" start >/dev/null
+"$PG_BIN/createdb" -h localhost -p "$PG_PORT" -U bench bench
+
+echo "Starting mosquitto on port $MQTT_PORT"
+printf 'listener %s localhost\nallow_anonymous true\n' "$MQTT_PORT" > "$WORK/mosquitto.conf"
+mosquitto -c "$WORK/mosquitto.conf" > "$WORK/mosquitto.log" 2>&1 &
+PIDS+=($!)
+
+# Exported values take precedence over .env
+export DB_HOST=localhost DB_PORT=$PG_PORT DB_NAME=bench DB_USER=bench DB_PASSWORD=bench
+export PIANOGUARD_FACTORY_KEY=${PIANOGUARD_FACTORY_KEY:-benchmarkbenchmarkbenchmarkbenchmarkbenchmarkben}
+export MQTT_BROKER=localhost MQTT_PORT
+export MQTT_SUBSCRIBER_LOG=$WORK/subscriber.log SPOOL_DIR=$WORK/spool
+export METRICS_PORT=${METRICS_PORT:-0} PROMETHEUS_MULTIPROC_DIR=$WORK/metrics
+DSN="postgresql://bench@localhost:$PG_PORT/bench"
+
+"$PYTHON" migrations.py
+
+echo "Starting subscriber and API ($API_WORKERS workers on port $API_PORT)"
+"$PYTHON" mqtt_subscriber.py > "$WORK/subscriber.out" 2>&1 &
+PIDS+=($!)
+"$PYTHON" -m gunicorn main:app --workers "$API_WORKERS" --worker-class uvicorn.workers.UvicornWorker \
+    --bind "127.0.0.1:$API_PORT" > "$WORK/api.log" 2>&1 &
+PIDS+=($!)
+
+for _ in $(seq 1 30); do
+    curl -sf "http://127.0.0.1:$API_PORT/api/health" >/dev/null && break
+    sleep 1
+done
+
+"$PYTHON" -m benchmarks.bench_ingest --dsn "$DSN" --port "$MQTT_PORT" \
+    --devices "$DEVICES" --rate "$RATE" --duration "$DURATION" --json "$RESULTS/ingest.json"
+"$PYTHON" -m benchmarks.bench_api --url "http://127.0.0.1:$API_PORT" \
+    --concurrency "$CONCURRENCY" --duration "$DURATION" --endpoints "$ENDPOINTS" --json "$RESULTS/api.json"
+
+echo
+if [ -n "${BASELINE:-}" ]; then
+    # shellcheck disable=SC2086
+    "$PYTHON" -m benchmarks.report "$RESULTS"/*.json --baseline $BASELINE
+else
+    "$PYTHON" -m benchmarks.report "$RESULTS"/*.json
+fi
+echo
+echo "Results saved in $RESULTS"
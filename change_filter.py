@@ -0,0 +1,133 @@
+"""
+change_filter.py
+
+Created on: 2026-10-17
+Edited on: 2026-10-17
+Author: R. Andrew Ballard (c) 2025 "Andwardo"
+Version: v1.0.0
+
+Change-aware storage for idle devices
+Keeps each device's last stored row in memory and lets the writer skip rows
+that only repeat it: a row is stored when a field changes beyond its
+deadband, the device rebooted (uptime went backwards), or max_interval has
+passed since the last stored row. Stored rows are then the points of a step
+function, which /api/data/resample turns back into regular samples.
+"""
+
+from typing import Dict, List, Optional, Tuple
+
+from telemetry_writer import TelemetryRow
+
+STORAGE_ALL = "all"
+STORAGE_CHANGES = "changes"
+STORAGE_MODES = (STORAGE_ALL, STORAGE_CHANGES)
+
+# TelemetryRow positions of the fields a change is detected on; uptime_ms (5) always
+# increases and is only checked for going backwards
+FIELDS = {
+    "fw_version": 2,
+    "wifi_ssid": 3,
+    "wifi_rssi": 4,
+    "free_heap": 6,
+    "battery_voltage": 7,
+    "led_power": 8,
+    "led_water": 9,
+    "led_pads": 10,
+}
+_UPTIME = 5
+
+# Fields a deadband can be set on
+NUMERIC_FIELDS = ("wifi_rssi", "free_heap", "battery_voltage")
+
+DEFAULT_DEADBANDS = "battery_voltage=0.05,wifi_rssi=6,free_heap=4096"
+
+
+def parse_deadbands(value: str) -> Dict[str, float]:
+    """"field=amount,..." -> {field: amount}; fields without one must match exactly"""
+    deadbands = {}
+    for entry in value.split(","):
+        if not entry.strip():
+            continue
+        field, _, amount = entry.partition("=")
+        field = field.strip()
+        if field not in NUMERIC_FIELDS:
+            raise ValueError(f"Unknown deadband field {field!r} (choose from {', '.join(NUMERIC_FIELDS)})")
+        deadbands[field] = float(amount)
+    return deadbands
+
+
+class ChangeFilter:
+    """Splits batches into rows worth storing and suppressed repeats, per device
+
+    A row is compared with the device's last *stored* row, so slow drift is
+    still stored once it adds up to a deadband. Rows older than the last
+    stored one (late or replayed) are always stored and don't move the state.
+    """
+
+    def __init__(self, max_interval: float = 300.0, deadbands: Optional[Dict[str, float]] = None):
+        self.max_interval = max_interval
+        self.deadbands = {FIELDS[field]: amount for field, amount in (deadbands or {}).items()}
+        self._last: Dict[str, TelemetryRow] = {}
+
+        self.rows_stored = 0
+        self.rows_suppressed = 0
+
+    def __len__(self) -> int:
+        return len(self._last)
+
+    def changed(self, row: TelemetryRow, last: TelemetryRow) -> bool:
+        for index in FIELDS.values():
+            value, previous = row[index], last[index]
+            if value == previous:
+                continue
+            if value is None or previous is None:
+                return True
+            deadband = self.deadbands.get(index)
+            if deadband is None or abs(value - previous) > deadband:
+                return True
+        return False
+
+    def should_store(self, row: TelemetryRow, last: Optional[TelemetryRow]) -> bool:
+        if last is None or row[1] <= last[1]:
+            # First row seen, or late / redelivered - stored as-is, the unique index skips exact repeats
+            return True
+        rebooted = row[_UPTIME] is not None and last[_UPTIME] is not None and row[_UPTIME] < last[_UPTIME]
+        return rebooted or row[1] - last[1] >= self.max_interval or self.changed(row, last)
+
+    def split(self, rows: List[TelemetryRow]) -> Tuple[List[TelemetryRow], List[TelemetryRow]]:
+        """(rows to store, suppressed rows), in arrival order
+
+        Rows are compared with those selected earlier in the batch, but the
+        state itself only moves in commit(), once the batch is written.
+        """
+        pending: Dict[str, TelemetryRow] = {}
+        stored, suppressed = [], []
+        for row in rows:
+            last = pending.get(row[0]) or self._last.get(row[0])
+            if self.should_store(row, last):
+                stored.append(row)
+                if last is None or row[1] > last[1]:
+                    pending[row[0]] = row
+            else:
+                suppressed.append(row)
+        return stored, suppressed
+
+    def commit(self, stored: List[TelemetryRow], suppressed: List[TelemetryRow]) -> None:
+        """Record a split batch as written: its newest stored rows become the ones compared against
+
+        Not called for a batch that was spooled or abandoned, so later rows are
+        never suppressed as repeats of a row that didn't reach the database.
+        """
+        for row in stored:
+            last = self._last.get(row[0])
+            if last is None or row[1] > last[1]:
+                self._last[row[0]] = row
+        self.rows_stored += len(stored)
+        self.rows_suppressed += len(suppressed)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "devices": len(self),
+            "rows_stored": self.rows_stored,
+            "rows_suppressed": self.rows_suppressed,
+        }
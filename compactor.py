@@ -0,0 +1,421 @@
+"""
+compactor.py
+
+Created on: 2026-10-17
+Edited on: 2026-10-17
+Author: R. Andrew Ballard (c) 2025 "Andwardo"
+Version: v1.0.0
+
+Tiered retention for telemetry: raw rows, then rollups, then nothing
+Raw rows are kept for raw_days; older days are compacted (their rollups are
+rebuilt from the complete raw rows) and the raw rows deleted, after which
+/api/data/aggregate still serves them from "TelemetryRollups". Each rollup
+resolution can have its own retention on top (e.g. 1m for 30 days, 1h for
+two years, 1d forever).
+
+All work happens in small autocommitted chunks found through indexes, with
+a pause between chunks and a wait whenever a streaming replica falls behind,
+so ingest never waits on a lock and deletes never flood the WAL. Monthly
+partitions entirely past the raw window are dropped instead of deleted
+row by row. The mqtt_subscriber runs a pass every COMPACTION_INTERVAL.
+
+Usage:
+    python compactor.py --raw-days 90                          # one compaction pass
+    python compactor.py --raw-days 90 --rollups 1m=30,1h=730   # also expire old rollups
+    python compactor.py --status                               # progress and backlog only
+"""
+
+import argparse
+import asyncio
+import logging
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, Optional
+
+import asyncpg
+
+from metrics import COMPACTION_BACKLOG_SECONDS, COMPACTION_BYTES_RECLAIMED, COMPACTION_ROWS_DELETED
+from partitions import DEFAULT_PARTITION, PARENT_TABLE, list_partitions
+from rollups import RESOLUTIONS, rebuild_rollups
+
+logger = logging.getLogger(__name__)
+
+# Arbitrary constant so only one process compacts at a time
+COMPACTION_LOCK_ID = 7420003
+
+ROLLUP_TABLE = "TelemetryRollups"
+STATE_TABLE = "TelemetryCompaction"
+
+# Longest a partition drop may wait for its lock before it is left for the next pass
+DROP_LOCK_TIMEOUT = "2s"
+
+# Oldest raw day that still has rows, at or after $1 (anywhere when NULL)
+NEXT_DAY_SQL = f"""
+    SELECT date_trunc('day', MIN(timestamp) AT TIME ZONE 'UTC') AT TIME ZONE 'UTC'
+    FROM "{PARENT_TABLE}"
+    WHERE timestamp >= COALESCE($1::timestamptz, '-infinity')
+"""
+
+# One chunk of raw rows older than $1, oldest first through the timestamp index;
+# the outer time bound lets each partition's primary key serve the join
+DELETE_RAW_SQL = f"""
+    DELETE FROM "{PARENT_TABLE}" t
+    USING (
+        SELECT id, timestamp
+        FROM "{PARENT_TABLE}"
+        WHERE timestamp < $1
+        ORDER BY timestamp
+        LIMIT $2
+    ) d
+    WHERE t.id = d.id AND t.timestamp = d.timestamp AND t.timestamp < $1
+"""
+
+# One chunk of one device's rollups of one resolution older than $3, via the primary key prefix
+DELETE_ROLLUPS_SQL = f"""
+    DELETE FROM "{ROLLUP_TABLE}"
+    WHERE ctid = ANY(ARRAY(
+        SELECT ctid
+        FROM "{ROLLUP_TABLE}"
+        WHERE device_id = $1 AND resolution = $2 AND bucket_start < $3
+        LIMIT $4
+    ))
+"""
+
+# On-disk size (heap, indexes, TOAST) and estimated row count of a table and its partitions
+TABLE_SIZE_SQL = """
+    SELECT COALESCE(SUM(pg_total_relation_size(c.oid)), 0)::bigint AS bytes,
+           COALESCE(SUM(GREATEST(c.reltuples, 0)), 0)::float8 AS rows
+    FROM pg_class c
+    WHERE c.oid = to_regclass($1)
+       OR c.oid IN (SELECT inhrelid FROM pg_inherits WHERE inhparent = to_regclass($1))
+"""
+
+# Worst replay lag over streaming replicas; NULL columns (caught up, or no
+# pg_monitor privilege) count as no lag
+REPLICATION_LAG_SQL = """
+    SELECT COALESCE(MAX(EXTRACT(EPOCH FROM replay_lag)), 0)::float8 FROM pg_stat_replication
+"""
+
+
+def parse_retention(value: str) -> Dict[str, int]:
+    """"resolution=days,..." -> {resolution: days}; resolutions left out (or 0) are kept forever"""
+    retention = {}
+    for entry in value.split(","):
+        if not entry.strip():
+            continue
+        resolution, _, days = entry.partition("=")
+        resolution = resolution.strip()
+        if resolution not in RESOLUTIONS:
+            raise ValueError(f"Unknown rollup resolution {resolution!r} (choose from {', '.join(RESOLUTIONS)})")
+        if int(days) > 0:
+            retention[resolution] = int(days)
+    return retention
+
+
+def day_start(moment: datetime) -> datetime:
+    moment = moment.astimezone(timezone.utc)
+    return moment.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def _deleted(result: str) -> int:
+    """Row count from a "DELETE n" command tag"""
+    return int(result.split()[-1])
+
+
+class Compactor:
+    """Applies the tiered retention policy, one pass per run_once()
+
+    A pass:
+      1. rebuilds the rollups of each raw day older than raw_days, oldest
+         first, advancing the compacted_before marker after each day
+      2. drops monthly partitions that lie entirely before the marker
+      3. deletes the remaining raw rows before the marker in chunks
+      4. deletes rollups past their resolution's retention, device by device
+
+    Only rollup resolutions that are still within their own retention are
+    rebuilt, so a day is never given 1m buckets that step 4 then deletes.
+    With rebuild off (STORAGE_MODE=changes, where the raw rows leave out the
+    suppressed messages the writer counted) step 1 only advances the marker
+    and the day keeps the rollups written at ingest.
+    """
+
+    def __init__(
+        self,
+        raw_days: int = 0,
+        rollup_days: Optional[Dict[str, int]] = None,
+        chunk_rows: int = 5000,
+        chunk_pause: float = 0.5,
+        max_replication_lag: float = 10.0,
+        rebuild: bool = True
+    ):
+        self.raw_days = raw_days
+        self.rollup_days = rollup_days or {}
+        self.chunk_rows = chunk_rows
+        self.chunk_pause = chunk_pause
+        self.max_replication_lag = max_replication_lag
+        self.rebuild = rebuild
+        self._stopping = False
+
+        self.passes = 0
+        self.days_compacted = 0
+        self.rows_deleted: Dict[str, int] = {}
+        self.partitions_dropped = 0
+        self.bytes_dropped = 0
+        self.bytes_freed = 0
+        self.throttled_seconds = 0.0
+        self.compacted_before: Optional[datetime] = None
+        self.backlog_seconds = 0.0
+        self.last_pass_seconds: Optional[float] = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.raw_days > 0 or bool(self.rollup_days)
+
+    def stop(self) -> None:
+        """Finish the current chunk and end the pass early"""
+        self._stopping = True
+
+    def cutoffs(self, now: Optional[datetime] = None) -> Dict[str, datetime]:
+        """Tier -> start of the oldest day it still keeps ("raw" and each expiring resolution)"""
+        today = day_start(now or datetime.now(timezone.utc))
+        cutoffs = {resolution: today - timedelta(days=days) for resolution, days in self.rollup_days.items()}
+        if self.raw_days > 0:
+            cutoffs["raw"] = today - timedelta(days=self.raw_days)
+        return cutoffs
+
+    async def run(self, pool: asyncpg.Pool, interval: float) -> None:
+        """Run a pass every interval seconds until stopped"""
+        while not self._stopping:
+            try:
+                async with pool.acquire() as conn:
+                    await self.run_once(conn)
+            except Exception as e:
+                logger.error(f"Telemetry compaction failed: {e}")
+            slept = 0.0
+            while slept < interval and not self._stopping:
+                await asyncio.sleep(1)
+                slept += 1
+
+    async def run_once(self, conn: asyncpg.Connection, now: Optional[datetime] = None) -> bool:
+        """One compaction pass, returns False if another process holds the lock"""
+        if not self.enabled:
+            return True
+        if not await conn.fetchval("SELECT pg_try_advisory_lock($1)", COMPACTION_LOCK_ID):
+            return False
+
+        started = time.monotonic()
+        try:
+            cutoffs = self.cutoffs(now)
+            raw_cutoff = cutoffs.get("raw")
+            if raw_cutoff is not None:
+                row_bytes = await self._row_bytes(conn, PARENT_TABLE)
+                compacted_before = await self._compact(conn, raw_cutoff, cutoffs)
+                if compacted_before is not None:
+                    await self._drop_partitions(conn, compacted_before)
+                    await self._delete_raw(conn, compacted_before, row_bytes)
+                await self._measure_backlog(conn, raw_cutoff)
+
+            for resolution in RESOLUTIONS:
+                if resolution in cutoffs and not self._stopping:
+                    await self._delete_rollups(conn, resolution, cutoffs[resolution])
+        finally:
+            await conn.execute("SELECT pg_advisory_unlock($1)", COMPACTION_LOCK_ID)
+
+        self.passes += 1
+        self.last_pass_seconds = time.monotonic() - started
+        logger.info(f"Compaction pass finished in {self.last_pass_seconds:.1f}s: {self.stats()}")
+        return True
+
+    async def _compact(
+        self, conn: asyncpg.Connection, raw_cutoff: datetime, cutoffs: Dict[str, datetime]
+    ) -> Optional[datetime]:
+        """Rebuild rollups day by day up to raw_cutoff, returns the new compacted_before"""
+        compacted_before = await conn.fetchval(f'SELECT compacted_before FROM "{STATE_TABLE}"')
+        day = await conn.fetchval(NEXT_DAY_SQL, compacted_before)
+
+        while day is not None and day < raw_cutoff and not self._stopping:
+            end = day + timedelta(days=1)
+            resolutions = [r for r in RESOLUTIONS if r not in cutoffs or end > cutoffs[r]] if self.rebuild else []
+            if resolutions:
+                await rebuild_rollups(conn, int(day.timestamp()), int(end.timestamp()), resolutions)
+            await conn.execute(f"""
+                INSERT INTO "{STATE_TABLE}" (id, compacted_before) VALUES (true, $1)
+                ON CONFLICT (id) DO UPDATE SET compacted_before = EXCLUDED.compacted_before, "updatedAt" = now()
+            """, end)
+            compacted_before = end
+            self.days_compacted += 1
+            logger.info(f"Compacted telemetry for {day:%Y-%m-%d} (rollups: {', '.join(resolutions) or 'none' if self.rebuild else 'kept'})")
+
+            await self._throttle(conn)
+            day = await conn.fetchval(NEXT_DAY_SQL, end)
+
+        self.compacted_before = compacted_before
+        return compacted_before
+
+    async def _drop_partitions(self, conn: asyncpg.Connection, before: datetime) -> None:
+        """Drop whole partitions whose rows are all compacted - no row deletes, no WAL per row"""
+        for name, upper in await list_partitions(conn):
+            if name == DEFAULT_PARTITION or upper is None or upper > before or self._stopping:
+                continue
+
+            size = await conn.fetchval("SELECT pg_total_relation_size(to_regclass($1))", f'"{name}"')
+            try:
+                async with conn.transaction():
+                    # DETACH briefly locks the parent against writes; give up rather than queue behind a long query
+                    await conn.execute(f"SET LOCAL lock_timeout = '{DROP_LOCK_TIMEOUT}'")
+                    await conn.execute(f'ALTER TABLE "{PARENT_TABLE}" DETACH PARTITION "{name}"')
+                    await conn.execute(f'DROP TABLE "{name}"')
+            except asyncpg.LockNotAvailableError:
+                logger.warning(f"Partition {name} is busy, dropping it on the next compaction pass")
+                continue
+
+            self.partitions_dropped += 1
+            self.bytes_dropped += size
+            COMPACTION_BYTES_RECLAIMED.labels("drop").inc(size)
+            logger.info(f"Dropped compacted telemetry partition {name}, reclaimed {size / 1048576:.1f} MiB")
+
+    async def _delete_raw(self, conn: asyncpg.Connection, before: datetime, row_bytes: float) -> None:
+        """Delete compacted raw rows left in partitions that couldn't be dropped whole"""
+        total = 0
+        started = time.monotonic()
+        while not self._stopping:
+            deleted = _deleted(await conn.execute(DELETE_RAW_SQL, before, self.chunk_rows))
+            total += deleted
+            if deleted < self.chunk_rows:
+                break
+            await self._throttle(conn)
+        self._count_deleted("raw", total, row_bytes)
+        if total:
+            logger.info(
+                f"Deleted {total} compacted raw telemetry rows in {time.monotonic() - started:.1f}s "
+                f"(~{total * row_bytes / 1048576:.1f} MiB freed for reuse)"
+            )
+
+    async def _delete_rollups(self, conn: asyncpg.Connection, resolution: str, before: datetime) -> None:
+        """Delete rollups of one resolution older than its retention, one device at a time"""
+        row_bytes = await self._row_bytes(conn, ROLLUP_TABLE)
+        total = 0
+        started = time.monotonic()
+        for device in await conn.fetch('SELECT device_id FROM "Devices" ORDER BY device_id'):
+            while not self._stopping:
+                deleted = _deleted(await conn.execute(
+                    DELETE_ROLLUPS_SQL, device["device_id"], resolution, before, self.chunk_rows
+                ))
+                total += deleted
+                if deleted:
+                    await self._throttle(conn)
+                if deleted < self.chunk_rows:
+                    break
+            if self._stopping:
+                break
+        self._count_deleted(resolution, total, row_bytes)
+        if total:
+            logger.info(
+                f"Deleted {total} expired {resolution} rollups in {time.monotonic() - started:.1f}s "
+                f"(~{total * row_bytes / 1048576:.1f} MiB freed for reuse)"
+            )
+
+    def _count_deleted(self, tier: str, rows: int, row_bytes: float) -> None:
+        if not rows:
+            return
+        self.rows_deleted[tier] = self.rows_deleted.get(tier, 0) + rows
+        self.bytes_freed += int(rows * row_bytes)
+        COMPACTION_ROWS_DELETED.labels(tier).inc(rows)
+        COMPACTION_BYTES_RECLAIMED.labels("delete").inc(int(rows * row_bytes))
+
+    async def _row_bytes(self, conn: asyncpg.Connection, table: str) -> float:
+        """Average on-disk bytes per row, for estimating what deletes free up"""
+        size = await conn.fetchrow(TABLE_SIZE_SQL, f'"{table}"')
+        return size["bytes"] / size["rows"] if size["rows"] else 0.0
+
+    async def _measure_backlog(self, conn: asyncpg.Connection, raw_cutoff: datetime) -> None:
+        oldest = await conn.fetchval(f'SELECT MIN(timestamp) FROM "{PARENT_TABLE}"')
+        self.backlog_seconds = max(0.0, (raw_cutoff - oldest).total_seconds()) if oldest else 0.0
+        COMPACTION_BACKLOG_SECONDS.set(self.backlog_seconds)
+
+    async def _throttle(self, conn: asyncpg.Connection) -> None:
+        """Pause between chunks, and for as long as replicas are further behind than allowed"""
+        await asyncio.sleep(self.chunk_pause)
+        if self.max_replication_lag <= 0:
+            return
+
+        waited = 0.0
+        while not self._stopping:
+            lag = await conn.fetchval(REPLICATION_LAG_SQL)
+            if lag <= self.max_replication_lag:
+                break
+            if not waited:
+                logger.info(f"Compaction paused: replication lag {lag:.1f}s > {self.max_replication_lag}s")
+            await asyncio.sleep(1)
+            waited += 1
+        self.throttled_seconds += waited
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "passes": self.passes,
+            "days_compacted": self.days_compacted,
+            "compacted_before": self.compacted_before.isoformat() if self.compacted_before else None,
+            "backlog_seconds": round(self.backlog_seconds),
+            "rows_deleted": dict(self.rows_deleted),
+            "partitions_dropped": self.partitions_dropped,
+            "bytes_dropped": self.bytes_dropped,
+            "bytes_freed_estimate": self.bytes_freed,
+            "throttled_seconds": self.throttled_seconds,
+        }
+
+
+async def _status(conn: asyncpg.Connection, compactor: Compactor) -> None:
+    compacted_before = await conn.fetchval(f'SELECT compacted_before FROM "{STATE_TABLE}"')
+    oldest = await conn.fetchval(f'SELECT MIN(timestamp) FROM "{PARENT_TABLE}"')
+    print(f"Compacted before: {compacted_before.isoformat() if compacted_before else 'never run'}")
+    print(f"Oldest raw row:   {oldest.isoformat() if oldest else 'none'}")
+    cutoffs = compactor.cutoffs()
+    for tier, cutoff in cutoffs.items():
+        print(f"  {tier:<4} kept from {cutoff:%Y-%m-%d}")
+    if "raw" in cutoffs and oldest and oldest < cutoffs["raw"]:
+        print(f"Backlog: {(cutoffs['raw'] - day_start(oldest)).days} days of raw telemetry to compact")
+    for table in (PARENT_TABLE, ROLLUP_TABLE):
+        size = await conn.fetchrow(TABLE_SIZE_SQL, f'"{table}"')
+        print(f'"{table}": {size["bytes"] / 1048576:.1f} MiB, ~{int(size["rows"])} rows')
+
+
+async def _main(args: argparse.Namespace) -> None:
+    from env import DB_HOST, DB_PORT, DB_NAME, DB_USER, DB_PASSWORD
+
+    compactor = Compactor(
+        raw_days=args.raw_days,
+        rollup_days=parse_retention(args.rollups),
+        chunk_rows=args.chunk_rows,
+        chunk_pause=args.pause,
+        max_replication_lag=args.max_replication_lag,
+        rebuild=not args.keep_rollups
+    )
+    conn = await asyncpg.connect(
+        host=DB_HOST,
+        port=int(DB_PORT),
+        database=DB_NAME,
+        user=DB_USER,
+        password=DB_PASSWORD
+    )
+    try:
+        if args.status:
+            await _status(conn, compactor)
+        elif not await compactor.run_once(conn):
+            print("Another process is compacting, try again later")
+    finally:
+        await conn.close()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--raw-days", type=int, default=0, help="Days of raw telemetry to keep (0: forever)")
+    parser.add_argument("--rollups", default="", help="Rollup retention in days, e.g. 1m=30,1h=730")
+    parser.add_argument("--chunk-rows", type=int, default=5000, help="Rows deleted per statement")
+    parser.add_argument("--pause", type=float, default=0.5, help="Seconds to pause between chunks")
+    parser.add_argument("--max-replication-lag", type=float, default=10.0,
+                        help="Wait while any replica is further behind than this (0: don't check)")
+    parser.add_argument("--keep-rollups", action="store_true",
+                        help="Keep the rollups written at ingest instead of rebuilding them (STORAGE_MODE=changes)")
+    parser.add_argument("--status", action="store_true", help="Show progress and backlog without compacting")
+    asyncio.run(_main(parser.parse_args()))
@@ -1,25 +1,178 @@
 """
 data.py
 
-Data API routes - serves sensor data from database (populated by MQTT subscriber)
+Data API routes - serves sensor data from database (populated by MQTT subscriber and POST /ingest)
 """
 
-from fastapi import APIRouter, HTTPException, Query
-from typing import Dict, Any, Optional, List
+import asyncio
+import base64
+import csv
+import hashlib
+import hmac
+import io
+import json
+import re
+import time
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+from fastapi import APIRouter, Depends, Header, HTTPException, Query, Request
+from fastapi.responses import Response, StreamingResponse
+from typing import Dict, Any, Optional, List, Tuple
 from pydantic import BaseModel
 import asyncpg
+import numpy as np
+from downsample import METHOD_LTTB, SeriesCache, downsample
+from ingest_parser import IngestParser
+from latest_cache import LatestTelemetryCache
+from metrics import POOL_ACQUIRE_SECONDS, ROWS_DUPLICATE, ROWS_STORED, record_pool, timed_query
+from replicas import ReplicaRouter, parse_replicas
+from telemetry_stream import TelemetryHub
+from migrations import check_schema
+from rollups import RESOLUTIONS
+from telemetry_writer import TelemetryRow, check_row, telemetry_row, write_batch
 from env import (
     DB_HOST,
     DB_PORT,
     DB_NAME,
     DB_USER,
-    DB_PASSWORD
+    DB_PASSWORD,
+    DB_READ_REPLICAS,
+    PIANOGUARD_FACTORY_KEY
 )
 
-router = APIRouter(prefix="/api/data", tags=["data"])
+# Reads go to the primary for this request only (read-your-writes), set from X-Read-Consistency
+read_from_primary: ContextVar[bool] = ContextVar("read_from_primary", default=False)
 
-# Global connection pool
+
+async def read_consistency(
+    x_read_consistency: Optional[str] = Header(
+        None, pattern="^(primary|replica)$",
+        description="primary: read from the primary, to see writes a replica may not have replayed yet"
+    )
+):
+    read_from_primary.set(x_read_consistency == "primary")
+
+
+router = APIRouter(prefix="/api/data", tags=["data"], dependencies=[Depends(read_consistency)])
+
+# Upper bound on rows returned by /aggregate
+MAX_AGGREGATE_BUCKETS = 5000
+
+# Read replicas (DB_READ_REPLICAS) - replay lag above which a replica gets no reads,
+# seconds between lag checks, and the connect/check timeout before falling back to the primary
+REPLICA_MAX_LAG = 5.0
+REPLICA_CHECK_INTERVAL = 2.0
+REPLICA_TIMEOUT = 2.0
+
+# Upper bound on points returned by /resample, and how long a stored row is carried
+# forward before the device counts as silent (must exceed the subscriber's CHANGE_MAX_INTERVAL)
+MAX_RESAMPLE_POINTS = 5000
+RESAMPLE_MAX_GAP = 900
+
+# /series - numeric columns it can chart (LEDs as 0/1), points per series, raw rows
+# read per request (longer ranges belong to /aggregate), rows per cursor fetch, and
+# the per-worker cache of downsampled series (entries, seconds a settled range is kept)
+SERIES_METRICS = {
+    "battery_voltage": "battery_voltage",
+    "wifi_rssi": "wifi_rssi",
+    "free_heap": "free_heap",
+    "uptime_ms": "uptime_ms",
+    "led_power": "led_power::int",
+    "led_water": "led_water::int",
+    "led_pads": "led_pads::int",
+}
+MAX_SERIES_POINTS = 5000
+MAX_SERIES_ROWS = 2000000
+SERIES_FETCH_ROWS = 10000
+SERIES_CACHE_MAX_ENTRIES = 1000
+SERIES_CACHE_TTL = 3600
+
+# Devices whose latest telemetry each worker keeps in memory for /latest
+LATEST_CACHE_MAX_DEVICES = 10000
+
+# Devices not heard from for this many seconds are reported offline by /fleet
+FLEET_OFFLINE_AFTER = 300
+
+# Live streams - concurrent clients per worker, devices per client, and seconds
+# between keepalive comments (keeps proxies from timing out idle streams)
+STREAM_MAX_CLIENTS = 1000
+STREAM_MAX_DEVICES = 100
+STREAM_KEEPALIVE = 15
+
+# Export streaming - rows fetched per cursor round-trip, rows per response chunk,
+# and concurrent exports per worker (each one holds a pool connection throughout)
+EXPORT_PREFETCH = 2000
+EXPORT_CHUNK_ROWS = 500
+EXPORT_MAX_CONCURRENT = 2
+
+# Conditional GET (/latest, /history) - responses carry ETag / Last-Modified and may be
+# stored, but clients and proxies have to revalidate them (304 if nothing changed)
+CONDITIONAL_CACHE_CONTROL = "no-cache"
+
+# Bulk ingest (POST /ingest) - largest request body, records and single record accepted,
+# per-record errors listed in the response, and rows per write_batch() transaction
+MAX_INGEST_BYTES = 16 * 1024 * 1024
+MAX_INGEST_RECORDS = 100000
+MAX_INGEST_RECORD_BYTES = 64 * 1024
+MAX_INGEST_ERRORS = 100
+INGEST_BATCH_ROWS = 500
+
+# One telemetry row in the API response format, built by PostgreSQL so responses can be
+# sent as-is instead of constructing and re-validating pydantic models per row
+TELEMETRY_JSON_SQL = """
+    json_build_object(
+        'device_id', t.device_id,
+        'timestamp', CAST(EXTRACT(EPOCH FROM t.timestamp) AS BIGINT),
+        'fw_version', COALESCE(t.fw_version, ''),
+        'wifi_ssid', COALESCE(t.wifi_ssid, ''),
+        'wifi_rssi', COALESCE(t.wifi_rssi, 0),
+        'uptime_ms', COALESCE(t.uptime_ms, 0),
+        'free_heap', COALESCE(t.free_heap, 0),
+        'battery_voltage', COALESCE(t.battery_voltage, 0.0),
+        'status', json_build_object(
+            'power', COALESCE(t.led_power, false),
+            'water', COALESCE(t.led_water, false),
+            'pads', COALESCE(t.led_pads, false)
+        )
+    )
+"""
+
+# Columns /export can return, mapped to their SQL expressions
+EXPORT_COLUMNS = {
+    "device_id": "device_id",
+    "timestamp": "CAST(EXTRACT(EPOCH FROM timestamp) AS BIGINT)",
+    "fw_version": "fw_version",
+    "wifi_ssid": "wifi_ssid",
+    "wifi_rssi": "wifi_rssi",
+    "uptime_ms": "uptime_ms",
+    "free_heap": "free_heap",
+    "battery_voltage": "battery_voltage",
+    "led_power": "led_power",
+    "led_water": "led_water",
+    "led_pads": "led_pads",
+}
+
+# Global connection pool (primary), plus the read replica pools when configured
 db_pool: Optional[asyncpg.Pool] = None
+replicas = ReplicaRouter(max_lag=REPLICA_MAX_LAG, check_interval=REPLICA_CHECK_INTERVAL, check_timeout=REPLICA_TIMEOUT)
+
+# Seconds each request spent waiting for pool connections, reported in Server-Timing by main.py
+request_pool_wait: ContextVar[Optional[List[float]]] = ContextVar("request_pool_wait", default=None)
+
+# Per-worker latest telemetry, kept current over LISTEN/NOTIFY
+latest_cache = LatestTelemetryCache(max_devices=LATEST_CACHE_MAX_DEVICES)
+
+# Fed from the cache's LISTEN connection, no extra database connection per worker
+telemetry_hub = TelemetryHub(max_subscriptions=STREAM_MAX_CLIENTS)
+latest_cache.add_listener(telemetry_hub.publish)
+
+# Downsampled /series results, keyed by (device, metric, range, points, method)
+series_cache = SeriesCache(max_entries=SERIES_CACHE_MAX_ENTRIES, ttl=SERIES_CACHE_TTL)
+
+# Limits long-running exports so they can't take over the pool
+export_slots = asyncio.Semaphore(EXPORT_MAX_CONCURRENT)
 
 
 # Pydantic response models
@@ -43,7 +196,70 @@ class TelemetryResponse(BaseModel):
 
 class HistoryResponse(BaseModel):
     data: List[TelemetryResponse]
-    total_records: int
+    total_records: Optional[int] = None
+    total_is_estimate: bool = False
+    next_cursor: Optional[str] = None
+
+
+class MetricStats(BaseModel):
+    min: Optional[float] = None
+    max: Optional[float] = None
+    avg: Optional[float] = None
+
+
+class LedOnFraction(BaseModel):
+    power: float
+    water: float
+    pads: float
+
+
+class AggregateBucket(BaseModel):
+    timestamp: int
+    count: int
+    battery_voltage: MetricStats
+    wifi_rssi: MetricStats
+    free_heap: MetricStats
+    led_on_fraction: LedOnFraction
+
+
+class AggregateResponse(BaseModel):
+    device_id: str
+    bucket: str
+    data: List[AggregateBucket]
+
+
+class ResampleResponse(BaseModel):
+    device_id: str
+    step: int
+    data: List[TelemetryResponse]
+
+
+class SeriesData(BaseModel):
+    source_points: int
+    data: List[Tuple[int, float]]
+
+
+class SeriesResponse(BaseModel):
+    device_id: str
+    start: int
+    end: int
+    points: int
+    method: str
+    series: Dict[str, SeriesData]
+
+
+class FleetDevice(BaseModel):
+    device_id: str
+    last_seen: Optional[int] = None
+    online: bool
+    latest: Optional[TelemetryResponse] = None
+
+
+class FleetResponse(BaseModel):
+    data: List[FleetDevice]
+    total_devices: int
+    online_devices: int
+    next_cursor: Optional[str] = None
 
 
 class DeviceInfo(BaseModel):
@@ -51,6 +267,19 @@ class DeviceInfo(BaseModel):
     last_seen: Optional[int] = None
 
 
+class IngestError(BaseModel):
+    index: int
+    error: str
+
+
+class IngestResponse(BaseModel):
+    received: int
+    stored: int
+    duplicate: int
+    rejected: int
+    errors: List[IngestError]
+
+
 async def init_db_pool():
     """Initialize asyncpg connection pool"""
     global db_pool
@@ -66,255 +295,865 @@ async def init_db_pool():
         command_timeout=60
     )
 
-    # Create tables if they don't exist
-    await create_tables()
+    # Schema changes are applied at deploy time (migrations.py), workers only verify the version
+    async with db_pool.acquire() as conn:
+        await check_schema(conn)
+
+    await replicas.start(
+        db_pool,
+        parse_replicas(DB_READ_REPLICAS, int(DB_PORT)),
+        database=DB_NAME,
+        user=DB_USER,
+        password=DB_PASSWORD,
+        max_size=10,
+        command_timeout=60
+    )
+
+    # Dedicated LISTEN connection, outside the pool - NOTIFY is only delivered on the primary
+    latest_cache.start(
+        host=DB_HOST,
+        port=int(DB_PORT),
+        database=DB_NAME,
+        user=DB_USER,
+        password=DB_PASSWORD
+    )
 
 
 async def close_db_pool():
     """Close asyncpg connection pool"""
     global db_pool
+    await latest_cache.stop()
+    await replicas.stop()
     if db_pool:
         await db_pool.close()
 
 
-async def create_tables():
-    """Create database tables with proper schema"""
-    if not db_pool:
-        raise RuntimeError("Database pool not initialized")
-
-    async with db_pool.acquire() as conn:
-        # Create Devices table
-        await conn.execute("""
-            CREATE TABLE IF NOT EXISTS "Devices" (
-                device_id VARCHAR(255) PRIMARY KEY,
-                last_seen BIGINT,
-                created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
-                updated_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
-
-        # Create TelemetryData table
-        await conn.execute("""
-            CREATE TABLE IF NOT EXISTS "TelemetryData" (
-                id SERIAL PRIMARY KEY,
-                device_id VARCHAR(255) NOT NULL,
-                timestamp BIGINT NOT NULL,
-                fw_version VARCHAR(50),
-                wifi_ssid VARCHAR(255),
-                wifi_rssi INTEGER,
-                uptime_ms BIGINT,
-                free_heap INTEGER,
-                battery_voltage FLOAT,
-                led_power BOOLEAN,
-                led_water BOOLEAN,
-                led_pads BOOLEAN,
-                created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (device_id) REFERENCES "Devices" (device_id) ON DELETE CASCADE
-            )
-        """)
-
-        # Create indexes
-        await conn.execute("""
-            CREATE INDEX IF NOT EXISTS idx_telemetry_timestamp
-            ON "TelemetryData" (timestamp DESC)
-        """)
+@asynccontextmanager
+async def acquire(read_only: bool = False):
+    """Pool connection that records how long the current request waited for it
 
-        await conn.execute("""
-            CREATE INDEX IF NOT EXISTS idx_telemetry_device_id
-            ON "TelemetryData" (device_id)
-        """)
+    read_only connections come from a read replica when one is healthy and
+    within REPLICA_MAX_LAG, unless the request asked to read from the primary.
+    A replica that can't hand out a connection is taken out of rotation and
+    the primary serves the request instead.
+    """
+    started = time.perf_counter()
+    pool, name, conn = db_pool, "primary", None
+    replica = replicas.choose() if read_only and not read_from_primary.get() else None
+    if replica:
+        try:
+            conn = await replica.pool.acquire(timeout=REPLICA_TIMEOUT)
+            pool, name = replica.pool, replica.name
+        except (OSError, asyncio.TimeoutError, asyncpg.PostgresError, asyncpg.InterfaceError) as e:
+            replicas.mark_failed(replica, e)
+    if conn is None:
+        conn = await db_pool.acquire()
 
-        await conn.execute("""
-            CREATE INDEX IF NOT EXISTS idx_telemetry_device_timestamp
-            ON "TelemetryData" (device_id, timestamp DESC)
-        """)
+    try:
+        waited = time.perf_counter() - started
+        POOL_ACQUIRE_SECONDS.labels(name).observe(waited)
+        record_pool(pool, name)
+        waits = request_pool_wait.get()
+        if waits is not None:
+            waits.append(waited)
+        yield conn
+    finally:
+        await pool.release(conn)
+        record_pool(pool, name)
 
 
 @router.get("/latest", response_model=TelemetryResponse)
-async def get_latest_data(device_id: Optional[str] = Query(None, description="Filter by device ID")):
-    """Get latest sensor data, optionally filtered by device_id"""
+async def get_latest_data(
+    request: Request,
+    device_id: Optional[str] = Query(None, description="Filter by device ID")
+):
+    """Get latest sensor data, optionally filtered by device_id
+
+    The ETag digests the record and Last-Modified is its timestamp, so a
+    client polling an unchanged device gets a 304 from any worker.
+    """
     if not db_pool:
         raise HTTPException(status_code=500, detail="Database pool not initialized")
 
-    async with db_pool.acquire() as conn:
+    # Steady state: answer from the in-memory cache without touching the pool
+    if latest_cache.ready:
         if device_id:
-            row = await conn.fetchrow("""
-                SELECT device_id,
-                       CAST(EXTRACT(EPOCH FROM timestamp) AS BIGINT) as timestamp,
-                       fw_version, wifi_ssid, wifi_rssi,
-                       uptime_ms, free_heap, battery_voltage,
-                       led_power, led_water, led_pads
-                FROM "TelemetryData"
-                WHERE device_id = $1
-                ORDER BY timestamp DESC
-                LIMIT 1
-            """, device_id)
+            record = latest_cache.get(device_id)
         else:
-            row = await conn.fetchrow("""
-                SELECT device_id,
-                       CAST(EXTRACT(EPOCH FROM timestamp) AS BIGINT) as timestamp,
-                       fw_version, wifi_ssid, wifi_rssi,
-                       uptime_ms, free_heap, battery_voltage,
-                       led_power, led_water, led_pads
-                FROM "TelemetryData"
-                ORDER BY timestamp DESC
-                LIMIT 1
-            """)
+            # The newest record overall is only known when the cache holds every device
+            record = latest_cache.newest() if latest_cache.complete else None
+        if record:
+            return latest_response(request, record)
+        if latest_cache.complete:
+            raise HTTPException(status_code=404, detail="No telemetry data found")
+
+    async with acquire(read_only=True) as conn:
+        # "LatestTelemetry" rather than the raw rows, which leave out messages
+        # suppressed by STORAGE_MODE=changes, so the fallback agrees with the cache
+        if device_id:
+            with timed_query("latest_device"):
+                body = await conn.fetchval(f"""
+                    SELECT {TELEMETRY_JSON_SQL}::text
+                    FROM "LatestTelemetry" t
+                    WHERE t.device_id = $1
+                """, device_id)
+        else:
+            with timed_query("latest_any"):
+                body = await conn.fetchval(f"""
+                    SELECT {TELEMETRY_JSON_SQL}::text
+                    FROM "LatestTelemetry" t
+                    ORDER BY t.timestamp DESC
+                    LIMIT 1
+                """)
 
-        if not row:
+        if not body:
             raise HTTPException(status_code=404, detail="No telemetry data found")
 
-        return TelemetryResponse(
-            device_id=row["device_id"],
-            timestamp=row["timestamp"],
-            fw_version=row["fw_version"] or "",
-            wifi_ssid=row["wifi_ssid"] or "",
-            wifi_rssi=row["wifi_rssi"] or 0,
-            uptime_ms=row["uptime_ms"] or 0,
-            free_heap=row["free_heap"] or 0,
-            battery_voltage=row["battery_voltage"] or 0.0,
-            status=StatusDict(
-                power=row["led_power"] or False,
-                water=row["led_water"] or False,
-                pads=row["led_pads"] or False
-            )
-        )
+        record = json.loads(body)
+        if device_id and latest_cache.ready:
+            latest_cache.update(record)
+
+        return latest_response(request, record, body)
+
+
+def json_response(body: str, headers: Optional[Dict[str, str]] = None) -> Response:
+    """Send an already-encoded JSON body, bypassing response_model validation"""
+    return Response(content=body.encode(), media_type="application/json", headers=headers)
+
+
+def entity_tag(*parts: Any, weak: bool = False) -> str:
+    """Quoted ETag digesting parts - weak when equal tags only promise equivalent content"""
+    digest = hashlib.blake2b("\x1f".join(str(part) for part in parts).encode(), digest_size=12).hexdigest()
+    return f'W/"{digest}"' if weak else f'"{digest}"'
+
+
+def validator_headers(etag: str, last_modified: Optional[datetime]) -> Dict[str, str]:
+    headers = {"ETag": etag, "Cache-Control": CONDITIONAL_CACHE_CONTROL}
+    if last_modified is not None:
+        headers["Last-Modified"] = format_datetime(last_modified.astimezone(timezone.utc), usegmt=True)
+    return headers
+
+
+def not_modified(
+    request: Request,
+    etag: str,
+    last_modified: Optional[datetime],
+    modified_since: bool = True
+) -> bool:
+    """Whether the client's copy is current (RFC 9110 13.2.2)
+
+    If-None-Match is compared weakly and, when present, decides alone.
+    If-Modified-Since is only used without it and only when modified_since
+    is set. Its one second resolution cannot tell a copy from a change later
+    in the same second, so it never matches while that second is current.
+    """
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        if if_none_match.strip() == "*":
+            return True
+        tags = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+        return etag.removeprefix("W/") in tags
+
+    if_modified_since = request.headers.get("if-modified-since")
+    if not modified_since or not if_modified_since or last_modified is None:
+        return False
+    try:
+        since = parsedate_to_datetime(if_modified_since)
+    except (TypeError, ValueError):
+        return False
+    if since.tzinfo is None:
+        return False
+    second = int(last_modified.timestamp())
+    if second >= int(datetime.now(timezone.utc).timestamp()):
+        return False
+    return second <= since.timestamp()
+
+
+def latest_response(request: Request, record: Dict[str, Any], body: Optional[str] = None) -> Response:
+    """/latest record with its validators, or a 304 - body is the record as encoded by PostgreSQL, if it was"""
+    # Digest of the record in one encoding, whether it came from the cache or the database
+    encoded = json.dumps(record, separators=(",", ":"))
+    etag = entity_tag(encoded)
+    # A device clock running ahead must not produce a Last-Modified in the future
+    last_modified = min(datetime.fromtimestamp(record["timestamp"], timezone.utc), datetime.now(timezone.utc))
+    headers = validator_headers(etag, last_modified)
+    if not_modified(request, etag, last_modified):
+        return Response(status_code=304, headers=headers)
+    return json_response(body or encoded, headers)
+
+
+def encode_cursor(timestamp: datetime, row_id: int) -> str:
+    """Opaque keyset cursor for the (timestamp, id) of the last row on a page"""
+    raw = json.dumps({"t": timestamp.isoformat(), "i": row_id}, separators=(",", ":"))
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> Tuple[datetime, int]:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        data = json.loads(raw)
+        return datetime.fromisoformat(data["t"]), int(data["i"])
+    except (ValueError, KeyError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+def telemetry_filters(
+    device_id: Optional[str],
+    start: Optional[int],
+    end: Optional[int]
+) -> Tuple[List[str], List[Any]]:
+    """WHERE clauses and positional args for the common telemetry filters"""
+    clauses: List[str] = []
+    args: List[Any] = []
+    if device_id:
+        args.append(device_id)
+        clauses.append(f"device_id = ${len(args)}")
+    if start is not None:
+        args.append(start)
+        clauses.append(f"timestamp >= to_timestamp(${len(args)})")
+    if end is not None:
+        args.append(end)
+        clauses.append(f"timestamp < to_timestamp(${len(args)})")
+    return clauses, args
+
+
+async def count_telemetry(conn: asyncpg.Connection, mode: str, clauses: List[str], args: List[Any]) -> Optional[int]:
+    """Row count for the filters - exact, planner estimate, or skipped"""
+    where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+
+    if mode == "exact":
+        return await conn.fetchval(f'SELECT COUNT(*) FROM "TelemetryData" {where}', *args)
+
+    if mode == "estimate":
+        if not clauses:
+            # Sum of per-partition statistics, no scan at all
+            return await conn.fetchval("""
+                SELECT COALESCE(SUM(GREATEST(c.reltuples, 0)), 0)::bigint
+                FROM pg_class c
+                WHERE c.oid = '"TelemetryData"'::regclass
+                   OR c.oid IN (
+                       SELECT inhrelid FROM pg_inherits
+                       WHERE inhparent = '"TelemetryData"'::regclass
+                   )
+            """)
+        plan = await conn.fetchval(f'EXPLAIN (FORMAT JSON) SELECT 1 FROM "TelemetryData" {where}', *args)
+        return int(json.loads(plan)[0]["Plan"]["Plan Rows"])
+
+    return None
 
 
 @router.get("/history", response_model=HistoryResponse)
 async def get_data_history(
+    request: Request,
     device_id: Optional[str] = Query(None, description="Filter by device ID"),
-    limit: int = Query(100, ge=1, le=1000, description="Maximum number of records to return")
+    limit: int = Query(100, ge=1, le=1000, description="Maximum number of records to return"),
+    cursor: Optional[str] = Query(None, description="next_cursor from the previous page"),
+    start: Optional[int] = Query(None, description="Range start, Unix epoch seconds (inclusive)"),
+    end: Optional[int] = Query(None, description="Range end, Unix epoch seconds (exclusive)"),
+    total: str = Query("estimate", pattern="^(exact|estimate|none)$", description="total_records mode: exact, estimate or none")
 ):
-    """Get historical sensor data, optionally filtered by device_id"""
+    """Get historical sensor data, newest first, paged with an opaque keyset cursor
+
+    Validators come from "Devices"."updatedAt" (the newest one without a
+    device_id), which every batch writing a device's rows moves forward, late
+    and backfilled rows included, and from the retention compactor's marker.
+    They are read before the page, so a write in between can only cost a
+    304, never make a stale page look current. If the client's copy is
+    current, the count and page queries are skipped.
+
+    Only If-None-Match can produce a 304 here: "updatedAt" is the writing
+    transaction's start time, so a batch committing later can leave it in a
+    second already sent as Last-Modified, or even move it backwards.
+    Deletes (partition expiry, compaction chunks, dedupe.py) bump neither
+    validator, so a page that still lists deleted rows stays current until
+    the device writes again or the compaction marker advances.
+    """
     if not db_pool:
         raise HTTPException(status_code=500, detail="Database pool not initialized")
 
-    async with db_pool.acquire() as conn:
-        # Get total count
+    clauses, args = telemetry_filters(device_id, start, end)
+    page_clauses, page_args = list(clauses), list(args)
+    if cursor:
+        cursor_timestamp, cursor_id = decode_cursor(cursor)
+        page_args.extend([cursor_timestamp, cursor_id])
+        ts_arg, id_arg = len(page_args) - 1, len(page_args)
+        # Split so timestamp <= stays usable as an index condition
+        page_clauses.append(f"timestamp <= ${ts_arg} AND (timestamp < ${ts_arg} OR id < ${id_arg})")
+    page_args.append(limit)
+    where = f"WHERE {' AND '.join(page_clauses)}" if page_clauses else ""
+
+    async with acquire(read_only=True) as conn:
         if device_id:
-            total_count = await conn.fetchval(
-                'SELECT COUNT(*) FROM "TelemetryData" WHERE device_id = $1',
-                device_id
-            )
+            modified_sql, modified_args = 'SELECT "updatedAt" FROM "Devices" WHERE device_id = $1', [device_id]
         else:
-            total_count = await conn.fetchval('SELECT COUNT(*) FROM "TelemetryData"')
+            modified_sql, modified_args = 'SELECT MAX("updatedAt") FROM "Devices"', []
+        with timed_query("history_validators"):
+            validators = await conn.fetchrow(f"""
+                SELECT ({modified_sql}) AS modified,
+                       (SELECT "updatedAt" FROM "TelemetryCompaction") AS compacted
+            """, *modified_args)
+        # Weak: an estimated total_records can drift while the rows stay the same
+        etag = entity_tag(validators["modified"], validators["compacted"], weak=True)
+        last_modified = max(filter(None, validators.values()), default=None)
+        headers = validator_headers(etag, last_modified)
+        if not_modified(request, etag, last_modified, modified_since=False):
+            return Response(status_code=304, headers=headers)
 
-        # Get limited historical data ordered by timestamp descending
-        if device_id:
+        with timed_query(f"history_count_{total}"):
+            total_count = await count_telemetry(conn, total, clauses, args)
+
+        # Get one page of historical data ordered by timestamp descending,
+        # encoded to JSON by PostgreSQL along with the keyset of its last row
+        with timed_query("history_page"):
+            page = await conn.fetchrow(f"""
+                WITH page AS (
+                    SELECT *
+                    FROM "TelemetryData"
+                    {where}
+                    ORDER BY timestamp DESC, id DESC
+                    LIMIT ${len(page_args)}
+                )
+                SELECT COALESCE(json_agg({TELEMETRY_JSON_SQL} ORDER BY t.timestamp DESC, t.id DESC), '[]')::text AS body,
+                       COUNT(*) AS row_count,
+                       (array_agg(t.timestamp ORDER BY t.timestamp, t.id))[1] AS last_timestamp,
+                       (array_agg(t.id ORDER BY t.timestamp, t.id))[1] AS last_id
+                FROM page t
+            """, *page_args)
+
+        next_cursor = None
+        if page["row_count"] == limit:
+            next_cursor = encode_cursor(page["last_timestamp"], page["last_id"])
+
+        envelope = json.dumps({
+            "total_records": total_count,
+            "total_is_estimate": total == "estimate",
+            "next_cursor": next_cursor
+        }, separators=(",", ":"))
+        return json_response('{"data":' + page["body"] + "," + envelope[1:], headers)
+
+
+@router.get("/aggregate", response_model=AggregateResponse)
+async def get_data_aggregate(
+    device_id: str = Query(..., description="Device ID"),
+    start: int = Query(..., description="Range start, Unix epoch seconds (inclusive)"),
+    end: int = Query(..., description="Range end, Unix epoch seconds (exclusive)"),
+    bucket: str = Query("1h", pattern="^(1m|1h|1d)$", description="Bucket width: 1m, 1h or 1d")
+):
+    """Get pre-aggregated telemetry for a device over a time range"""
+    if not db_pool:
+        raise HTTPException(status_code=500, detail="Database pool not initialized")
+
+    if end <= start:
+        raise HTTPException(status_code=400, detail="end must be after start")
+
+    buckets = (end - start) // RESOLUTIONS[bucket]
+    if buckets > MAX_AGGREGATE_BUCKETS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Range spans {buckets} {bucket} buckets, maximum is {MAX_AGGREGATE_BUCKETS} - use a wider bucket"
+        )
+
+    async with acquire(read_only=True) as conn:
+        with timed_query("aggregate"):
             rows = await conn.fetch("""
-                SELECT device_id,
-                       CAST(EXTRACT(EPOCH FROM timestamp) AS BIGINT) as timestamp,
-                       fw_version, wifi_ssid, wifi_rssi,
-                       uptime_ms, free_heap, battery_voltage,
-                       led_power, led_water, led_pads
-                FROM "TelemetryData"
+                SELECT CAST(EXTRACT(EPOCH FROM bucket_start) AS BIGINT) as timestamp,
+                       sample_count,
+                       battery_min, battery_max, battery_sum / NULLIF(battery_count, 0) AS battery_avg,
+                       rssi_min, rssi_max, rssi_sum::float8 / NULLIF(rssi_count, 0) AS rssi_avg,
+                       heap_min, heap_max, heap_sum::float8 / NULLIF(heap_count, 0) AS heap_avg,
+                       power_on::float8 / sample_count AS power_fraction,
+                       water_on::float8 / sample_count AS water_fraction,
+                       pads_on::float8 / sample_count AS pads_fraction
+                FROM "TelemetryRollups"
                 WHERE device_id = $1
-                ORDER BY timestamp DESC
-                LIMIT $2
-            """, device_id, limit)
-        else:
-            rows = await conn.fetch("""
-                SELECT device_id,
-                       CAST(EXTRACT(EPOCH FROM timestamp) AS BIGINT) as timestamp,
-                       fw_version, wifi_ssid, wifi_rssi,
-                       uptime_ms, free_heap, battery_voltage,
-                       led_power, led_water, led_pads
-                FROM "TelemetryData"
-                ORDER BY timestamp DESC
-                LIMIT $1
-            """, limit)
-
-        telemetry_data = [
-            TelemetryResponse(
-                device_id=row["device_id"],
-                timestamp=row["timestamp"],
-                fw_version=row["fw_version"] or "",
-                wifi_ssid=row["wifi_ssid"] or "",
-                wifi_rssi=row["wifi_rssi"] or 0,
-                uptime_ms=row["uptime_ms"] or 0,
-                free_heap=row["free_heap"] or 0,
-                battery_voltage=row["battery_voltage"] or 0.0,
-                status=StatusDict(
-                    power=row["led_power"] or False,
-                    water=row["led_water"] or False,
-                    pads=row["led_pads"] or False
-                )
+                  AND resolution = $2
+                  AND bucket_start >= to_timestamp($3)
+                  AND bucket_start < to_timestamp($4)
+                ORDER BY bucket_start
+            """, device_id, bucket, start, end)
+
+            return AggregateResponse(
+                device_id=device_id,
+                bucket=bucket,
+                data=[
+                    AggregateBucket(
+                        timestamp=row["timestamp"],
+                        count=row["sample_count"],
+                        battery_voltage=MetricStats(
+                            min=row["battery_min"],
+                            max=row["battery_max"],
+                            avg=row["battery_avg"]
+                        ),
+                        wifi_rssi=MetricStats(
+                            min=row["rssi_min"],
+                            max=row["rssi_max"],
+                            avg=row["rssi_avg"]
+                        ),
+                        free_heap=MetricStats(
+                            min=row["heap_min"],
+                            max=row["heap_max"],
+                            avg=row["heap_avg"]
+                        ),
+                        led_on_fraction=LedOnFraction(
+                            power=row["power_fraction"],
+                            water=row["water_fraction"],
+                            pads=row["pads_fraction"]
+                        )
+                    )
+                    for row in rows
+                ]
             )
-            for row in rows
-        ]
 
-        return HistoryResponse(data=telemetry_data, total_records=total_count)
 
+@router.get("/resample", response_model=ResampleResponse)
+async def get_data_resample(
+    device_id: str = Query(..., description="Device ID"),
+    start: int = Query(..., description="Range start, Unix epoch seconds (inclusive)"),
+    end: int = Query(..., description="Range end, Unix epoch seconds (exclusive)"),
+    step: int = Query(60, ge=1, le=86400, description="Seconds between points"),
+    max_gap: int = Query(RESAMPLE_MAX_GAP, ge=1, le=86400, description="Seconds a stored row is carried forward")
+):
+    """Telemetry at regular points, each the state in effect at that moment
+
+    Rows stored by change-aware ingest (STORAGE_MODE=changes) are the steps of
+    a step function: each holds until the next one. Every point gets the newest
+    row at or before it, with uptime_ms advanced to the point, and points with
+    no row in the preceding max_gap seconds (device silent) are left out.
+    Works the same on fully stored data.
+    """
+    if not db_pool:
+        raise HTTPException(status_code=500, detail="Database pool not initialized")
+
+    if end <= start:
+        raise HTTPException(status_code=400, detail="end must be after start")
 
-# Note: This function is deprecated - use MQTT subscriber for data ingestion
+    points = -(-(end - start) // step)
+    if points > MAX_RESAMPLE_POINTS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Range spans {points} points, maximum is {MAX_RESAMPLE_POINTS} - use a larger step"
+        )
 
+    # One index probe per point; the partition is pruned per probe at run time
+    async with acquire(read_only=True) as conn:
+        with timed_query("resample"):
+            body = await conn.fetchval(f"""
+                SELECT COALESCE(json_agg({TELEMETRY_JSON_SQL} ORDER BY t.timestamp), '[]')::text
+                FROM (
+                    SELECT s.device_id, p.point AS timestamp, s.fw_version, s.wifi_ssid, s.wifi_rssi,
+                           s.uptime_ms + CAST(EXTRACT(EPOCH FROM p.point - s.timestamp) * 1000 AS BIGINT) AS uptime_ms,
+                           s.free_heap, s.battery_voltage, s.led_power, s.led_water, s.led_pads
+                    FROM generate_series(to_timestamp($2), to_timestamp($3), make_interval(secs => $4)) AS p(point)
+                    CROSS JOIN LATERAL (
+                        SELECT *
+                        FROM "TelemetryData"
+                        WHERE device_id = $1
+                          AND timestamp <= p.point
+                          AND timestamp > p.point - make_interval(secs => $5)
+                        ORDER BY timestamp DESC
+                        LIMIT 1
+                    ) s
+                    WHERE p.point < to_timestamp($3)
+                ) t
+            """, device_id, start, end, step, max_gap)
 
-@router.get("/devices", response_model=List[DeviceInfo])
-async def get_devices():
-    """Get list of all registered devices"""
+    return json_response(
+        '{"device_id":' + json.dumps(device_id) + ',"step":' + str(step) + ',"data":' + body + "}"
+    )
+
+
+async def fetch_series_columns(
+    conn: asyncpg.Connection, device_id: str, start: int, end: int, metrics: List[str]
+) -> np.ndarray:
+    """(rows, 1 + len(metrics)) float array of epoch timestamps and metric values, oldest first
+
+    Read through a server-side cursor SERIES_FETCH_ROWS at a time, each fetch
+    converted to an array as it arrives; NULLs become NaN.
+    """
+    clauses, args = telemetry_filters(device_id, start, end)
+    query = f"""
+        SELECT EXTRACT(EPOCH FROM timestamp)::float8,
+               {", ".join(f"{SERIES_METRICS[m]}::float8" for m in metrics)}
+        FROM "TelemetryData"
+        WHERE {" AND ".join(clauses)}
+        ORDER BY timestamp
+    """
+    chunks: List[np.ndarray] = []
+    rows = 0
+    async with conn.transaction(readonly=True):
+        cursor = await conn.cursor(query, *args)
+        while True:
+            records = await cursor.fetch(SERIES_FETCH_ROWS)
+            if not records:
+                break
+            rows += len(records)
+            if rows > MAX_SERIES_ROWS:
+                raise HTTPException(
+                    status_code=400,
+                    detail=f"Range holds more than {MAX_SERIES_ROWS} rows - use /api/data/aggregate"
+                )
+            chunks.append(np.array([tuple(r) for r in records], dtype=np.float64))
+    if not chunks:
+        return np.empty((0, 1 + len(metrics)))
+    return np.concatenate(chunks)
+
+
+@router.get("/series", response_model=SeriesResponse)
+async def get_data_series(
+    device_id: str = Query(..., description="Device ID"),
+    metric: List[str] = Query(..., description="Metric(s) to chart, repeated or comma-separated"),
+    start: int = Query(..., description="Range start, Unix epoch seconds (inclusive)"),
+    end: int = Query(..., description="Range end, Unix epoch seconds (exclusive)"),
+    points: int = Query(500, ge=3, le=MAX_SERIES_POINTS, description="Target points per series"),
+    method: str = Query(METHOD_LTTB, pattern="^(lttb|minmax)$", description="lttb (shape) or minmax (extremes per bucket)")
+):
+    """Chart-ready downsample of raw telemetry, one [timestamp, value] series per metric
+
+    lttb keeps the points that preserve the series' visual shape; minmax
+    keeps each time bucket's lowest and highest point (up to points per
+    series either way). Series with no more rows than points come back
+    whole. Results are cached per worker, so repeated ranges are served
+    from memory; ranges ending within the last few minutes are recomputed
+    every few seconds.
+    """
     if not db_pool:
         raise HTTPException(status_code=500, detail="Database pool not initialized")
 
-    async with db_pool.acquire() as conn:
-        rows = await conn.fetch("""
-            SELECT device_id,
-                   CASE
-                       WHEN last_seen IS NULL THEN NULL
-                       ELSE CAST(EXTRACT(EPOCH FROM last_seen) AS BIGINT)
-                   END as last_seen
-            FROM "Devices"
-            ORDER BY last_seen DESC NULLS LAST
-        """)
-
-        return [
-            DeviceInfo(
-                device_id=row["device_id"],
-                last_seen=row["last_seen"]
+    if end <= start:
+        raise HTTPException(status_code=400, detail="end must be after start")
+
+    metrics = list(dict.fromkeys(m.strip() for value in metric for m in value.split(",") if m.strip()))
+    unknown = [m for m in metrics if m not in SERIES_METRICS]
+    if unknown or not metrics:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Unknown metrics: {', '.join(unknown)}" if unknown else "No metric given"
+        )
+
+    encoded = {m: series_cache.get((device_id, m, start, end, points, method)) for m in metrics}
+    missing = [m for m in metrics if encoded[m] is None]
+    if missing:
+        async with acquire(read_only=True) as conn:
+            with timed_query("series"):
+                columns = await fetch_series_columns(conn, device_id, start, end, missing)
+
+        timestamps = columns[:, 0]
+        for index, name in enumerate(missing, start=1):
+            x, y = downsample(timestamps, columns[:, index], points, method)
+            values = y.tolist() if name == "battery_voltage" else y.astype(np.int64).tolist()
+            encoded[name] = (
+                '{"source_points":' + str(int((~np.isnan(columns[:, index])).sum()))
+                + ',"data":' + json.dumps(list(zip(x.astype(np.int64).tolist(), values)), separators=(",", ":"))
+                + "}"
             )
-            for row in rows
-        ]
+            series_cache.put((device_id, name, start, end, points, method), encoded[name], end)
+
+    envelope = json.dumps({
+        "device_id": device_id,
+        "start": start,
+        "end": end,
+        "points": points,
+        "method": method
+    }, separators=(",", ":"))
+    series = ",".join(json.dumps(m) + ":" + encoded[m] for m in metrics)
+    return json_response(envelope[:-1] + ',"series":{' + series + "}}")
 
 
-# Internal function for MQTT subscriber to store data
-async def store_sensor_data(data: Dict[str, Any]) -> None:
-    """Store sensor data from MQTT (internal use only)"""
+def _ndjson_chunk(columns: List[str], records: List[asyncpg.Record]) -> str:
+    return "".join(
+        json.dumps(dict(zip(columns, record.values())), separators=(",", ":")) + "\n"
+        for record in records
+    )
+
+
+def _csv_chunk(records: List[Any]) -> str:
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(records)
+    return buffer.getvalue()
+
+
+@router.get("/export")
+async def export_data(
+    device_id: str = Query(..., description="Device ID"),
+    start: Optional[int] = Query(None, description="Range start, Unix epoch seconds (inclusive)"),
+    end: Optional[int] = Query(None, description="Range end, Unix epoch seconds (exclusive)"),
+    format: str = Query("ndjson", pattern="^(ndjson|csv)$", description="Output format: ndjson or csv"),
+    columns: Optional[str] = Query(None, description="Comma-separated columns to include (default: all)")
+):
+    """Stream raw telemetry for a device, oldest first, from a server-side cursor
+
+    Memory use is bounded by EXPORT_PREFETCH rows no matter how large the export is.
+    """
     if not db_pool:
-        raise RuntimeError("Database pool not initialized")
+        raise HTTPException(status_code=500, detail="Database pool not initialized")
 
-    async with db_pool.acquire() as conn:
-        # Upsert device info
-        await conn.execute("""
-            INSERT INTO "Devices" (device_id, last_seen, "createdAt", "updatedAt")
-            VALUES ($1, to_timestamp($2), CURRENT_TIMESTAMP, CURRENT_TIMESTAMP)
-            ON CONFLICT (device_id)
-            DO UPDATE SET
-                last_seen = EXCLUDED.last_seen,
-                "updatedAt" = CURRENT_TIMESTAMP
-        """,
-            data.get("device_id"),
-            data.get("timestamp")
+    selected = [c.strip() for c in columns.split(",") if c.strip()] if columns else list(EXPORT_COLUMNS)
+    unknown = [c for c in selected if c not in EXPORT_COLUMNS]
+    if unknown or not selected:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Unknown columns: {', '.join(unknown)}" if unknown else "No columns selected"
         )
 
-        # Insert telemetry data
-        await conn.execute("""
-            INSERT INTO "TelemetryData" (
-                device_id, timestamp, fw_version, wifi_ssid, wifi_rssi,
-                uptime_ms, free_heap, battery_voltage,
-                led_power, led_water, led_pads,
-                "createdAt", "updatedAt"
-            )
-            VALUES ($1, to_timestamp($2), $3, $4, $5, $6, $7, $8, $9, $10, $11, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP)
-        """,
-            data.get("device_id"),
-            data.get("timestamp"),
-            data.get("fw_version"),
-            data.get("wifi_ssid"),
-            data.get("wifi_rssi"),
-            data.get("uptime_ms"),
-            data.get("free_heap"),
-            data.get("battery_voltage"),
-            data.get("status", {}).get("power") if isinstance(data.get("status"), dict) else data.get("led_power"),
-            data.get("status", {}).get("water") if isinstance(data.get("status"), dict) else data.get("led_water"),
-            data.get("status", {}).get("pads") if isinstance(data.get("status"), dict) else data.get("led_pads")
+    if export_slots.locked():
+        raise HTTPException(status_code=429, detail="Too many concurrent exports, try again later")
+
+    clauses, args = telemetry_filters(device_id, start, end)
+    query = f"""
+        SELECT {", ".join(f"{EXPORT_COLUMNS[c]} AS {c}" for c in selected)}
+        FROM "TelemetryData"
+        WHERE {" AND ".join(clauses)}
+        ORDER BY "TelemetryData".timestamp, id
+    """
+
+    async def stream():
+        async with export_slots:
+            if format == "csv":
+                yield _csv_chunk([selected])
+
+            async with acquire(read_only=True) as conn:
+                # Server-side cursors only live inside a transaction
+                async with conn.transaction(readonly=True):
+                    chunk: List[asyncpg.Record] = []
+                    async for record in conn.cursor(query, *args, prefetch=EXPORT_PREFETCH):
+                        chunk.append(record)
+                        if len(chunk) >= EXPORT_CHUNK_ROWS:
+                            yield _csv_chunk(chunk) if format == "csv" else _ndjson_chunk(selected, chunk)
+                            chunk = []
+                    if chunk:
+                        yield _csv_chunk(chunk) if format == "csv" else _ndjson_chunk(selected, chunk)
+
+    extension = "csv" if format == "csv" else "ndjson"
+    filename = re.sub(r"[^A-Za-z0-9_.-]", "_", device_id)
+    return StreamingResponse(
+        stream(),
+        media_type="text/csv" if format == "csv" else "application/x-ndjson",
+        headers={"Content-Disposition": f'attachment; filename="{filename}-telemetry.{extension}"'}
+    )
+
+
+@router.get("/stream")
+async def stream_telemetry(
+    device_id: List[str] = Query(..., description="Device ID(s) to follow, repeated or comma-separated")
+):
+    """Server-Sent Events stream of new telemetry records as they are committed
+
+    Starts with each device's current record (when the cache has it), then
+    sends every new one. A client that can't keep up gets only the newest
+    pending record per device.
+    """
+    device_ids = {d.strip() for value in device_id for d in value.split(",") if d.strip()}
+    if not device_ids:
+        raise HTTPException(status_code=400, detail="No device_id given")
+    if len(device_ids) > STREAM_MAX_DEVICES:
+        raise HTTPException(status_code=400, detail=f"At most {STREAM_MAX_DEVICES} devices per stream")
+    if telemetry_hub.full:
+        raise HTTPException(status_code=503, detail="Too many live streams, try again later")
+
+    async def events():
+        # Subscribe inside the generator so the finally below always runs for it
+        subscription = telemetry_hub.subscribe(device_ids)
+        try:
+            if latest_cache.ready:
+                for current in sorted(device_ids):
+                    record = latest_cache.get(current)
+                    if record:
+                        subscription.offer(current, json.dumps(record, separators=(",", ":")))
+
+            yield "retry: 5000\n\n"
+            while True:
+                encoded = await subscription.next(STREAM_KEEPALIVE)
+                if encoded is None:
+                    yield ": keepalive\n\n"
+                else:
+                    yield f"event: telemetry\ndata: {encoded}\n\n"
+        finally:
+            telemetry_hub.unsubscribe(subscription)
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        # X-Accel-Buffering stops nginx from holding events back in its proxy buffer
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
+@router.get("/fleet", response_model=FleetResponse)
+async def get_fleet(
+    device_id: Optional[List[str]] = Query(None, description="Only these devices, repeated or comma-separated"),
+    status: str = Query("all", pattern="^(all|online|offline)$", description="Filter by status: all, online or offline"),
+    limit: int = Query(100, ge=1, le=1000, description="Maximum number of devices to return"),
+    cursor: Optional[str] = Query(None, description="next_cursor from the previous page"),
+    offline_after: int = Query(FLEET_OFFLINE_AFTER, ge=1, le=86400, description="Seconds without telemetry before a device is offline")
+):
+    """Latest telemetry and online status for a page of devices, ordered by device_id
+
+    One query joining "Devices" to "LatestTelemetry" (maintained by the ingest
+    path), instead of a /latest call per device.
+    """
+    if not db_pool:
+        raise HTTPException(status_code=500, detail="Database pool not initialized")
+
+    args: List[Any] = [offline_after]
+    online = "COALESCE(d.last_seen >= now() - make_interval(secs => $1), false)"
+    clauses = []
+    if device_id:
+        args.append([d.strip() for value in device_id for d in value.split(",") if d.strip()])
+        clauses.append(f"d.device_id = ANY(${len(args)}::varchar[])")
+    if status != "all":
+        clauses.append(online if status == "online" else f"NOT {online}")
+    totals_where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+
+    page_clauses, page_args = list(clauses), list(args)
+    if cursor:
+        page_args.append(cursor)
+        page_clauses.append(f"d.device_id > ${len(page_args)}")
+    page_args.append(limit)
+    page_where = f"WHERE {' AND '.join(page_clauses)}" if page_clauses else ""
+
+    async with acquire(read_only=True) as conn:
+        with timed_query("fleet_totals"):
+            totals = await conn.fetchrow(f"""
+                SELECT COUNT(*) AS total, COUNT(*) FILTER (WHERE {online}) AS online
+                FROM "Devices" d
+                {totals_where}
+            """, *args)
+
+        with timed_query("fleet_page"):
+            page = await conn.fetchrow(f"""
+                WITH page AS (
+                    SELECT d.device_id, d.last_seen, {online} AS online
+                    FROM "Devices" d
+                    {page_where}
+                    ORDER BY d.device_id
+                    LIMIT ${len(page_args)}
+                )
+                SELECT COALESCE(json_agg(json_build_object(
+                           'device_id', p.device_id,
+                           'last_seen', CAST(EXTRACT(EPOCH FROM p.last_seen) AS BIGINT),
+                           'online', p.online,
+                           'latest', CASE WHEN t.device_id IS NULL THEN NULL ELSE {TELEMETRY_JSON_SQL} END
+                       ) ORDER BY p.device_id), '[]')::text AS body,
+                       COUNT(*) AS row_count,
+                       MAX(p.device_id) AS last_device_id
+                FROM page p
+                LEFT JOIN "LatestTelemetry" t ON t.device_id = p.device_id
+            """, *page_args)
+
+        envelope = json.dumps({
+            "total_devices": totals["total"],
+            "online_devices": totals["online"],
+            "next_cursor": page["last_device_id"] if page["row_count"] == limit else None
+        }, separators=(",", ":"))
+        return json_response('{"data":' + page["body"] + "," + envelope[1:])
+
+
+@router.post("/ingest", response_model=IngestResponse)
+async def ingest_telemetry(
+    request: Request,
+    x_factory_key: Optional[str] = Header(None, description="Factory key (PIANOGUARD_FACTORY_KEY)")
+):
+    """Store a batch of telemetry records (NDJSON, or a JSON array of records)
+
+    The body is parsed as it streams in and written through write_batch() in
+    transactions of INGEST_BATCH_ROWS rows - the subscriber's bulk insert -
+    so records already stored are skipped and retrying a request is safe.
+    Invalid records are rejected one by one and reported by index; only the
+    first MAX_INGEST_ERRORS are listed. Going over MAX_INGEST_BYTES or
+    MAX_INGEST_RECORDS fails the request with 413, keeping the batches
+    already written. It can write for any device, so the factory key is
+    required in X-Factory-Key.
+    """
+    if not x_factory_key or not hmac.compare_digest(x_factory_key.encode(), PIANOGUARD_FACTORY_KEY.encode()):
+        raise HTTPException(status_code=401, detail="Invalid factory key")
+    if not db_pool:
+        raise HTTPException(status_code=500, detail="Database pool not initialized")
+
+    length = request.headers.get("content-length")
+    if length and length.isdigit() and int(length) > MAX_INGEST_BYTES:
+        raise HTTPException(status_code=413, detail=f"Request body larger than {MAX_INGEST_BYTES} bytes")
+
+    parser = IngestParser(max_record_bytes=MAX_INGEST_RECORD_BYTES)
+    batch: List[TelemetryRow] = []
+    errors: List[IngestError] = []
+    counts = {"stored": 0, "duplicate": 0, "rejected": 0}
+
+    def reject(index: int, error: str) -> None:
+        counts["rejected"] += 1
+        if len(errors) < MAX_INGEST_ERRORS:
+            errors.append(IngestError(index=index, error=error))
+
+    def too_large(limit: str) -> HTTPException:
+        return HTTPException(
+            status_code=413,
+            detail=f"{limit}; {counts['stored'] + counts['duplicate']} valid records were already written"
         )
+
+    async def flush() -> None:
+        async with acquire() as conn, timed_query("ingest_batch"):
+            inserted = await write_batch(conn, batch)
+        counts["stored"] += len(inserted)
+        counts["duplicate"] += len(batch) - len(inserted)
+        ROWS_STORED.inc(len(inserted))
+        ROWS_DUPLICATE.inc(len(batch) - len(inserted))
+        batch.clear()
+
+    async def take(parsed) -> None:
+        for index, record, error in parsed:
+            if index >= MAX_INGEST_RECORDS:
+                raise too_large(f"More than {MAX_INGEST_RECORDS} records")
+            if error is None:
+                try:
+                    if not isinstance(record, dict):
+                        raise ValueError("record is not a JSON object")
+                    if "timestamp" not in record:
+                        raise ValueError("timestamp is required")
+                    row = telemetry_row(record)
+                    check_row(row)
+                    batch.append(row)
+                except (ValueError, TypeError, OverflowError) as e:
+                    error = str(e)
+            if error is not None:
+                reject(index, error)
+            if len(batch) >= INGEST_BATCH_ROWS:
+                await flush()
+
+    size = 0
+    async for chunk in request.stream():
+        size += len(chunk)
+        if size > MAX_INGEST_BYTES:
+            raise too_large(f"Request body larger than {MAX_INGEST_BYTES} bytes")
+        await take(parser.feed(chunk))
+    await take(parser.close())
+    if batch:
+        await flush()
+
+    return IngestResponse(received=parser.records, errors=errors, **counts)
+
+
+@router.get("/devices", response_model=List[DeviceInfo])
+async def get_devices():
+    """Get list of all registered devices"""
+    if not db_pool:
+        raise HTTPException(status_code=500, detail="Database pool not initialized")
+
+    async with acquire(read_only=True) as conn:
+        with timed_query("devices"):
+            rows = await conn.fetch("""
+                SELECT device_id,
+                       CASE
+                           WHEN last_seen IS NULL THEN NULL
+                           ELSE CAST(EXTRACT(EPOCH FROM last_seen) AS BIGINT)
+                       END as last_seen
+                FROM "Devices"
+                ORDER BY last_seen DESC NULLS LAST
+            """)
+
+            return [
+                DeviceInfo(
+                    device_id=row["device_id"],
+                    last_seen=row["last_seen"]
+                )
+                for row in rows
+            ]
+
@@ -0,0 +1,187 @@
+"""
+dedupe.py
+
+Created on: 2026-10-17
+Edited on: 2026-10-17
+Author: R. Andrew Ballard (c) 2025 "Andwardo"
+Version: v1.0.0
+
+Duplicate telemetry handling, keyed on (device_id, timestamp)
+The database enforces the key with a unique index (migration 5) and the write
+path skips conflicting rows; RecentKeyFilter lets the subscriber drop obvious
+redeliveries before they reach the database, and dedupe_telemetry() removes
+duplicates stored before the index existed (rebuilding the rollups of the
+days it touched, which counted every copy).
+
+Usage:
+    python dedupe.py                    # delete duplicate rows, one time window at a time
+    python dedupe.py --dry-run          # only count them
+    python dedupe.py --chunk-hours 6    # window size (default: 24)
+"""
+
+import argparse
+import asyncio
+import logging
+import threading
+import time
+from collections import OrderedDict
+from datetime import timedelta
+from typing import Hashable, Iterable, Set
+
+import asyncpg
+
+from partitions import list_partitions
+from rollups import RESOLUTIONS, rebuild_rollups
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CHUNK_HOURS = 24
+
+# Duplicates within one time window; the copy with the lowest id is kept
+DUPLICATES_SQL = """
+    SELECT id, timestamp
+    FROM (
+        SELECT id, timestamp,
+               row_number() OVER (PARTITION BY device_id, timestamp ORDER BY id) AS copy
+        FROM "{table}"
+        WHERE timestamp >= $1 AND timestamp < $2
+    ) copies
+    WHERE copy > 1
+"""
+
+DELETE_DUPLICATES_SQL = f"""
+    WITH duplicates AS ({DUPLICATES_SQL})
+    DELETE FROM "{{table}}" t
+    USING duplicates d
+    WHERE t.id = d.id AND t.timestamp = d.timestamp
+"""
+
+COUNT_DUPLICATES_SQL = f"SELECT COUNT(*) FROM ({DUPLICATES_SQL}) d"
+
+
+class RecentKeyFilter:
+    """Bounded set of the most recently accepted (device_id, timestamp) keys
+
+    Catches QoS 1 redeliveries and device retries in memory. It is only a
+    shortcut: keys are forgotten oldest first once max_keys is reached, and
+    the unique index still rejects anything the filter misses.
+    """
+
+    def __init__(self, max_keys: int = 100000):
+        self.max_keys = max_keys
+        self._keys: "OrderedDict[Hashable, None]" = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.duplicates = 0
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def seen(self, key: Hashable) -> bool:
+        """True (and counted) if key was accepted recently"""
+        if self.max_keys <= 0:
+            return False
+        with self._lock:
+            if key in self._keys:
+                self.duplicates += 1
+                return True
+        return False
+
+    def add(self, key: Hashable) -> None:
+        """Remember an accepted key, forgetting the oldest when full"""
+        if self.max_keys <= 0:
+            return
+        with self._lock:
+            self._keys[key] = None
+            while len(self._keys) > self.max_keys:
+                self._keys.popitem(last=False)
+
+    def discard(self, keys: Iterable[Hashable]) -> None:
+        """Forget keys whose rows were never stored, so a redelivery gets through"""
+        with self._lock:
+            for key in keys:
+                self._keys.pop(key, None)
+
+
+async def dedupe_partition(
+    conn: asyncpg.Connection,
+    table: str,
+    chunk: timedelta = timedelta(hours=DEFAULT_CHUNK_HOURS),
+    dry_run: bool = False
+) -> int:
+    """Delete duplicate rows from one partition, one time window per transaction
+
+    Each window only row-locks the duplicates it deletes, so ingest and
+    queries carry on. Rollups of every day that had duplicates are rebuilt
+    afterwards. Returns the number of duplicates found.
+    """
+    bounds = await conn.fetchrow(f'SELECT MIN(timestamp) AS first, MAX(timestamp) AS last FROM "{table}"')
+    if bounds["first"] is None:
+        return 0
+
+    sql = (COUNT_DUPLICATES_SQL if dry_run else DELETE_DUPLICATES_SQL).format(table=table)
+    day = RESOLUTIONS["1d"]
+    days: Set[int] = set()
+    total = 0
+    start = bounds["first"].replace(hour=0, minute=0, second=0, microsecond=0)
+    while start <= bounds["last"]:
+        end = start + chunk
+        if dry_run:
+            found = await conn.fetchval(sql, start, end)
+        else:
+            result = await conn.execute(sql, start, end)
+            found = int(result.split()[-1])
+        if found and not dry_run:
+            first_day = int(start.timestamp()) // day * day
+            days.update(range(first_day, int(end.timestamp()), day))
+        total += found
+        start = end
+
+    for day_start in sorted(days):
+        await rebuild_rollups(conn, day_start, day_start + day)
+
+    if total:
+        action = "Found" if dry_run else "Deleted"
+        logger.info(f'{action} {total} duplicate telemetry rows in "{table}"')
+    return total
+
+
+async def dedupe_telemetry(
+    conn: asyncpg.Connection,
+    chunk: timedelta = timedelta(hours=DEFAULT_CHUNK_HOURS),
+    dry_run: bool = False
+) -> int:
+    """Delete duplicate rows from every partition, returns the number found"""
+    total = 0
+    for name, _ in await list_partitions(conn):
+        started = time.monotonic()
+        found = await dedupe_partition(conn, name, chunk, dry_run)
+        logger.info(f'Checked "{name}" in {time.monotonic() - started:.1f}s: {found} duplicates')
+        total += found
+    return total
+
+
+async def _main(chunk_hours: float, dry_run: bool) -> None:
+    from env import DB_HOST, DB_PORT, DB_NAME, DB_USER, DB_PASSWORD
+
+    conn = await asyncpg.connect(
+        host=DB_HOST,
+        port=int(DB_PORT),
+        database=DB_NAME,
+        user=DB_USER,
+        password=DB_PASSWORD
+    )
+    try:
+        total = await dedupe_telemetry(conn, timedelta(hours=chunk_hours), dry_run)
+    finally:
+        await conn.close()
+    print(f'{"Found" if dry_run else "Deleted"} {total} duplicate telemetry rows')
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--chunk-hours", type=float, default=DEFAULT_CHUNK_HOURS, help="Time window per transaction")
+    parser.add_argument("--dry-run", action="store_true", help="Count duplicates without deleting them")
+    args = parser.parse_args()
+    asyncio.run(_main(args.chunk_hours, args.dry_run))
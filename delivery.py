@@ -0,0 +1,115 @@
+"""
+delivery.py
+
+Created on: 2026-10-17
+Edited on: 2026-10-17
+Author: R. Andrew Ballard (c) 2025 "Andwardo"
+Version: v1.0.0
+
+MQTT delivery guarantees for the subscriber
+  at_most_once   QoS 0, clean session - whatever is in flight when the
+                 subscriber stops or crashes is lost
+  at_least_once  QoS 1 on a persistent session with manual acks: a message's
+                 PUBACK is only sent once the batch holding its row has
+                 committed (or been spooled), so the broker redelivers
+                 anything the subscriber never finished with
+AckTracker holds the acks back until the writer has settled their rows.
+"""
+
+import threading
+from collections import deque
+from typing import Callable, Deque, Dict, List, Optional, Tuple
+
+DELIVERY_AT_MOST_ONCE = "at_most_once"
+DELIVERY_AT_LEAST_ONCE = "at_least_once"
+DELIVERY_MODES = (DELIVERY_AT_MOST_ONCE, DELIVERY_AT_LEAST_ONCE)
+
+# Largest Receive Maximum MQTT v5 allows
+MAX_RECEIVE_MAXIMUM = 65535
+
+
+# (connection session, packet id, QoS) of one received message
+Message = Tuple[int, int, int]
+
+
+class AckTracker:
+    """Sends MQTT acks once the rows their messages carried are settled
+
+    track() is called from the MQTT network thread for every message that
+    queues a row, before the row is queued, and keeps one entry per row in
+    queue order. Messages that produce no row (duplicates, invalid payloads)
+    are passed to done() and ride along with the newest entry, so acks still
+    go out in arrival order. The writer settles rows in the order it took
+    them off the queue: settle(n) acks the oldest n entries, abandon(n)
+    drops them without acking their rows and calls on_abandon, which should
+    reconnect - the broker only redelivers unacked messages on a new
+    connection, and until then they hold its in-flight window. The queue
+    must never drop a row it accepted.
+
+    new_session() is called on every connect. Acks still owed to an earlier
+    connection are never sent: the broker redelivers those messages anyway,
+    and it may have reused their packet ids for new messages.
+    """
+
+    def __init__(self, client, on_abandon: Optional[Callable[[], None]] = None):
+        self.client = client
+        self.on_abandon = on_abandon
+        self._pending: Deque[List[Message]] = deque()
+        self._session = 0
+        self._lock = threading.Lock()
+
+        self.acked = 0
+        self.abandoned = 0
+        self.superseded = 0
+
+    def __len__(self) -> int:
+        return len(self._pending)
+
+    def new_session(self) -> None:
+        with self._lock:
+            self._session += 1
+
+    def track(self, mid: int, qos: int) -> None:
+        with self._lock:
+            self._pending.append([(self._session, mid, qos)])
+
+    def done(self, mid: int, qos: int) -> None:
+        """Ack a message that queued no row, after every row queued before it"""
+        with self._lock:
+            message = (self._session, mid, qos)
+            if self._pending:
+                self._pending[-1].append(message)
+                return
+        self._ack([message])
+
+    def settle(self, count: int) -> None:
+        """Ack the oldest count rows (stored, skipped or spooled) and the messages riding with them"""
+        self._ack([message for entry in self._pop(count) for message in entry])
+
+    def abandon(self, count: int) -> None:
+        """Leave the oldest count rows unacked for redelivery, acking only the messages riding with them"""
+        entries = self._pop(count)
+        self.abandoned += len(entries)
+        self._ack([message for entry in entries for message in entry[1:]])
+        if entries and self.on_abandon is not None:
+            self.on_abandon()
+
+    def _pop(self, count: int) -> List[List[Message]]:
+        with self._lock:
+            return [self._pending.popleft() for _ in range(min(count, len(self._pending)))]
+
+    def _ack(self, messages: List[Message]) -> None:
+        # paho queues the packet for its network thread, so this is safe from the event loop
+        current = [(mid, qos) for session, mid, qos in messages if session == self._session]
+        for mid, qos in current:
+            self.client.ack(mid, qos)
+        self.acked += len(current)
+        self.superseded += len(messages) - len(current)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "pending": len(self),
+            "acked": self.acked,
+            "abandoned": self.abandoned,
+            "superseded": self.superseded,
+        }
@@ -0,0 +1,151 @@
+"""
+downsample.py
+
+Created on: 2026-10-17
+Edited on: 2026-10-17
+Author: R. Andrew Ballard (c) 2025 "Andwardo"
+Version: v1.0.0
+
+Chart downsampling for /api/data/series
+Reduces a (timestamp, value) series to a target number of points that still
+looks like the original when plotted, with numpy doing the per-point work:
+  lttb    largest-triangle-three-buckets, keeps the points that carry the shape
+  minmax  each time bucket's lowest and highest point, keeps every spike
+Downsampled series are cached per worker in a bounded LRU (SeriesCache).
+"""
+
+import time
+from collections import OrderedDict
+from typing import Dict, Hashable, Optional, Tuple
+
+import numpy as np
+
+METHOD_LTTB = "lttb"
+METHOD_MINMAX = "minmax"
+METHODS = (METHOD_LTTB, METHOD_MINMAX)
+
+
+def lttb(x: np.ndarray, y: np.ndarray, points: int) -> np.ndarray:
+    """Indices of the points largest-triangle-three-buckets keeps, in order
+
+    The first and last points are always kept; the rest are split into
+    points - 2 equal-count buckets and each contributes the point forming
+    the largest triangle with the point kept from the previous bucket and
+    the average of the next one. Buckets are walked in Python (each depends
+    on the previous choice), the work within one is vectorized.
+    """
+    n = len(x)
+    if points >= n or points < 3:
+        return np.arange(n)
+
+    edges = np.linspace(1, n - 1, points - 1).astype(np.int64)
+    # Average of every bucket, plus the last point standing in for the bucket after the last
+    sums_x = np.add.reduceat(x[1:n - 1], edges[:-1] - 1)
+    sums_y = np.add.reduceat(y[1:n - 1], edges[:-1] - 1)
+    counts = np.diff(edges)
+    avg_x = np.append(sums_x / counts, x[-1])
+    avg_y = np.append(sums_y / counts, y[-1])
+
+    kept = np.empty(points, dtype=np.int64)
+    kept[0], kept[-1] = 0, n - 1
+    previous = 0
+    for bucket in range(points - 2):
+        lo, hi = edges[bucket], edges[bucket + 1]
+        # Twice the triangle area; the constant factor doesn't change the argmax
+        area = np.abs(
+            (x[previous] - avg_x[bucket + 1]) * (y[lo:hi] - y[previous])
+            - (x[previous] - x[lo:hi]) * (avg_y[bucket + 1] - y[previous])
+        )
+        previous = lo + int(np.argmax(area))
+        kept[bucket + 1] = previous
+    return kept
+
+
+def minmax(x: np.ndarray, y: np.ndarray, points: int) -> np.ndarray:
+    """Indices of the lowest and highest point in each of points // 2 equal-width time buckets, in order
+
+    x must be sorted (rows come ordered by timestamp).
+    """
+    n = len(x)
+    if points >= n or points < 2:
+        return np.arange(n)
+
+    buckets = points // 2
+    span = x[-1] - x[0]
+    if span <= 0:
+        return np.array([0, n - 1])
+    bucket = np.minimum(((x - x[0]) / span * buckets).astype(np.int64), buckets - 1)
+
+    # x is sorted, so every bucket is one contiguous run
+    starts = np.concatenate(([0], np.flatnonzero(np.diff(bucket)) + 1))
+    run = np.repeat(np.arange(len(starts)), np.diff(np.append(starts, n)))
+    lows = _first_per_run(y == np.minimum.reduceat(y, starts)[run], run)
+    highs = _first_per_run(y == np.maximum.reduceat(y, starts)[run], run)
+    return np.unique(np.concatenate((lows, highs)))
+
+
+def _first_per_run(mask: np.ndarray, run: np.ndarray) -> np.ndarray:
+    matches = np.flatnonzero(mask)
+    _, first = np.unique(run[matches], return_index=True)
+    return matches[first]
+
+
+def downsample(x: np.ndarray, y: np.ndarray, points: int, method: str = METHOD_LTTB) -> Tuple[np.ndarray, np.ndarray]:
+    """(x, y) reduced to about points points; NaN values (NULL in the database) are skipped"""
+    present = ~np.isnan(y)
+    if not present.all():
+        x, y = x[present], y[present]
+    indices = lttb(x, y, points) if method == METHOD_LTTB else minmax(x, y, points)
+    return x[indices], y[indices]
+
+
+class SeriesCache:
+    """Bounded LRU of downsampled series, each stored as its ready-to-send JSON
+
+    Entries expire after ttl seconds, or live_ttl for ranges that reach into
+    the last settle_after seconds and are still gaining rows.
+    """
+
+    def __init__(self, max_entries: int = 1000, ttl: float = 3600.0, live_ttl: float = 10.0, settle_after: float = 300.0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.live_ttl = live_ttl
+        self.settle_after = settle_after
+
+        self._entries: "OrderedDict[Hashable, Tuple[float, str]]" = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: Hashable) -> Optional[str]:
+        now = time.monotonic()
+        entry = self._entries.get(key)
+        if entry is None or entry[0] <= now:
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, key: Hashable, value: str, end: float) -> None:
+        """Cache value for a series whose range ends at epoch end"""
+        if self.max_entries <= 0:
+            return
+        live = end > time.time() - self.settle_after
+        expires = time.monotonic() + (self.live_ttl if live else self.ttl)
+        self._entries[key] = (expires, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "entries": len(self),
+            "hits": self.hits,
+            "misses": self.misses,
+        }
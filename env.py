@@ -4,9 +4,9 @@
 env.py
 
 Created on: 2025-07-21
-Edited on: 2025-07-21
+Edited on: 2026-10-17
 Author: R. Andrew Ballard (c) 2025 "Andwardo"
-Version: v1.0.1
+Version: v1.1.0
 
 """
 
@@ -34,3 +34,7 @@ DB_PORT = get_env_var("DB_PORT")
 DB_NAME = get_env_var("DB_NAME")
 DB_USER = get_env_var("DB_USER")
 DB_PASSWORD = get_env_var("DB_PASSWORD")
+
+# Optional read replicas for the query endpoints, comma-separated host[:port]
+# (same database name and credentials as the primary; empty = primary only)
+DB_READ_REPLICAS = os.getenv("DB_READ_REPLICAS", "")
@@ -1,4 +1,22 @@
 # gunicorn_config.py
+import os
+import shutil
+
 bind = "127.0.0.1:8000"
 workers = 2
 timeout = 60
+
+# Prometheus multiprocess mode: every worker writes its metrics here and
+# /metrics aggregates them (see metrics.py). Set before workers import it.
+os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR", "/tmp/pgapi-metrics")
+
+
+def on_starting(server):
+    # Samples left by a previous master would be summed into the new ones
+    shutil.rmtree(os.environ["PROMETHEUS_MULTIPROC_DIR"], ignore_errors=True)
+    os.makedirs(os.environ["PROMETHEUS_MULTIPROC_DIR"])
+
+
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
@@ -0,0 +1,163 @@
+"""
+ingest_parser.py
+
+Created on: 2026-10-17
+Edited on: 2026-10-17
+Author: R. Andrew Ballard (c) 2025 "Andwardo"
+Version: v1.0.0
+
+Incremental parser for POST /api/data/ingest bodies
+Takes the body chunk by chunk as it arrives and hands back each record as
+soon as it is complete, so a request never has to be buffered whole. The
+format is detected from the first character: a JSON array ("[...]") or
+NDJSON (one JSON value per line). A bad NDJSON line only fails that line;
+in an array, a malformed value ends parsing because the rest can't be
+located reliably.
+"""
+
+import codecs
+import json
+from typing import Any, List, Optional, Tuple
+
+FORMAT_NDJSON = "ndjson"
+FORMAT_ARRAY = "array"
+
+DEFAULT_MAX_RECORD_BYTES = 64 * 1024
+
+_WHITESPACE = " \t\r\n"
+
+# (index of the record in the body, parsed value or None, error message or None)
+Parsed = Tuple[int, Any, Optional[str]]
+
+
+class IngestParser:
+    """feed() body chunks, then close(); both return the records completed so far
+
+    Record indices count every record in the body, valid or not, from 0.
+    Sizes are counted in characters, which bounds the buffer just as well.
+    """
+
+    def __init__(self, max_record_bytes: int = DEFAULT_MAX_RECORD_BYTES):
+        self.max_record_bytes = max_record_bytes
+        self.format: Optional[str] = None
+        self.records = 0
+        self.failed = False     # array parsing stopped at a malformed value
+
+        self._decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        self._json = json.JSONDecoder()
+        self._buffer = ""
+        self._skipping = False  # NDJSON: dropping the rest of an oversized line
+        self._expect_value = True
+        self._ended = False
+
+    def feed(self, data: bytes) -> List[Parsed]:
+        self._buffer += self._decoder.decode(data)
+        return self._parse(final=False)
+
+    def close(self) -> List[Parsed]:
+        self._buffer += self._decoder.decode(b"", final=True)
+        parsed = self._parse(final=True)
+        if self.format == FORMAT_ARRAY and not self._ended and not self.failed:
+            parsed.append(self._fail("JSON array is not closed"))
+        return parsed
+
+    def _next(self, value: Any = None, error: Optional[str] = None) -> Parsed:
+        index = self.records
+        self.records += 1
+        return index, value, error
+
+    def _fail(self, error: str) -> Parsed:
+        self.failed = True
+        self._buffer = ""
+        return self._next(error=error)
+
+    def _parse(self, final: bool) -> List[Parsed]:
+        if self.format is None:
+            stripped = self._buffer.lstrip(_WHITESPACE)
+            if not stripped:
+                self._buffer = ""
+                return []
+            if stripped[0] == "[":
+                self.format = FORMAT_ARRAY
+                self._buffer = stripped[1:]
+            else:
+                self.format = FORMAT_NDJSON
+                self._buffer = stripped
+        if self.format == FORMAT_ARRAY:
+            return self._parse_array(final)
+        return self._parse_lines(final)
+
+    def _parse_lines(self, final: bool) -> List[Parsed]:
+        parsed = []
+        lines = self._buffer.split("\n")
+        self._buffer = lines.pop()
+        if final and self._buffer:
+            lines.append(self._buffer)
+            self._buffer = ""
+
+        for line in lines:
+            if self._skipping:
+                # The oversized line was reported when it went over the limit
+                self._skipping = False
+                continue
+            if not line.strip(_WHITESPACE):
+                continue
+            if len(line) > self.max_record_bytes:
+                parsed.append(self._next(error=f"Record larger than {self.max_record_bytes} bytes"))
+                continue
+            try:
+                parsed.append(self._next(json.loads(line)))
+            except ValueError as e:
+                parsed.append(self._next(error=f"Invalid JSON: {e}"))
+
+        if len(self._buffer) > self.max_record_bytes and not self._skipping:
+            parsed.append(self._next(error=f"Record larger than {self.max_record_bytes} bytes"))
+            self._skipping = True
+        if self._skipping:
+            self._buffer = ""
+        return parsed
+
+    def _parse_array(self, final: bool) -> List[Parsed]:
+        parsed = []
+        buffer, position = self._buffer, 0
+        while not self.failed:
+            while position < len(buffer) and buffer[position] in _WHITESPACE:
+                position += 1
+            if position == len(buffer):
+                break
+
+            if self._ended:
+                parsed.append(self._fail("Unexpected data after the end of the JSON array"))
+                return parsed
+            if buffer[position] == "]" and (self._expect_value is False or self.records == 0):
+                self._ended = True
+                position += 1
+                continue
+            if not self._expect_value:
+                if buffer[position] != ",":
+                    parsed.append(self._fail(f"Expected ',' or ']' after record {self.records - 1}"))
+                    return parsed
+                self._expect_value = True
+                position += 1
+                continue
+
+            try:
+                value, end = self._json.raw_decode(buffer, position)
+            except ValueError as e:
+                # Most likely the record isn't complete yet
+                if final or len(buffer) - position > self.max_record_bytes:
+                    parsed.append(self._fail(f"Invalid JSON, the rest of the array was not read: {e}"))
+                    return parsed
+                break
+            if end == len(buffer) and not final and not isinstance(value, (dict, list, str)):
+                # A number or literal at the end of the buffer may continue in the next chunk
+                break
+            if end - position > self.max_record_bytes:
+                parsed.append(self._next(error=f"Record larger than {self.max_record_bytes} bytes"))
+            else:
+                parsed.append(self._next(value))
+            self._expect_value = False
+            position = end
+
+        self._buffer = buffer[position:]
+        return parsed
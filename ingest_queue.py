@@ -0,0 +1,145 @@
+"""
+ingest_queue.py
+
+Created on: 2026-10-17
+Edited on: 2026-10-17
+Author: R. Andrew Ballard (c) 2025 "Andwardo"
+Version: v1.0.0
+
+Bounded handoff queue between the paho network thread and the asyncio loop
+Applies a configurable overflow policy when the database falls behind
+"""
+
+import asyncio
+import threading
+import time
+from collections import deque
+from typing import Any, Callable, Deque, Dict, List, Optional
+
+from metrics import ROWS_DROPPED
+
+POLICY_BLOCK = "block"
+POLICY_DROP_OLDEST = "drop_oldest"
+POLICY_SPILL = "spill"
+OVERFLOW_POLICIES = (POLICY_BLOCK, POLICY_DROP_OLDEST, POLICY_SPILL)
+
+
+class IngestQueue:
+    """Thread-safe bounded queue with an overflow policy
+
+    put() is called from producer threads (the MQTT network thread), get() is
+    awaited on the event loop. When the queue is full:
+    - block: the producer waits for space, up to block_timeout seconds, then
+      the item is dropped
+    - drop_oldest: the oldest queued item is discarded to make room
+    - spill: the new item is handed to the spill callable (e.g. written to disk)
+    """
+
+    def __init__(
+        self,
+        loop: asyncio.AbstractEventLoop,
+        maxsize: int = 10000,
+        policy: str = POLICY_BLOCK,
+        block_timeout: Optional[float] = 30.0,
+        spill: Optional[Callable[[Any], None]] = None
+    ):
+        if policy not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown overflow policy: {policy}")
+        if policy == POLICY_SPILL and spill is None:
+            raise ValueError("Overflow policy 'spill' requires a spill callable")
+
+        self.loop = loop
+        self.maxsize = maxsize
+        self.policy = policy
+        self.block_timeout = block_timeout
+        self.spill = spill
+
+        self._items: Deque[Any] = deque()
+        self._lock = threading.Lock()
+        self._not_full = threading.Condition(self._lock)
+        self._not_empty = asyncio.Event()
+        self._consumer_waiting = False
+
+        self.enqueued = 0
+        self.dropped = 0
+        self.spilled = 0
+        self.blocked_seconds = 0.0
+
+    @property
+    def depth(self) -> int:
+        return len(self._items)
+
+    def put(self, item: Any) -> bool:
+        """Enqueue an item from a producer thread, returns False if it was not queued"""
+        spill_item = None
+        with self._lock:
+            if len(self._items) >= self.maxsize:
+                if self.policy == POLICY_DROP_OLDEST:
+                    self._items.popleft()
+                    self.dropped += 1
+                    ROWS_DROPPED.inc()
+                elif self.policy == POLICY_SPILL:
+                    spill_item = item
+                else:
+                    started = time.monotonic()
+                    has_space = self._not_full.wait_for(
+                        lambda: len(self._items) < self.maxsize,
+                        timeout=self.block_timeout
+                    )
+                    self.blocked_seconds += time.monotonic() - started
+                    if not has_space:
+                        self.dropped += 1
+                        ROWS_DROPPED.inc()
+                        return False
+
+            if spill_item is None:
+                self._items.append(item)
+                self.enqueued += 1
+                wake_consumer = self._consumer_waiting
+                self._consumer_waiting = False
+
+        if spill_item is not None:
+            # Disk I/O happens outside the lock so the consumer is never stalled by it
+            self.spill(spill_item)
+            self.spilled += 1
+            return False
+
+        if wake_consumer:
+            self.loop.call_soon_threadsafe(self._not_empty.set)
+        return True
+
+    async def get(self, max_items: int, timeout: Optional[float] = None) -> List[Any]:
+        """Wait up to timeout seconds for items, then return at most max_items of them"""
+        if not self._items:
+            with self._lock:
+                if not self._items:
+                    self._not_empty.clear()
+                    self._consumer_waiting = True
+            if self._consumer_waiting:
+                try:
+                    await asyncio.wait_for(self._not_empty.wait(), timeout=timeout)
+                except asyncio.TimeoutError:
+                    pass
+
+        with self._lock:
+            self._consumer_waiting = False
+            count = min(max_items, len(self._items))
+            items = [self._items.popleft() for _ in range(count)]
+            if items:
+                self._not_full.notify_all()
+        return items
+
+    def wake(self) -> None:
+        """Release a consumer blocked in get(), e.g. on shutdown"""
+        self.loop.call_soon_threadsafe(self._not_empty.set)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "depth": self.depth,
+            "maxsize": self.maxsize,
+            "policy": self.policy,
+            "enqueued": self.enqueued,
+            "dropped": self.dropped,
+            "spilled": self.spilled,
+            "blocked_seconds": round(self.blocked_seconds, 3),
+        }
@@ -0,0 +1,207 @@
+"""
+latest_cache.py
+
+Created on: 2026-10-17
+Edited on: 2026-10-17
+Author: R. Andrew Ballard (c) 2025 "Andwardo"
+Version: v1.1.0
+
+In-process cache of each device's latest telemetry record
+Kept current by a dedicated LISTEN connection per worker; the MQTT subscriber
+NOTIFYs every committed write (see telemetry_writer.TELEMETRY_CHANNEL)
+The same connection feeds live streaming listeners (see telemetry_stream.py)
+"""
+
+import asyncio
+import json
+import logging
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional
+
+import asyncpg
+
+from telemetry_writer import TELEMETRY_CHANNEL, float4
+
+logger = logging.getLogger(__name__)
+
+RECONNECT_DELAY = 5  # seconds
+
+# Newest row per device for the most recently seen devices, from the table the ingest path maintains
+COLD_FILL_SQL = """
+    SELECT device_id,
+           CAST(EXTRACT(EPOCH FROM timestamp) AS BIGINT) as timestamp,
+           fw_version, wifi_ssid, wifi_rssi,
+           uptime_ms, free_heap, battery_voltage,
+           led_power, led_water, led_pads
+    FROM "LatestTelemetry"
+    ORDER BY timestamp DESC
+    LIMIT $1
+"""
+
+
+def record_from_row(row) -> Dict[str, Any]:
+    """Database row in the API response format (NULLs coalesced, LEDs nested under status)"""
+    return {
+        "device_id": row["device_id"],
+        "timestamp": row["timestamp"],
+        "fw_version": row["fw_version"] or "",
+        "wifi_ssid": row["wifi_ssid"] or "",
+        "wifi_rssi": row["wifi_rssi"] or 0,
+        "uptime_ms": row["uptime_ms"] or 0,
+        "free_heap": row["free_heap"] or 0,
+        # asyncpg widens real to double (12.300000190734863), JSON from the database prints 12.3
+        "battery_voltage": float4(row["battery_voltage"]) if row["battery_voltage"] else 0.0,
+        "status": {
+            "power": row["led_power"] or False,
+            "water": row["led_water"] or False,
+            "pads": row["led_pads"] or False,
+        },
+    }
+
+
+class LatestTelemetryCache:
+    """Bounded map of device_id -> latest telemetry record
+
+    The cache is only trusted while its LISTEN connection is up (ready). If it
+    also holds every device that has telemetry (complete), a miss means the
+    device has no data and the newest record overall can be answered from
+    memory too. Evicting a device clears complete until the next cold fill.
+    """
+
+    def __init__(self, max_devices: int = 10000):
+        self.max_devices = max_devices
+
+        self._entries: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._newest: Optional[Dict[str, Any]] = None
+        self._conn: Optional[asyncpg.Connection] = None
+        self._task: Optional[asyncio.Task] = None
+        self._stopping = False
+        self._listeners: List[Callable[[Dict[str, Any]], None]] = []
+
+        self.ready = False
+        self.complete = False
+        self.hits = 0
+        self.misses = 0
+        self.notifications = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, device_id: str) -> Optional[Dict[str, Any]]:
+        record = self._entries.get(device_id)
+        if record is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return record
+
+    def newest(self) -> Optional[Dict[str, Any]]:
+        """Newest record across all devices, only meaningful when complete"""
+        return self._newest
+
+    def update(self, record: Dict[str, Any]) -> bool:
+        """Store a record unless the cache already holds a newer one for its device, returns True if stored"""
+        device_id = record["device_id"]
+        current = self._entries.get(device_id)
+        if current is not None and current["timestamp"] > record["timestamp"]:
+            return False
+
+        self._entries[device_id] = record
+        self._entries.move_to_end(device_id)
+        if self._newest is None or record["timestamp"] >= self._newest["timestamp"]:
+            self._newest = record
+
+        while len(self._entries) > self.max_devices:
+            evicted_id, evicted = self._entries.popitem(last=False)
+            self.complete = False
+            if evicted is self._newest:
+                self._newest = max(self._entries.values(), key=lambda r: r["timestamp"], default=None)
+        return True
+
+    def add_listener(self, callback: Callable[[Dict[str, Any]], None]) -> None:
+        """Call callback(record) for every committed record newer than the cached one, and for those found by a cold fill"""
+        self._listeners.append(callback)
+
+    def _notify(self, record: Dict[str, Any]) -> None:
+        for callback in self._listeners:
+            try:
+                callback(record)
+            except Exception as e:
+                logger.error(f"Telemetry listener failed: {e}")
+
+    def _on_notification(self, connection, pid, channel, payload) -> None:
+        try:
+            record = json.loads(payload)
+            applied = self.update(record)
+            self.notifications += 1
+        except (ValueError, KeyError) as e:
+            logger.warning(f"Ignoring malformed telemetry notification: {e}")
+            return
+        # A record older than the cached one (e.g. the slower of two concurrent batches)
+        # would take listeners back in time
+        if applied:
+            self._notify(record)
+
+    def _on_termination(self, connection) -> None:
+        logger.warning("Latest telemetry cache lost its LISTEN connection")
+        self.ready = False
+
+    async def _cold_fill(self, conn: asyncpg.Connection) -> None:
+        rows = await conn.fetch(COLD_FILL_SQL, self.max_devices + 1)
+        # Oldest first, so when there are more devices than fit, the LRU evicts the oldest
+        for row in reversed(rows):
+            record = record_from_row(row)
+            current = self._entries.get(record["device_id"])
+            # Catch listeners up on anything committed while the connection was down
+            if self.update(record) and record != current:
+                self._notify(record)
+        self.complete = len(rows) <= self.max_devices
+
+    async def _run(self, connect_kwargs: Dict[str, Any]) -> None:
+        while not self._stopping:
+            try:
+                self._conn = await asyncpg.connect(**connect_kwargs)
+                self._conn.add_termination_listener(self._on_termination)
+
+                # Listen before filling so no write between the two is missed
+                await self._conn.add_listener(TELEMETRY_CHANNEL, self._on_notification)
+                await self._cold_fill(self._conn)
+                self.ready = True
+                logger.info(f"Latest telemetry cache ready with {len(self)} devices (complete={self.complete})")
+
+                while self.ready and not self._stopping:
+                    await asyncio.sleep(1)
+            except Exception as e:
+                logger.error(f"Latest telemetry cache listener failed: {e}")
+            finally:
+                self.ready = False
+                if self._conn and not self._conn.is_closed():
+                    await self._conn.close()
+                self._conn = None
+
+            if not self._stopping:
+                await asyncio.sleep(RECONNECT_DELAY)
+
+    def start(self, **connect_kwargs) -> None:
+        """Open the LISTEN connection in the background; asyncpg.connect() keyword arguments"""
+        self._task = asyncio.create_task(self._run(connect_kwargs))
+
+    async def stop(self) -> None:
+        self._stopping = True
+        self.ready = False
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "devices": len(self),
+            "ready": self.ready,
+            "complete": self.complete,
+            "hits": self.hits,
+            "misses": self.misses,
+            "notifications": self.notifications,
+        }
@@ -0,0 +1,124 @@
+"""
+log_pipeline.py
+
+Created on: 2026-10-17
+Edited on: 2026-10-17
+Author: R. Andrew Ballard (c) 2025 "Andwardo"
+Version: v1.0.0
+
+Non-blocking logging for the MQTT subscriber
+Log calls only put the record on a bounded in-memory queue; a background
+QueueListener thread writes it to the real handlers (stdout, the log file),
+so neither the MQTT network thread nor the event loop ever waits on disk.
+If the queue fills up (disk stalled) records are dropped and counted instead
+of blocking ingest. LogLimiter keeps repetitive warnings and errors (a
+device flooding bad payloads, a database outage) to one line per interval.
+"""
+
+import logging
+import queue
+import threading
+import time
+from logging.handlers import QueueHandler, QueueListener
+from typing import Dict, List, Optional
+
+DEFAULT_QUEUE_SIZE = 10000
+
+# Longest excerpt of a payload or value included in a log line
+EXCERPT_CHARS = 200
+
+
+def excerpt(value, limit: int = EXCERPT_CHARS) -> str:
+    """str(value), cut to limit characters so a huge payload can't flood the log"""
+    text = value if isinstance(value, str) else str(value)
+    if len(text) <= limit:
+        return text
+    return f"{text[:limit]}... ({len(text)} chars)"
+
+
+class DroppingQueueHandler(QueueHandler):
+    """QueueHandler that drops (and counts) records instead of blocking when the queue is full"""
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class QueueLogging:
+    """Moves the root logger's handlers behind a queue and a writer thread
+
+    start() must be called in every process: the writer thread doesn't
+    survive a fork, so each subscriber instance starts its own. The root
+    logger's handlers at the first start() are the ones written to.
+    """
+
+    def __init__(self, maxsize: int = DEFAULT_QUEUE_SIZE):
+        self.maxsize = maxsize
+        self.handlers: Optional[List[logging.Handler]] = None
+        self._handler: Optional[DroppingQueueHandler] = None
+        self._listener: Optional[QueueListener] = None
+        self._dropped_before = 0
+
+    @property
+    def dropped(self) -> int:
+        """Records dropped in this process because the queue was full"""
+        return self._dropped_before + (self._handler.dropped if self._handler else 0)
+
+    def start(self) -> None:
+        root = logging.getLogger()
+        if self.handlers is None:
+            self.handlers = list(root.handlers)
+        if self._handler:
+            self._dropped_before += self._handler.dropped
+
+        self._handler = DroppingQueueHandler(queue.Queue(self.maxsize))
+        self._listener = QueueListener(self._handler.queue, *self.handlers, respect_handler_level=True)
+        root.handlers = [self._handler]
+        self._listener.start()
+
+    def stop(self) -> None:
+        """Write out everything queued and log directly again"""
+        if self._listener is None:
+            return
+        logging.getLogger().handlers = list(self.handlers)
+        self._listener.stop()
+        self._listener = None
+
+
+class LogLimiter:
+    """Logs a message per key at most once per interval, counting the ones it holds back
+
+    The next message that gets through for a key reports how many similar
+    ones were suppressed. Safe to call from any thread.
+    """
+
+    def __init__(self, interval: float = 10.0):
+        self.interval = interval
+        self._last: Dict[str, List[float]] = {}  # key -> [last logged at, suppressed since]
+        self._lock = threading.Lock()
+
+        self.suppressed = 0
+
+    def log(self, logger: logging.Logger, level: int, key: str, message: str) -> None:
+        now = time.monotonic()
+        with self._lock:
+            state = self._last.get(key)
+            if state is not None and now - state[0] < self.interval:
+                state[1] += 1
+                self.suppressed += 1
+                return
+            held_back = int(state[1]) if state is not None else 0
+            self._last[key] = [now, 0]
+        if held_back:
+            message = f"{message} ({held_back} similar messages suppressed)"
+        logger.log(level, message)
+
+
+# Shared by the subscriber's modules, so one summary counts every suppressed line
+log_limiter = LogLimiter()
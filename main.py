@@ -9,11 +9,13 @@ Integrated asyncpg with connection pooling and proper PostgreSQL queries
 """
 
 import os
+import time
 from contextlib import asynccontextmanager
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Response
 from pydantic import BaseModel
 from dotenv import load_dotenv
-from data import router as data_router, init_db_pool, close_db_pool
+from data import router as data_router, init_db_pool, close_db_pool, request_pool_wait
+from metrics import REQUEST_SECONDS, render
 
 load_dotenv()
 
@@ -28,7 +30,43 @@ async def lifespan(app: FastAPI):
     await close_db_pool()
 
 
+class RequestTimingMiddleware:
+    """Adds a Server-Timing header (pool connection wait and handler time until headers, in ms)
+    and records the same handler time in the request latency histogram"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        # Shared list rather than a value, so waits recorded in child tasks are seen here too
+        waits = []
+        token = request_pool_wait.set(waits)
+        started = time.perf_counter()
+
+        async def send_with_timing(message):
+            if message["type"] == "http.response.start":
+                elapsed = time.perf_counter() - started
+                timing = f"pool;dur={sum(waits) * 1000:.2f}, app;dur={elapsed * 1000:.2f}"
+                message["headers"] = list(message.get("headers", [])) + [(b"server-timing", timing.encode())]
+                # Label by route template, not raw path, to keep the series count bounded
+                route = scope.get("route")
+                REQUEST_SECONDS.labels(
+                    scope["method"], route.path if route else "unmatched", message["status"]
+                ).observe(elapsed)
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            request_pool_wait.reset(token)
+
+
 app = FastAPI(lifespan=lifespan)
+app.add_middleware(RequestTimingMiddleware)
 app.include_router(data_router)
 
 
@@ -46,6 +84,17 @@ async def health_check():
     }
 
 
+@app.get("/metrics", include_in_schema=False)
+def metrics():
+    """Prometheus scrape endpoint, aggregated over all workers (see metrics.py)
+
+    Plain def so FastAPI runs it in the threadpool - aggregating the
+    multiprocess files is blocking file I/O.
+    """
+    body, content_type = render()
+    return Response(body, media_type=content_type)
+
+
 @app.get("/env-test")
 async def env_test():
     if os.getenv("ENVIRONMENT") == "dev":
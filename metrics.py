@@ -0,0 +1,173 @@
+"""
+metrics.py
+
+Created on: 2026-10-17
+Edited on: 2026-10-17
+Author: R. Andrew Ballard (c) 2025 "Andwardo"
+Version: v1.0.0
+
+Prometheus metrics shared by the API workers and the MQTT subscriber
+
+With PROMETHEUS_MULTIPROC_DIR set, every process writes its samples to that
+directory and a scrape aggregates all of them, so /metrics is correct no
+matter which gunicorn worker (or subscriber instance) serves it. The
+directory must be empty when the service starts - gunicorn_config.py and the
+systemd units take care of that.
+"""
+
+import os
+import time
+from typing import Tuple
+
+# Must exist before prometheus_client is imported in multiprocess mode
+if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+    os.makedirs(os.environ["PROMETHEUS_MULTIPROC_DIR"], exist_ok=True)
+
+from prometheus_client import (  # noqa: E402
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    start_http_server,
+)
+from prometheus_client import multiprocess  # noqa: E402
+
+FAST_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+LAG_BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.0, 5.0, 10.0, 30.0, 60.0, 300.0, 900.0, 3600.0)
+
+# Database pools (API workers and subscriber), labelled "primary" or the replica's host:port
+POOL_ACQUIRE_SECONDS = Histogram(
+    "pianoguard_db_pool_acquire_seconds", "Time spent waiting for a pool connection", ["pool"],
+    buckets=FAST_BUCKETS
+)
+POOL_CONNECTIONS = Gauge(
+    "pianoguard_db_pool_connections", "Pool connections by state, summed over live processes",
+    ["pool", "state"], multiprocess_mode="livesum"
+)
+REPLICA_LAG_SECONDS = Gauge(
+    "pianoguard_db_replica_lag_seconds", "Read replica replay lag at the last check, worst over live workers",
+    ["replica"], multiprocess_mode="livemax"
+)
+QUERY_SECONDS = Histogram(
+    "pianoguard_db_query_seconds", "Database query latency", ["query"],
+    buckets=FAST_BUCKETS
+)
+
+# API
+REQUEST_SECONDS = Histogram(
+    "pianoguard_http_request_seconds", "Request latency until response headers are sent",
+    ["method", "route", "status"], buckets=FAST_BUCKETS
+)
+
+# Ingest (subscriber)
+MESSAGES_RECEIVED = Counter("pianoguard_ingest_messages_received", "MQTT telemetry messages received")
+MESSAGES_INVALID = Counter("pianoguard_ingest_messages_invalid", "MQTT messages rejected as unparseable or invalid")
+ROWS_STORED = Counter("pianoguard_ingest_rows_stored", "Telemetry rows committed to the database")
+ROWS_DUPLICATE = Counter(
+    "pianoguard_ingest_rows_duplicate", "Telemetry rows skipped because their (device_id, timestamp) was already stored"
+)
+ROWS_SUPPRESSED = Counter(
+    "pianoguard_ingest_rows_suppressed", "Telemetry rows not stored because nothing changed (STORAGE_MODE=changes)"
+)
+ROWS_FAILED = Counter("pianoguard_ingest_rows_failed", "Telemetry rows that failed to write and could not be spooled")
+ROWS_SPOOLED = Counter("pianoguard_ingest_rows_spooled", "Telemetry rows written to the on-disk spool")
+ROWS_DROPPED = Counter("pianoguard_ingest_rows_dropped", "Telemetry rows dropped by the ingest queue overflow policy")
+QUEUE_DEPTH = Gauge(
+    "pianoguard_ingest_queue_depth", "Rows waiting in the ingest queue, summed over live instances",
+    multiprocess_mode="livesum"
+)
+SPOOL_BYTES = Gauge(
+    "pianoguard_ingest_spool_bytes", "Bytes waiting in the on-disk spool, summed over live instances",
+    multiprocess_mode="livesum"
+)
+BATCH_SECONDS = Histogram(
+    "pianoguard_ingest_batch_seconds", "Time to write one telemetry batch",
+    buckets=FAST_BUCKETS
+)
+ACKS_PENDING = Gauge(
+    "pianoguard_ingest_acks_pending",
+    "Queued rows whose MQTT ack waits for their batch to commit (MQTT_DELIVERY=at_least_once), summed over live instances",
+    multiprocess_mode="livesum"
+)
+INGEST_LAG_SECONDS = Histogram(
+    "pianoguard_ingest_lag_seconds", "Device timestamp to commit time per stored row",
+    buckets=LAG_BUCKETS
+)
+
+# Retention compactor (subscriber)
+COMPACTION_ROWS_DELETED = Counter(
+    "pianoguard_compaction_rows_deleted", "Rows deleted by the retention compactor, by tier (raw or rollup resolution)",
+    ["tier"]
+)
+COMPACTION_BYTES_RECLAIMED = Counter(
+    "pianoguard_compaction_bytes_reclaimed",
+    "Bytes reclaimed by the retention compactor: exact for dropped partitions, estimated for deleted rows",
+    ["method"]
+)
+COMPACTION_BACKLOG_SECONDS = Gauge(
+    "pianoguard_compaction_backlog_seconds", "Age of the oldest raw row beyond the raw retention window",
+    multiprocess_mode="livemax"
+)
+
+
+def registry() -> CollectorRegistry:
+    """Registry to expose - aggregated over all processes in multiprocess mode"""
+    if multiprocess_enabled():
+        collected = CollectorRegistry()
+        multiprocess.MultiProcessCollector(collected)
+        return collected
+    return REGISTRY
+
+
+def render() -> Tuple[bytes, str]:
+    """Metrics in the Prometheus text format and its content type, for a /metrics endpoint"""
+    return generate_latest(registry()), CONTENT_TYPE_LATEST
+
+
+def start_exporter(port: int) -> None:
+    """Serve /metrics on its own port from a background thread (for the subscriber)"""
+    start_http_server(port, registry=registry())
+
+
+def process_exited(pid: int) -> None:
+    """Drop a dead process's live gauges (multiprocess mode only)"""
+    if multiprocess_enabled():
+        multiprocess.mark_process_dead(pid)
+
+
+def multiprocess_enabled() -> bool:
+    return bool(os.environ.get("PROMETHEUS_MULTIPROC_DIR"))
+
+
+def record_pool(pool, name: str = "primary") -> None:
+    """Update the in-use / idle connection gauges from an asyncpg pool"""
+    idle = pool.get_idle_size()
+    POOL_CONNECTIONS.labels(name, "in_use").set(pool.get_size() - idle)
+    POOL_CONNECTIONS.labels(name, "idle").set(idle)
+
+
+class timed_query:
+    """Observe the wrapped query's latency under QUERY_SECONDS{query=name}
+
+    Works with both with and async with, so it can share an async with
+    statement with the connection it times.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.started = 0.0
+
+    def __enter__(self) -> None:
+        self.started = time.perf_counter()
+
+    def __exit__(self, *exc_info) -> None:
+        QUERY_SECONDS.labels(self.name).observe(time.perf_counter() - self.started)
+
+    async def __aenter__(self) -> None:
+        self.__enter__()
+
+    async def __aexit__(self, *exc_info) -> None:
+        self.__exit__(*exc_info)
@@ -0,0 +1,525 @@
+"""
+migrations.py
+
+Created on: 2026-10-17
+Edited on: 2026-10-17
+Author: R. Andrew Ballard (c) 2025 "Andwardo"
+Version: v1.0.0
+
+Versioned schema migrations for the PianoGuard database
+Run once per deploy; API workers and the MQTT subscriber only check the
+recorded version at startup and never run DDL themselves
+
+Usage:
+    python migrations.py            # apply pending migrations (same as "migrate")
+    python migrations.py migrate    # apply pending migrations
+    python migrations.py status     # show applied and pending migrations
+"""
+
+import asyncio
+import logging
+import sys
+from datetime import timedelta
+from typing import Awaitable, Callable, List, NamedTuple, Optional
+
+import asyncpg
+
+from partitions import PARENT_TABLE, convert_legacy_table, list_partitions, maintain_partitions
+from rollups import lock_rollup_days
+
+logger = logging.getLogger(__name__)
+
+VERSION_TABLE = "SchemaVersion"
+
+# Arbitrary constant so concurrent deploys apply migrations one at a time
+MIGRATION_LOCK_ID = 7420002
+
+# Monthly telemetry partitions created ahead of time by each migrate run
+MIGRATE_PARTITION_MONTHS_AHEAD = 3
+
+# Unique (device_id, timestamp) index on "TelemetryData" (migration 5), and how many
+# times a partition's build is retried when live ingest sneaks in a new duplicate
+TELEMETRY_KEY_INDEX = "telemetry_device_timestamp_key"
+TELEMETRY_KEY_ATTEMPTS = 3
+
+
+class SchemaVersionError(RuntimeError):
+    """The database schema is older than this code expects"""
+
+
+class Migration(NamedTuple):
+    version: int
+    name: str
+    apply: Callable[[asyncpg.Connection], Awaitable[None]]
+    # False for steps that can't run inside a transaction (e.g. CREATE INDEX CONCURRENTLY);
+    # those must be safe to re-run if interrupted
+    transactional: bool = True
+
+
+async def _column(conn: asyncpg.Connection, table: str, column: str) -> Optional[asyncpg.Record]:
+    return await conn.fetchrow("""
+        SELECT data_type, is_nullable = 'YES' AS nullable FROM information_schema.columns
+        WHERE table_schema = current_schema() AND table_name = $1 AND column_name = $2
+    """, table, column)
+
+
+async def _column_type(conn: asyncpg.Connection, table: str, column: str) -> Optional[str]:
+    info = await _column(conn, table, column)
+    return info["data_type"] if info else None
+
+
+async def _0001_baseline(conn: asyncpg.Connection) -> None:
+    """Tables as the write path expects them; no-op on an existing production database"""
+    # "userId" references the web application's "Users" table, which this service doesn't own
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS "Devices" (
+            id SERIAL PRIMARY KEY,
+            device_id VARCHAR(255) NOT NULL UNIQUE,
+            "userId" INTEGER,
+            friendly_name VARCHAR(255),
+            location VARCHAR(255),
+            last_seen TIMESTAMP WITH TIME ZONE,
+            status VARCHAR(255) DEFAULT 'offline',
+            "createdAt" TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            "updatedAt" TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+
+    # Range-partitioned by month on timestamp; the primary key must include the partition key.
+    # An existing monolithic table is left alone here and converted by migration 3
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS "TelemetryData" (
+            id SERIAL,
+            device_id VARCHAR(255) NOT NULL,
+            timestamp TIMESTAMP WITH TIME ZONE NOT NULL,
+            fw_version VARCHAR(50),
+            wifi_ssid VARCHAR(255),
+            wifi_rssi INTEGER,
+            uptime_ms BIGINT,
+            free_heap INTEGER,
+            battery_voltage REAL,
+            led_power BOOLEAN NOT NULL DEFAULT false,
+            led_water BOOLEAN NOT NULL DEFAULT false,
+            led_pads BOOLEAN NOT NULL DEFAULT false,
+            "createdAt" TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            "updatedAt" TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (id, timestamp),
+            FOREIGN KEY (device_id) REFERENCES "Devices" (device_id) ON DELETE CASCADE
+        ) PARTITION BY RANGE (timestamp)
+    """)
+
+    # (device_id, timestamp) also serves device_id-only lookups
+    await conn.execute("""
+        CREATE INDEX IF NOT EXISTS idx_telemetry_timestamp
+        ON "TelemetryData" (timestamp DESC)
+    """)
+    await conn.execute("""
+        CREATE INDEX IF NOT EXISTS idx_telemetry_device_timestamp
+        ON "TelemetryData" (device_id, timestamp DESC)
+    """)
+
+    # Incremental per-device aggregates, averages are sum / count at read time so buckets can be merged
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS "TelemetryRollups" (
+            device_id VARCHAR(255) NOT NULL,
+            resolution VARCHAR(8) NOT NULL,
+            bucket_start TIMESTAMP WITH TIME ZONE NOT NULL,
+            sample_count INTEGER NOT NULL,
+            battery_min REAL,
+            battery_max REAL,
+            battery_sum DOUBLE PRECISION NOT NULL DEFAULT 0,
+            battery_count INTEGER NOT NULL DEFAULT 0,
+            rssi_min INTEGER,
+            rssi_max INTEGER,
+            rssi_sum BIGINT NOT NULL DEFAULT 0,
+            rssi_count INTEGER NOT NULL DEFAULT 0,
+            heap_min INTEGER,
+            heap_max INTEGER,
+            heap_sum BIGINT NOT NULL DEFAULT 0,
+            heap_count INTEGER NOT NULL DEFAULT 0,
+            power_on INTEGER NOT NULL DEFAULT 0,
+            water_on INTEGER NOT NULL DEFAULT 0,
+            pads_on INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (device_id, resolution, bucket_start)
+        )
+    """)
+
+
+async def _0002_reconcile_legacy_columns(conn: asyncpg.Connection) -> None:
+    """Bring tables created by the old per-worker create_tables() in line with production
+
+    Those had BIGINT epoch timestamps and snake_case audit columns, which the
+    write path (to_timestamp(), "createdAt"/"updatedAt") can't insert into.
+    """
+    if await _column_type(conn, "Devices", "last_seen") == "bigint":
+        await conn.execute("""
+            ALTER TABLE "Devices"
+            ALTER COLUMN last_seen TYPE TIMESTAMP WITH TIME ZONE USING to_timestamp(last_seen)
+        """)
+        logger.info('Converted "Devices".last_seen to timestamptz')
+
+    if await _column_type(conn, "TelemetryData", "timestamp") == "bigint":
+        await conn.execute("""
+            ALTER TABLE "TelemetryData"
+            ALTER COLUMN timestamp TYPE TIMESTAMP WITH TIME ZONE USING to_timestamp(timestamp)
+        """)
+        logger.info('Converted "TelemetryData".timestamp to timestamptz')
+
+    for table in ("Devices", "TelemetryData"):
+        for old, new in (("created_at", "createdAt"), ("updated_at", "updatedAt")):
+            if await _column_type(conn, table, old) and not await _column_type(conn, table, new):
+                await conn.execute(f'ALTER TABLE "{table}" RENAME COLUMN {old} TO "{new}"')
+            await conn.execute(f"""
+                ALTER TABLE "{table}"
+                ADD COLUMN IF NOT EXISTS "{new}" TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT CURRENT_TIMESTAMP
+            """)
+
+    # Old schemas have nullable LEDs. They stay nullable: backfilling them would rewrite and
+    # lock the whole table, every read path COALESCEs them, and the write path never stores NULL
+    for column in ("led_power", "led_water", "led_pads"):
+        info = await _column(conn, "TelemetryData", column)
+        if info and info["nullable"]:
+            await conn.execute(f'ALTER TABLE "TelemetryData" ALTER COLUMN {column} SET DEFAULT false')
+
+
+async def _0003_partition_telemetry(conn: asyncpg.Connection) -> None:
+    """Convert a monolithic "TelemetryData" into a partitioned one (no-op if already partitioned)"""
+    await convert_legacy_table(conn)
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS "TelemetryData_default"
+        PARTITION OF "TelemetryData" DEFAULT
+    """)
+
+
+async def _0004_latest_telemetry(conn: asyncpg.Connection) -> None:
+    """Each device's newest telemetry row, maintained by the ingest path for /fleet and cold fills"""
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS "LatestTelemetry" (
+            device_id VARCHAR(255) PRIMARY KEY,
+            timestamp TIMESTAMP WITH TIME ZONE NOT NULL,
+            fw_version VARCHAR(50),
+            wifi_ssid VARCHAR(255),
+            wifi_rssi INTEGER,
+            uptime_ms BIGINT,
+            free_heap INTEGER,
+            battery_voltage REAL,
+            led_power BOOLEAN NOT NULL DEFAULT false,
+            led_water BOOLEAN NOT NULL DEFAULT false,
+            led_pads BOOLEAN NOT NULL DEFAULT false,
+            "updatedAt" TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (device_id) REFERENCES "Devices" (device_id) ON DELETE CASCADE
+        )
+    """)
+
+    # One index probe per device; rows the old subscriber writes meanwhile are
+    # picked up by the guarded upsert once the new one takes over
+    result = await conn.execute("""
+        INSERT INTO "LatestTelemetry" (
+            device_id, timestamp, fw_version, wifi_ssid, wifi_rssi,
+            uptime_ms, free_heap, battery_voltage,
+            led_power, led_water, led_pads
+        )
+        SELECT t.device_id, t.timestamp, t.fw_version, t.wifi_ssid, t.wifi_rssi,
+               t.uptime_ms, t.free_heap, t.battery_voltage,
+               COALESCE(t.led_power, false), COALESCE(t.led_water, false), COALESCE(t.led_pads, false)
+        FROM "Devices" d
+        CROSS JOIN LATERAL (
+            SELECT *
+            FROM "TelemetryData"
+            WHERE device_id = d.device_id
+            ORDER BY timestamp DESC
+            LIMIT 1
+        ) t
+        ON CONFLICT (device_id) DO NOTHING
+    """)
+    logger.info(f"Backfilled LatestTelemetry: {result}")
+
+
+# Migration 5 deduplicates with its own frozen copies of the dedupe.py / rollups.py SQL
+# as they stood when it was written, so replaying it does the same thing whatever those
+# modules become later
+_0005_CHUNK = timedelta(hours=24)
+_0005_RESOLUTIONS = {"1m": 60, "1h": 3600, "1d": 86400}
+
+_0005_DELETE_DUPLICATES_SQL = """
+    WITH duplicates AS (
+        SELECT id, timestamp
+        FROM (
+            SELECT id, timestamp,
+                   row_number() OVER (PARTITION BY device_id, timestamp ORDER BY id) AS copy
+            FROM "{table}"
+            WHERE timestamp >= $1 AND timestamp < $2
+        ) copies
+        WHERE copy > 1
+    )
+    DELETE FROM "{table}" t
+    USING duplicates d
+    WHERE t.id = d.id AND t.timestamp = d.timestamp
+"""
+
+_0005_REBUILD_ROLLUPS_SQL = """
+    INSERT INTO "TelemetryRollups" (
+        device_id, resolution, bucket_start, sample_count,
+        battery_min, battery_max, battery_sum, battery_count,
+        rssi_min, rssi_max, rssi_sum, rssi_count,
+        heap_min, heap_max, heap_sum, heap_count,
+        power_on, water_on, pads_on
+    )
+    SELECT device_id, $1,
+           to_timestamp(floor(EXTRACT(EPOCH FROM timestamp) / $2) * $2) AS bucket_start,
+           COUNT(*),
+           MIN(battery_voltage), MAX(battery_voltage),
+           COALESCE(SUM(battery_voltage), 0), COUNT(battery_voltage),
+           MIN(wifi_rssi), MAX(wifi_rssi), COALESCE(SUM(wifi_rssi), 0), COUNT(wifi_rssi),
+           MIN(free_heap), MAX(free_heap), COALESCE(SUM(free_heap), 0), COUNT(free_heap),
+           COUNT(*) FILTER (WHERE led_power),
+           COUNT(*) FILTER (WHERE led_water),
+           COUNT(*) FILTER (WHERE led_pads)
+    FROM "TelemetryData"
+    WHERE timestamp >= to_timestamp($3) AND timestamp < to_timestamp($4)
+    GROUP BY device_id, bucket_start
+    ON CONFLICT (device_id, resolution, bucket_start)
+    DO UPDATE SET
+        sample_count = EXCLUDED.sample_count,
+        battery_min = EXCLUDED.battery_min,
+        battery_max = EXCLUDED.battery_max,
+        battery_sum = EXCLUDED.battery_sum,
+        battery_count = EXCLUDED.battery_count,
+        rssi_min = EXCLUDED.rssi_min,
+        rssi_max = EXCLUDED.rssi_max,
+        rssi_sum = EXCLUDED.rssi_sum,
+        rssi_count = EXCLUDED.rssi_count,
+        heap_min = EXCLUDED.heap_min,
+        heap_max = EXCLUDED.heap_max,
+        heap_sum = EXCLUDED.heap_sum,
+        heap_count = EXCLUDED.heap_count,
+        power_on = EXCLUDED.power_on,
+        water_on = EXCLUDED.water_on,
+        pads_on = EXCLUDED.pads_on
+"""
+
+
+async def _0005_dedupe_partition(conn: asyncpg.Connection, table: str) -> None:
+    """Delete duplicates from one partition a day per transaction, then rebuild the affected days' rollups"""
+    bounds = await conn.fetchrow(f'SELECT MIN(timestamp) AS first, MAX(timestamp) AS last FROM "{table}"')
+    if bounds["first"] is None:
+        return
+
+    sql = _0005_DELETE_DUPLICATES_SQL.format(table=table)
+    day = _0005_RESOLUTIONS["1d"]
+    days = set()
+    total = 0
+    start = bounds["first"].replace(hour=0, minute=0, second=0, microsecond=0)
+    while start <= bounds["last"]:
+        end = start + _0005_CHUNK
+        found = int((await conn.execute(sql, start, end)).split()[-1])
+        if found:
+            first_day = int(start.timestamp()) // day * day
+            days.update(range(first_day, int(end.timestamp()), day))
+        total += found
+        start = end
+
+    for day_start in sorted(days):
+        for resolution, width in _0005_RESOLUTIONS.items():
+            async with conn.transaction():
+                # The lock is shared with whichever writer is live, so it isn't frozen with the SQL
+                await lock_rollup_days(conn, day_start, day_start + day)
+                await conn.execute(_0005_REBUILD_ROLLUPS_SQL, resolution, width, day_start, day_start + day)
+    if total:
+        logger.info(f'Deleted {total} duplicate telemetry rows in "{table}"')
+
+
+async def _0005_unique_telemetry_key(conn: asyncpg.Connection) -> None:
+    """Unique (device_id, timestamp) on "TelemetryData", so the write path can skip duplicates
+
+    A partitioned index can't be built CONCURRENTLY, so it is created on the
+    parent only (instantly, and inherited by any partition created from now
+    on), then each existing partition is deduplicated in chunks, gets its own
+    index built CONCURRENTLY and is attached. Writes are never blocked for
+    longer than a catalog update. Safe to re-run: finished partitions are
+    skipped and invalid leftovers from an interrupted build are rebuilt.
+    The unique index also serves every (device_id, timestamp) lookup, so the
+    old non-unique one is dropped.
+    """
+    await conn.execute(f"""
+        CREATE UNIQUE INDEX IF NOT EXISTS {TELEMETRY_KEY_INDEX}
+        ON ONLY "{PARENT_TABLE}" (device_id, timestamp)
+    """)
+
+    attached = {
+        row["relname"] for row in await conn.fetch("""
+            SELECT t.relname
+            FROM pg_inherits i
+            JOIN pg_index x ON x.indexrelid = i.inhrelid
+            JOIN pg_class t ON t.oid = x.indrelid
+            WHERE i.inhparent = to_regclass($1)
+        """, TELEMETRY_KEY_INDEX)
+    }
+
+    for partition, _ in await list_partitions(conn):
+        if partition in attached:
+            continue
+        index = f"{partition}_device_timestamp_key"
+        for attempt in range(1, TELEMETRY_KEY_ATTEMPTS + 1):
+            await _0005_dedupe_partition(conn, partition)
+            valid = await conn.fetchval(
+                "SELECT indisvalid FROM pg_index WHERE indexrelid = to_regclass($1)", f'"{index}"'
+            )
+            if valid is False:
+                await conn.execute(f'DROP INDEX CONCURRENTLY IF EXISTS "{index}"')
+            try:
+                await conn.execute(f"""
+                    CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS "{index}"
+                    ON "{partition}" (device_id, timestamp)
+                """)
+                break
+            except asyncpg.UniqueViolationError:
+                if attempt == TELEMETRY_KEY_ATTEMPTS:
+                    raise
+                logger.warning(f'New duplicates in "{partition}" during the index build, retrying')
+        await conn.execute(f'ALTER INDEX {TELEMETRY_KEY_INDEX} ATTACH PARTITION "{index}"')
+        logger.info(f'Unique (device_id, timestamp) index ready on "{partition}"')
+
+    if not await conn.fetchval(
+        "SELECT indisvalid FROM pg_index WHERE indexrelid = to_regclass($1)", TELEMETRY_KEY_INDEX
+    ):
+        raise RuntimeError(f"{TELEMETRY_KEY_INDEX} is still missing partitions, re-run the migration")
+
+    await conn.execute("DROP INDEX IF EXISTS idx_telemetry_device_timestamp")
+
+
+async def _0006_telemetry_compaction(conn: asyncpg.Connection) -> None:
+    """Single-row progress marker for compactor.py's tiered retention
+
+    Rollups of every day before compacted_before have been rebuilt from the
+    complete raw rows, so those raw rows may be deleted. Kept in the database
+    so an interrupted run never rebuilds a day from a partly deleted one.
+    """
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS "TelemetryCompaction" (
+            id BOOLEAN PRIMARY KEY DEFAULT true CHECK (id),
+            compacted_before TIMESTAMP WITH TIME ZONE NOT NULL,
+            "updatedAt" TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+
+
+# Append only: never edit or renumber a migration once it has been deployed
+MIGRATIONS: List[Migration] = [
+    Migration(1, "baseline", _0001_baseline),
+    Migration(2, "reconcile_legacy_columns", _0002_reconcile_legacy_columns),
+    Migration(3, "partition_telemetry", _0003_partition_telemetry, transactional=False),
+    Migration(4, "latest_telemetry", _0004_latest_telemetry),
+    Migration(5, "unique_telemetry_key", _0005_unique_telemetry_key, transactional=False),
+    Migration(6, "telemetry_compaction", _0006_telemetry_compaction),
+]
+
+# Schema version this code requires
+SCHEMA_VERSION = MIGRATIONS[-1].version
+
+
+async def current_version(conn: asyncpg.Connection) -> int:
+    """Highest applied migration, 0 for a database that has never been migrated"""
+    if not await conn.fetchval("SELECT to_regclass($1) IS NOT NULL", f'"{VERSION_TABLE}"'):
+        return 0
+    return await conn.fetchval(f'SELECT COALESCE(MAX(version), 0) FROM "{VERSION_TABLE}"')
+
+
+async def check_schema(conn: asyncpg.Connection) -> int:
+    """Startup check for workers: one cheap query, no DDL
+
+    Raises SchemaVersionError if migrations are pending. A newer schema is
+    accepted, so old workers keep running while a deploy rolls forward.
+    """
+    version = await current_version(conn)
+    if version < SCHEMA_VERSION:
+        raise SchemaVersionError(
+            f"Database schema is at version {version}, this code needs {SCHEMA_VERSION}; "
+            f"run 'python migrations.py' before starting"
+        )
+    if version > SCHEMA_VERSION:
+        logger.warning(f"Database schema version {version} is newer than this code ({SCHEMA_VERSION})")
+    return version
+
+
+async def migrate(conn: asyncpg.Connection, target: Optional[int] = None) -> List[int]:
+    """Apply pending migrations up to target (default: all), returns the versions applied
+
+    Holds an advisory lock for the whole run so two deploys can't interleave.
+    Each transactional migration commits together with its version row.
+    """
+    target = SCHEMA_VERSION if target is None else target
+    applied = []
+
+    await conn.execute("SELECT pg_advisory_lock($1)", MIGRATION_LOCK_ID)
+    try:
+        await conn.execute(f"""
+            CREATE TABLE IF NOT EXISTS "{VERSION_TABLE}" (
+                version INTEGER PRIMARY KEY,
+                name VARCHAR(255) NOT NULL,
+                "appliedAt" TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+        version = await current_version(conn)
+
+        for migration in MIGRATIONS:
+            if migration.version <= version or migration.version > target:
+                continue
+
+            logger.info(f"Applying migration {migration.version:04d} {migration.name}")
+            record = f'INSERT INTO "{VERSION_TABLE}" (version, name) VALUES ($1, $2)'
+            if migration.transactional:
+                async with conn.transaction():
+                    await migration.apply(conn)
+                    await conn.execute(record, migration.version, migration.name)
+            else:
+                await migration.apply(conn)
+                await conn.execute(record, migration.version, migration.name)
+            applied.append(migration.version)
+
+        # Partitions are data-dependent rather than versioned; the subscriber keeps them
+        # current afterwards, this just makes sure a fresh database can take writes
+        await maintain_partitions(conn, months_ahead=MIGRATE_PARTITION_MONTHS_AHEAD)
+    finally:
+        await conn.execute("SELECT pg_advisory_unlock($1)", MIGRATION_LOCK_ID)
+
+    if applied:
+        logger.info(f"Schema migrated to version {applied[-1]}")
+    else:
+        logger.info(f"Schema is up to date at version {version}")
+    return applied
+
+
+async def _status(conn: asyncpg.Connection) -> None:
+    version = await current_version(conn)
+    print(f"Schema version {version}, code expects {SCHEMA_VERSION}")
+    for migration in MIGRATIONS:
+        state = "applied" if migration.version <= version else "pending"
+        print(f"  {migration.version:04d} {migration.name:<32} {state}")
+
+
+async def _main(command: str) -> None:
+    from env import DB_HOST, DB_PORT, DB_NAME, DB_USER, DB_PASSWORD
+
+    conn = await asyncpg.connect(
+        host=DB_HOST,
+        port=int(DB_PORT),
+        database=DB_NAME,
+        user=DB_USER,
+        password=DB_PASSWORD
+    )
+    try:
+        if command == "status":
+            await _status(conn)
+        else:
+            await migrate(conn)
+    finally:
+        await conn.close()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    if len(sys.argv) > 2 or (len(sys.argv) == 2 and sys.argv[1] not in ("migrate", "status")):
+        print(__doc__)
+        sys.exit(1)
+    asyncio.run(_main(sys.argv[1] if len(sys.argv) == 2 else "migrate"))
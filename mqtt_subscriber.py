@@ -2,9 +2,9 @@
 mqtt_subscriber.py
 
 Created on: 2025-10-30
-Edited on: 2025-10-30
+Edited on: 2026-10-17
 Author: R. Andrew Ballard (c) 2025 "Andwardo"
-Version: v1.0.0
+Version: v1.12.0
 
 MQTT Subscriber Service for PianoGuard Telemetry
 Subscribes to MQTT broker and stores telemetry data in PostgreSQL database
@@ -13,26 +13,53 @@ Subscribes to MQTT broker and stores telemetry data in PostgreSQL database
 import asyncio
 import json
 import logging
+import os
+import multiprocessing
 import signal
+import socket
 import ssl
 import sys
-from typing import Dict, Any, Optional
-from datetime import datetime
+import time
+from typing import Dict, Optional
 
 import asyncpg
 import paho.mqtt.client as mqtt
 from paho.mqtt.client import CallbackAPIVersion
+from paho.mqtt.packettypes import PacketTypes
+from paho.mqtt.properties import Properties
 from dotenv import load_dotenv
 
+from change_filter import STORAGE_CHANGES, STORAGE_MODES, DEFAULT_DEADBANDS, ChangeFilter, parse_deadbands
+from compactor import Compactor, parse_retention
+from dedupe import RecentKeyFilter
+from delivery import DELIVERY_AT_LEAST_ONCE, DELIVERY_MODES, MAX_RECEIVE_MAXIMUM, AckTracker
 from env import DB_HOST, DB_PORT, DB_NAME, DB_USER, DB_PASSWORD
+from ingest_queue import POLICY_BLOCK, IngestQueue
+from log_pipeline import QueueLogging, excerpt, log_limiter
+from metrics import (
+    MESSAGES_INVALID,
+    MESSAGES_RECEIVED,
+    QUEUE_DEPTH,
+    ACKS_PENDING,
+    ROWS_DUPLICATE,
+    SPOOL_BYTES,
+    multiprocess_enabled,
+    process_exited,
+    record_pool,
+    start_exporter,
+)
+from migrations import check_schema
+from partitions import maintain_partitions
+from spool import Spool, SpoolReplayer
+from telemetry_writer import TelemetryBatchWriter, check_row, row_key, telemetry_row
 
-# Configure logging
+# Configure logging - each instance moves these handlers behind a queue (see run_instance)
 logging.basicConfig(
     level=logging.INFO,
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
     handlers=[
         logging.StreamHandler(sys.stdout),
-        logging.FileHandler('/var/log/mqtt-subscriber.log')
+        logging.FileHandler(os.getenv("MQTT_SUBSCRIBER_LOG", "/var/log/mqtt-subscriber.log"))
     ]
 )
 logger = logging.getLogger(__name__)
@@ -41,19 +68,107 @@ logger = logging.getLogger(__name__)
 load_dotenv()
 
 # MQTT Configuration
-MQTT_BROKER = "localhost"
-MQTT_PORT = 1883  # Using non-TLS port for testing
+MQTT_BROKER = os.getenv("MQTT_BROKER", "localhost")
+MQTT_PORT = int(os.getenv("MQTT_PORT", "1883"))  # Using non-TLS port for testing
 MQTT_TOPIC = "pianoguard/+/telemetry"
 MQTT_CA_CERT = "/etc/mosquitto/mosquitto.crt"
 MQTT_USERNAME = "dcm_client"
 MQTT_PASSWORD = "secure_mqtt_pass"
 USE_TLS = False  # Disable TLS for testing
 
+# Delivery guarantee is one of: at_most_once (QoS 0, clean session), at_least_once (QoS 1 on a
+# persistent MQTT v5 session, each message acked only once the batch holding it is committed or spooled)
+MQTT_DELIVERY = os.getenv("MQTT_DELIVERY", "at_most_once")
+MQTT_SESSION_EXPIRY = int(os.getenv("MQTT_SESSION_EXPIRY", "86400"))  # seconds the broker keeps a disconnected session
+# Unacked messages the broker may have in flight to an instance (at_least_once only), capped at INGEST_QUEUE_SIZE
+MQTT_RECEIVE_MAXIMUM = int(os.getenv("MQTT_RECEIVE_MAXIMUM", "1000"))
+# Seconds before reconnecting to have messages of an abandoned batch redelivered (at_least_once only)
+REDELIVERY_DELAY = 5.0
+
+# Scale-out configuration
+# With a share group set, instances connect with MQTT v5 and unique client ids and
+# subscribe to $share/<group>/<topic> so the broker splits messages between them
+SUBSCRIBER_INSTANCES = os.getenv("SUBSCRIBER_INSTANCES", "1")  # number or "auto" (one per core)
+MQTT_SHARE_GROUP = os.getenv("MQTT_SHARE_GROUP", "")
+MQTT_CLIENT_ID = "pianoguard_subscriber"
+SUPERVISOR_RESTART_DELAY = 10  # seconds
+
+# Telemetry partition maintenance - retention of 0 keeps partitions forever
+# Retention action is one of: detach, drop
+TELEMETRY_PARTITION_MONTHS_AHEAD = int(os.getenv("TELEMETRY_PARTITION_MONTHS_AHEAD", "3"))
+TELEMETRY_RETENTION_MONTHS = int(os.getenv("TELEMETRY_RETENTION_MONTHS", "0"))
+TELEMETRY_RETENTION_ACTION = os.getenv("TELEMETRY_RETENTION_ACTION", "detach")
+PARTITION_MAINTENANCE_INTERVAL = int(os.getenv("PARTITION_MAINTENANCE_INTERVAL", "3600"))  # seconds
+
+# Tiered retention (compactor.py): raw rows are kept RAW_RETENTION_DAYS, then only as rollups,
+# which expire per resolution after ROLLUP_RETENTION_DAYS - 0 / unset keeps a tier forever.
+# Deletes run in chunks with a pause between them, waiting while replicas lag behind
+RAW_RETENTION_DAYS = int(os.getenv("RAW_RETENTION_DAYS", "0"))
+ROLLUP_RETENTION_DAYS = os.getenv("ROLLUP_RETENTION_DAYS", "")  # resolution=days,... e.g. 1m=30,1h=730
+COMPACTION_INTERVAL = int(os.getenv("COMPACTION_INTERVAL", "3600"))  # seconds
+COMPACTION_CHUNK_ROWS = int(os.getenv("COMPACTION_CHUNK_ROWS", "5000"))
+COMPACTION_CHUNK_PAUSE = float(os.getenv("COMPACTION_CHUNK_PAUSE", "0.5"))  # seconds
+COMPACTION_MAX_REPLICATION_LAG = float(os.getenv("COMPACTION_MAX_REPLICATION_LAG", "10"))  # seconds, 0 disables
+
+# Database pool sizing, per subscriber instance
+DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", "2"))
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", "10"))
+
+# Batch writer configuration - a batch is flushed when either limit is reached
+INGEST_BATCH_SIZE = int(os.getenv("INGEST_BATCH_SIZE", "500"))
+INGEST_BATCH_LATENCY = float(os.getenv("INGEST_BATCH_LATENCY", "1.0"))  # seconds
+
+# Ingest queue between the MQTT thread and the writer
+# Overflow policy is one of: block, drop_oldest, spill
+INGEST_QUEUE_SIZE = int(os.getenv("INGEST_QUEUE_SIZE", "10000"))
+INGEST_OVERFLOW_POLICY = os.getenv("INGEST_OVERFLOW_POLICY", "block")
+INGEST_BLOCK_TIMEOUT = float(os.getenv("INGEST_BLOCK_TIMEOUT", "30"))  # seconds
+INGEST_STATS_INTERVAL = int(os.getenv("INGEST_STATS_INTERVAL", "60"))  # seconds
+
+# Durable spool for rows that overflow the queue or fail to write, and its replay rate
+SPOOL_DIR = os.getenv("SPOOL_DIR", "spool")
+SPOOL_SEGMENT_MB = int(os.getenv("SPOOL_SEGMENT_MB", "64"))
+SPOOL_FSYNC = os.getenv("SPOOL_FSYNC", "False").lower() == "true"
+SPOOL_REPLAY_BATCH_SIZE = int(os.getenv("SPOOL_REPLAY_BATCH_SIZE", "5000"))
+SPOOL_REPLAY_RATE = float(os.getenv("SPOOL_REPLAY_RATE", "5000"))  # rows per second
+
+# Storage mode is one of: all (every message is a row), changes (a row only when a field
+# moves beyond its deadband, the device reboots, or CHANGE_MAX_INTERVAL passes)
+STORAGE_MODE = os.getenv("STORAGE_MODE", "all")
+CHANGE_MAX_INTERVAL = float(os.getenv("CHANGE_MAX_INTERVAL", "300"))  # seconds
+CHANGE_DEADBANDS = os.getenv("CHANGE_DEADBANDS", DEFAULT_DEADBANDS)  # field=amount,...
+
+# Recently queued (device_id, timestamp) keys remembered to drop redeliveries before
+# they reach the database (which rejects duplicates anyway), 0 disables the filter
+DEDUPE_RECENT_KEYS = int(os.getenv("DEDUPE_RECENT_KEYS", "100000"))
+
+# Logging: records queued for the background writer thread before new ones are dropped,
+# and seconds between repeats of the same warning or error (the rest are counted)
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+LOG_REPEAT_INTERVAL = float(os.getenv("LOG_REPEAT_INTERVAL", "10"))
+
+# Prometheus exporter port for subscriber metrics, 0 disables it
+# With more than one instance, PROMETHEUS_MULTIPROC_DIR must be set so the supervisor can aggregate them
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9101"))
+
 # Global database pool and event loop
 db_pool: Optional[asyncpg.Pool] = None
+ingest_queue: Optional[IngestQueue] = None
+telemetry_writer: Optional[TelemetryBatchWriter] = None
+telemetry_spool: Optional[Spool] = None
 mqtt_client: Optional[mqtt.Client] = None
+message_acks: Optional[AckTracker] = None
+redelivery_task: Optional[asyncio.Task] = None
 event_loop: Optional[asyncio.AbstractEventLoop] = None
 running = True
+instance_id: Optional[int] = None
+recent_keys = RecentKeyFilter(max_keys=DEDUPE_RECENT_KEYS)
+log_pipeline = QueueLogging(maxsize=LOG_QUEUE_SIZE)
+log_limiter.interval = LOG_REPEAT_INTERVAL
+
+# Message counts for the periodic throughput summary (written by the MQTT thread only)
+messages_received = 0
+messages_invalid = 0
 
 
 async def init_db_pool():
@@ -67,11 +182,15 @@ async def init_db_pool():
             database=DB_NAME,
             user=DB_USER,
             password=DB_PASSWORD,
-            min_size=2,
-            max_size=10,
+            min_size=DB_POOL_MIN_SIZE,
+            max_size=DB_POOL_MAX_SIZE,
             command_timeout=60
         )
-        logger.info("Database connection pool initialized")
+        logger.info(f"Database connection pool initialized (size {DB_POOL_MIN_SIZE}-{DB_POOL_MAX_SIZE})")
+
+        async with db_pool.acquire() as conn:
+            version = await check_schema(conn)
+        logger.info(f"Database schema version {version}")
     except Exception as e:
         logger.error(f"Failed to initialize database pool: {e}")
         raise
@@ -85,62 +204,80 @@ async def close_db_pool():
         logger.info("Database connection pool closed")
 
 
-async def store_telemetry(data: Dict[str, Any]) -> None:
-    """Store telemetry data in PostgreSQL database"""
-    if not db_pool:
-        logger.error("Database pool not initialized")
-        return
+async def partition_maintenance():
+    """Keep upcoming telemetry partitions created and expire old ones"""
+    while running:
+        try:
+            async with db_pool.acquire() as conn:
+                await maintain_partitions(
+                    conn,
+                    months_ahead=TELEMETRY_PARTITION_MONTHS_AHEAD,
+                    retention_months=TELEMETRY_RETENTION_MONTHS,
+                    action=TELEMETRY_RETENTION_ACTION
+                )
+        except Exception as e:
+            logger.error(f"Partition maintenance failed: {e}")
+        await asyncio.sleep(PARTITION_MAINTENANCE_INTERVAL)
 
-    try:
-        async with db_pool.acquire() as conn:
-            # Upsert device info with online status
-            await conn.execute("""
-                INSERT INTO "Devices" (device_id, last_seen, "createdAt", "updatedAt")
-                VALUES ($1, to_timestamp($2), CURRENT_TIMESTAMP, CURRENT_TIMESTAMP)
-                ON CONFLICT (device_id)
-                DO UPDATE SET
-                    last_seen = EXCLUDED.last_seen,
-                    "updatedAt" = CURRENT_TIMESTAMP
-            """,
-                data.get("device_id"),
-                data.get("timestamp")
-            )
 
-            # Insert telemetry data
-            await conn.execute("""
-                INSERT INTO "TelemetryData" (
-                    device_id, timestamp, fw_version, wifi_ssid, wifi_rssi,
-                    uptime_ms, free_heap, battery_voltage,
-                    led_power, led_water, led_pads,
-                    "createdAt", "updatedAt"
-                )
-                VALUES ($1, to_timestamp($2), $3, $4, $5, $6, $7, $8, $9, $10, $11, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP)
-            """,
-                data.get("device_id"),
-                data.get("timestamp"),
-                data.get("fw_version"),
-                data.get("wifi_ssid"),
-                data.get("wifi_rssi"),
-                data.get("uptime_ms"),
-                data.get("free_heap"),
-                data.get("battery_voltage"),
-                data.get("status", {}).get("power") if isinstance(data.get("status"), dict) else False,
-                data.get("status", {}).get("water") if isinstance(data.get("status"), dict) else False,
-                data.get("status", {}).get("pads") if isinstance(data.get("status"), dict) else False
-            )
+def subscription_topic() -> str:
+    """Topic filter to subscribe to, as a shared subscription when a share group is set"""
+    if MQTT_SHARE_GROUP:
+        return f"$share/{MQTT_SHARE_GROUP}/{MQTT_TOPIC}"
+    return MQTT_TOPIC
 
-            logger.info(f"Stored telemetry for device {data.get('device_id')}")
 
-    except Exception as e:
-        logger.error(f"Failed to store telemetry: {e}")
+def at_least_once() -> bool:
+    return MQTT_DELIVERY == DELIVERY_AT_LEAST_ONCE
+
+
+def client_id() -> str:
+    """MQTT client id - must be unique per instance when subscriptions are shared"""
+    if MQTT_SHARE_GROUP and at_least_once():
+        # The broker resumes a persistent session by client id, so it has to survive a restart
+        return f"{MQTT_CLIENT_ID}-{socket.gethostname()}-{instance_id or 0}"
+    if MQTT_SHARE_GROUP:
+        return f"{MQTT_CLIENT_ID}-{socket.gethostname()}-{os.getpid()}"
+    return MQTT_CLIENT_ID
+
+
+def receive_maximum() -> int:
+    """In-flight limit sent to the broker - never more rows than the ingest queue holds"""
+    return max(1, min(MQTT_RECEIVE_MAXIMUM, INGEST_QUEUE_SIZE, MAX_RECEIVE_MAXIMUM))
+
+
+def connect_properties() -> Optional[Properties]:
+    """MQTT v5 CONNECT properties for a persistent, flow-controlled session (at_least_once only)"""
+    if not at_least_once():
+        return None
+    properties = Properties(PacketTypes.CONNECT)
+    properties.SessionExpiryInterval = MQTT_SESSION_EXPIRY
+    properties.ReceiveMaximum = receive_maximum()
+    return properties
+
+
+def spool_dir() -> str:
+    """Spool directory for this instance, so supervised instances never share segments"""
+    if instance_id is None:
+        return SPOOL_DIR
+    return os.path.join(SPOOL_DIR, f"instance-{instance_id}")
+
+
+def spill_to_spool(row) -> None:
+    """Append an overflowed telemetry row to the spool"""
+    telemetry_spool.append([row])
 
 
 def on_connect(client, userdata, flags, reason_code, properties):
     """MQTT connection callback (API v2)"""
     if reason_code == 0:
-        logger.info(f"Connected to MQTT broker at {MQTT_BROKER}:{MQTT_PORT}")
-        client.subscribe(MQTT_TOPIC)
-        logger.info(f"Subscribed to topic: {MQTT_TOPIC}")
+        logger.info(f"Connected to MQTT broker at {MQTT_BROKER}:{MQTT_PORT} (session present: {flags.session_present})")
+        if message_acks is not None:
+            message_acks.new_session()
+        topic = subscription_topic()
+        qos = 1 if at_least_once() else 0
+        client.subscribe(topic, qos=qos)
+        logger.info(f"Subscribed to topic: {topic} (QoS {qos})")
     else:
         logger.error(f"Failed to connect to MQTT broker, reason code: {reason_code}")
 
@@ -153,37 +290,142 @@ def on_disconnect(client, userdata, disconnect_flags, reason_code, properties):
         logger.info("Disconnected from MQTT broker")
 
 
+def request_redelivery() -> None:
+    """Writer callback after it abandoned rows: reconnect soon, unless a reconnect is already pending"""
+    global redelivery_task
+    if running and (redelivery_task is None or redelivery_task.done()):
+        redelivery_task = asyncio.create_task(redeliver())
+
+
+async def redeliver() -> None:
+    """Resume the MQTT session on a new connection, so the broker redelivers the abandoned messages
+
+    Unacked QoS 1 messages are only redelivered on a new connection, and
+    until then they hold the broker's in-flight window (Receive Maximum), so
+    enough of them would stall ingest. The delay keeps a database outage
+    from turning into a reconnect loop.
+    """
+    def reconnect() -> None:
+        # loop_stop() joins the network thread, which may be waiting on the full ingest queue
+        mqtt_client.disconnect()
+        mqtt_client.loop_stop()
+        mqtt_client.reconnect()
+        mqtt_client.loop_start()
+
+    await asyncio.sleep(REDELIVERY_DELAY)
+    while running:
+        logger.warning("Reconnecting to the MQTT broker to have abandoned messages redelivered")
+        try:
+            await asyncio.to_thread(reconnect)
+            return
+        except OSError as e:
+            log_limiter.log(logger, logging.ERROR, "redeliver", f"Failed to reconnect to the MQTT broker: {e}")
+        await asyncio.sleep(REDELIVERY_DELAY)
+
+
 def on_message(client, userdata, msg):
-    """MQTT message callback"""
+    """MQTT message callback
+
+    Runs once per message on the MQTT network thread: nothing here logs on
+    success, and failures go through log_limiter with payloads cut short.
+    With manual acks, a message whose row was queued is acked by the writer
+    once the row is settled; any other message is acked behind the rows
+    queued before it.
+    """
+    global messages_received, messages_invalid
+    messages_received += 1
+    MESSAGES_RECEIVED.inc()
+    tracked = False
     try:
         # Parse JSON payload
         payload = json.loads(msg.payload.decode())
-        logger.debug(f"Received message on topic {msg.topic}: {payload}")
 
         # Validate required fields
         required_fields = ["device_id", "timestamp"]
         if not all(field in payload for field in required_fields):
-            logger.warning(f"Missing required fields in payload: {payload}")
+            log_limiter.log(logger, logging.WARNING, "missing_fields",
+                            f"Missing required fields in payload on topic {msg.topic}: {excerpt(payload)}")
+            messages_invalid += 1
+            MESSAGES_INVALID.inc()
             return
 
-        # Store telemetry asynchronously from MQTT thread
-        if event_loop:
-            asyncio.run_coroutine_threadsafe(store_telemetry(payload), event_loop)
+        row = telemetry_row(payload)
+        # A value outside the column limits would fail the whole batch it lands in
+        check_row(row)
+        key = row_key(row)
+        if recent_keys.seen(key):
+            ROWS_DUPLICATE.inc()
+            return
 
-    except json.JSONDecodeError as e:
-        logger.error(f"Failed to parse JSON payload: {e}")
+        # The row's ack entry has to exist before the writer can take the row off the queue
+        if message_acks is not None:
+            message_acks.track(msg.mid, msg.qos)
+            tracked = True
+
+        # Hand the row to the batch writer; blocks or sheds load when the queue is full.
+        # Only rows the queue took are remembered, so a redelivery of a dropped row gets through
+        if ingest_queue and ingest_queue.put(row):
+            recent_keys.add(key)
+
+    except (json.JSONDecodeError, UnicodeDecodeError) as e:
+        log_limiter.log(logger, logging.WARNING, "unparseable", f"Failed to parse payload on topic {msg.topic}: {e}")
+        messages_invalid += 1
+        MESSAGES_INVALID.inc()
+    except (ValueError, TypeError, OverflowError) as e:
+        log_limiter.log(logger, logging.WARNING, "invalid", f"Invalid telemetry payload on topic {msg.topic}: {excerpt(e)}")
+        messages_invalid += 1
+        MESSAGES_INVALID.inc()
     except Exception as e:
-        logger.error(f"Error processing message: {e}")
+        log_limiter.log(logger, logging.ERROR, "error", f"Error processing message on topic {msg.topic}: {excerpt(e)}")
+    finally:
+        if message_acks is not None and not tracked:
+            message_acks.done(msg.mid, msg.qos)
+
+
+def throughput_summary(previous: Dict[str, int], elapsed: float) -> str:
+    """One log line of per-second ingest rates since the previous summary (previous is updated)"""
+    writer = telemetry_writer.stats()
+    queue_stats = ingest_queue.stats()
+    current = {
+        "received": messages_received,
+        "stored": writer["rows_written"],
+        "duplicate": writer["rows_duplicate"] + recent_keys.duplicates,
+        "suppressed": writer["rows_suppressed"],
+        "invalid": messages_invalid,
+        "dropped": queue_stats["dropped"],
+        "spooled": writer["rows_spooled"] + queue_stats["spilled"],
+        "failed": writer["rows_failed"],
+    }
+    rates = {name: (count - previous.get(name, 0)) / elapsed for name, count in current.items()}
+    previous.update(current)
+    return (
+        f"Ingest {rates['received']:.1f} msg/s, stored {rates['stored']:.1f} rows/s "
+        f"(duplicate {rates['duplicate']:.1f}/s, suppressed {rates['suppressed']:.1f}/s, "
+        f"invalid {rates['invalid']:.1f}/s, dropped {rates['dropped']:.1f}/s, spooled {rates['spooled']:.1f}/s, "
+        f"failed {rates['failed']:.1f}/s); queue {queue_stats['depth']}, "
+        f"spool {telemetry_spool.size_bytes()} bytes, last batch {writer['last_flush_seconds']}s, "
+        f"log lines suppressed {log_limiter.suppressed}, dropped {log_pipeline.dropped}"
+    )
 
 
 def setup_mqtt_client() -> mqtt.Client:
     """Setup and configure MQTT client"""
     # Use CallbackAPIVersion.VERSION2 to fix deprecation warning
-    client = mqtt.Client(
-        callback_api_version=CallbackAPIVersion.VERSION2,
-        client_id="pianoguard_subscriber",
-        clean_session=True
-    )
+    if MQTT_SHARE_GROUP or at_least_once():
+        # Shared subscriptions, session expiry and receive maximum need MQTT v5,
+        # which uses clean_start on connect instead of clean_session
+        client = mqtt.Client(
+            callback_api_version=CallbackAPIVersion.VERSION2,
+            client_id=client_id(),
+            protocol=mqtt.MQTTv5,
+            manual_ack=at_least_once()
+        )
+    else:
+        client = mqtt.Client(
+            callback_api_version=CallbackAPIVersion.VERSION2,
+            client_id=client_id(),
+            clean_session=True
+        )
 
     # Set callbacks
     client.on_connect = on_connect
@@ -225,7 +467,7 @@ def signal_handler(signum, frame):
 
 async def main():
     """Main event loop"""
-    global mqtt_client, running, event_loop
+    global mqtt_client, running, event_loop, ingest_queue, telemetry_writer, telemetry_spool, message_acks
 
     # Store event loop reference for MQTT callbacks
     event_loop = asyncio.get_running_loop()
@@ -234,33 +476,149 @@ async def main():
     signal.signal(signal.SIGINT, signal_handler)
     signal.signal(signal.SIGTERM, signal_handler)
 
-    logger.info("Starting PianoGuard MQTT Subscriber Service")
+    logger.info(f"Starting PianoGuard MQTT Subscriber Service (client id {client_id()})")
 
     try:
         # Initialize database connection pool
         await init_db_pool()
 
-        # Setup MQTT client
+        # Open the spool first - it takes rows the queue or the database can't
+        telemetry_spool = Spool(
+            spool_dir(),
+            segment_max_bytes=SPOOL_SEGMENT_MB * 1024 * 1024,
+            fsync=SPOOL_FSYNC
+        )
+
+        if MQTT_DELIVERY not in DELIVERY_MODES:
+            raise ValueError(f"Unknown delivery mode: {MQTT_DELIVERY}")
+        if at_least_once() and INGEST_OVERFLOW_POLICY != POLICY_BLOCK:
+            # A row dropped or spilled by the queue would leave its ack entry behind
+            raise ValueError("at_least_once delivery needs INGEST_OVERFLOW_POLICY=block")
+
+        # Setup MQTT client; acks are tracked from the first message on
         mqtt_client = setup_mqtt_client()
+        if at_least_once():
+            message_acks = AckTracker(mqtt_client, on_abandon=request_redelivery)
+            logger.info(f"At-least-once delivery: QoS 1, session expiry {MQTT_SESSION_EXPIRY}s, "
+                        f"receive maximum {receive_maximum()}")
+
+        # Start the ingest queue and batch writer before any messages can arrive.
+        # With manual acks the broker never has more messages in flight than the queue
+        # holds, so the MQTT thread only waits on a full queue without dropping
+        ingest_queue = IngestQueue(
+            event_loop,
+            maxsize=INGEST_QUEUE_SIZE,
+            policy=INGEST_OVERFLOW_POLICY,
+            block_timeout=None if at_least_once() else INGEST_BLOCK_TIMEOUT,
+            spill=spill_to_spool
+        )
+        if STORAGE_MODE not in STORAGE_MODES:
+            raise ValueError(f"Unknown storage mode: {STORAGE_MODE}")
+        change_filter = None
+        if STORAGE_MODE == STORAGE_CHANGES:
+            change_filter = ChangeFilter(CHANGE_MAX_INTERVAL, parse_deadbands(CHANGE_DEADBANDS))
+            logger.info(f"Storing changes only: deadbands {CHANGE_DEADBANDS}, max interval {CHANGE_MAX_INTERVAL}s")
+        telemetry_writer = TelemetryBatchWriter(
+            db_pool,
+            ingest_queue,
+            max_rows=INGEST_BATCH_SIZE,
+            max_latency=INGEST_BATCH_LATENCY,
+            spool=telemetry_spool,
+            changes=change_filter,
+            acks=message_acks,
+            recent_keys=recent_keys
+        )
+        writer_task = asyncio.create_task(telemetry_writer.run())
+
+        # Replay spooled rows in the background, backing off while the live queue is busy
+        spool_replayer = SpoolReplayer(
+            telemetry_spool,
+            db_pool,
+            batch_size=SPOOL_REPLAY_BATCH_SIZE,
+            rows_per_second=SPOOL_REPLAY_RATE,
+            live_busy=lambda: ingest_queue.depth > INGEST_BATCH_SIZE
+        )
+        replayer_task = asyncio.create_task(spool_replayer.run())
+
+        maintenance_task = asyncio.create_task(partition_maintenance())
+
+        # Tiered retention; with several instances the advisory lock lets only one compact
+        compactor = Compactor(
+            raw_days=RAW_RETENTION_DAYS,
+            rollup_days=parse_retention(ROLLUP_RETENTION_DAYS),
+            chunk_rows=COMPACTION_CHUNK_ROWS,
+            chunk_pause=COMPACTION_CHUNK_PAUSE,
+            max_replication_lag=COMPACTION_MAX_REPLICATION_LAG,
+            rebuild=STORAGE_MODE != STORAGE_CHANGES
+        )
+        compaction_task = None
+        if compactor.enabled:
+            logger.info(f"Compacting telemetry: raw for {RAW_RETENTION_DAYS or 'forever'} days, "
+                        f"rollups {ROLLUP_RETENTION_DAYS or 'forever'}")
+            compaction_task = asyncio.create_task(compactor.run(db_pool, COMPACTION_INTERVAL))
 
         # Connect to MQTT broker
         logger.info(f"Connecting to MQTT broker at {MQTT_BROKER}:{MQTT_PORT}")
-        mqtt_client.connect(MQTT_BROKER, MQTT_PORT, keepalive=60)
+        if at_least_once():
+            # Resume the persistent session, so messages that arrived while we were away are delivered
+            mqtt_client.connect(MQTT_BROKER, MQTT_PORT, keepalive=60, clean_start=False,
+                                properties=connect_properties())
+        elif MQTT_SHARE_GROUP:
+            mqtt_client.connect(MQTT_BROKER, MQTT_PORT, keepalive=60, clean_start=True)
+        else:
+            mqtt_client.connect(MQTT_BROKER, MQTT_PORT, keepalive=60)
 
         # Start MQTT loop in separate thread
         mqtt_client.loop_start()
 
-        # Keep service running
+        # Keep service running, updating gauges and logging a throughput summary periodically
+        last_stats = event_loop.time()
+        summary_counts: Dict[str, int] = {}
         while running:
             await asyncio.sleep(1)
+            QUEUE_DEPTH.set(ingest_queue.depth)
+            SPOOL_BYTES.set(telemetry_spool.size_bytes())
+            record_pool(db_pool)
+            if message_acks is not None:
+                ACKS_PENDING.set(len(message_acks))
+            if event_loop.time() - last_stats >= INGEST_STATS_INTERVAL:
+                elapsed = event_loop.time() - last_stats
+                last_stats = event_loop.time()
+                logger.info(throughput_summary(summary_counts, elapsed))
 
         logger.info("Shutting down service...")
 
-        # Cleanup
+        # Cleanup - stop reading messages, but stay connected until the writer has drained,
+        # so the acks of the last batches still reach the broker. loop_stop() joins the
+        # network thread, which may be waiting on the full ingest queue: join it off the
+        # event loop so the writer keeps draining the queue meanwhile
+        if redelivery_task is not None:
+            redelivery_task.cancel()
+        if mqtt_client:
+            await asyncio.to_thread(mqtt_client.loop_stop)
+
+        maintenance_task.cancel()
+        if compaction_task:
+            compactor.stop()
+            await compaction_task
+
+        # Flush whatever is still buffered before closing the pool
+        await spool_replayer.stop()
+        await replayer_task
+        await telemetry_writer.stop()
+        await writer_task
+        telemetry_spool.close()
+        logger.info(f"Telemetry writer stopped: {telemetry_writer.stats()}")
+
         if mqtt_client:
-            mqtt_client.loop_stop()
             mqtt_client.disconnect()
             logger.info("MQTT client disconnected")
+        logger.info(
+            f"Totals: queue={ingest_queue.stats()} spool={spool_replayer.stats()} "
+            f"messages_received={messages_received} messages_invalid={messages_invalid} "
+            f"duplicates_filtered={recent_keys.duplicates}"
+            + (f" acks={message_acks.stats()}" if message_acks is not None else "")
+        )
 
         await close_db_pool()
 
@@ -271,7 +629,13 @@ async def main():
         logger.info("PianoGuard MQTT Subscriber Service stopped")
 
 
-if __name__ == "__main__":
+def run_instance(instance: Optional[int] = None) -> None:
+    """Run one subscriber instance until it is signalled to stop"""
+    global instance_id
+    instance_id = instance
+
+    # Started here rather than at import: its writer thread wouldn't survive the supervisor's fork
+    log_pipeline.start()
     try:
         asyncio.run(main())
     except KeyboardInterrupt:
@@ -279,3 +643,69 @@ if __name__ == "__main__":
     except Exception as e:
         logger.error(f"Service crashed: {e}")
         sys.exit(1)
+    finally:
+        log_pipeline.stop()
+
+
+def instance_count() -> int:
+    if SUBSCRIBER_INSTANCES == "auto":
+        return os.cpu_count() or 1
+    return max(1, int(SUBSCRIBER_INSTANCES))
+
+
+def supervise(instances: int) -> None:
+    """Fork one subscriber process per instance and restart any that die"""
+    global running
+
+    signal.signal(signal.SIGINT, signal_handler)
+    signal.signal(signal.SIGTERM, signal_handler)
+
+    def start(index: int) -> multiprocessing.Process:
+        process = multiprocessing.Process(
+            target=run_instance,
+            args=(index,),
+            name=f"mqtt-subscriber-{index}"
+        )
+        process.start()
+        logger.info(f"Started subscriber instance {index} (pid {process.pid})")
+        return process
+
+    logger.info(f"Supervising {instances} subscriber instances in share group '{MQTT_SHARE_GROUP}'")
+    processes = {index: start(index) for index in range(instances)}
+    restart_at: Dict[int, float] = {}
+
+    while running:
+        time.sleep(1)
+        for index, process in processes.items():
+            if process.is_alive() or not running:
+                continue
+            if index not in restart_at:
+                process_exited(process.pid)
+                logger.warning(f"Subscriber instance {index} exited with code {process.exitcode}, restarting in {SUPERVISOR_RESTART_DELAY}s")
+                restart_at[index] = time.monotonic() + SUPERVISOR_RESTART_DELAY
+            elif time.monotonic() >= restart_at[index]:
+                del restart_at[index]
+                processes[index] = start(index)
+
+    # Forward the shutdown to the instances and wait for them to drain
+    for process in processes.values():
+        if process.is_alive():
+            process.terminate()
+    for process in processes.values():
+        process.join()
+    logger.info("All subscriber instances stopped")
+
+
+if __name__ == "__main__":
+    instances = instance_count()
+    if METRICS_PORT and (instances == 1 or multiprocess_enabled()):
+        start_exporter(METRICS_PORT)
+        logger.info(f"Serving subscriber metrics on port {METRICS_PORT}")
+    elif METRICS_PORT:
+        logger.warning("Subscriber metrics disabled: set PROMETHEUS_MULTIPROC_DIR to export them from multiple instances")
+    if instances > 1:
+        if not MQTT_SHARE_GROUP:
+            MQTT_SHARE_GROUP = "pianoguard"
+        supervise(instances)
+    else:
+        run_instance()
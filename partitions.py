@@ -0,0 +1,288 @@
+"""
+partitions.py
+
+Created on: 2026-10-17
+Edited on: 2026-10-17
+Author: R. Andrew Ballard (c) 2025 "Andwardo"
+Version: v1.0.0
+
+Partition management for the range-partitioned "TelemetryData" table
+Pre-creates upcoming monthly partitions and detaches or drops expired ones
+
+Usage:
+    python partitions.py maintain    # create upcoming / expire old partitions once
+    python partitions.py convert     # one-off: convert a legacy monolithic table
+"""
+
+import asyncio
+import logging
+import re
+import sys
+from datetime import datetime, timezone
+from typing import List, Optional, Tuple
+
+import asyncpg
+
+logger = logging.getLogger(__name__)
+
+PARENT_TABLE = "TelemetryData"
+DEFAULT_PARTITION = "TelemetryData_default"
+LEGACY_PARTITION = "TelemetryData_legacy"
+
+# Arbitrary constant so only one process maintains partitions at a time
+MAINTENANCE_LOCK_ID = 7420001
+
+RETENTION_DETACH = "detach"
+RETENTION_DROP = "drop"
+
+_LOWER_BOUND = re.compile(r"FROM \('([^']+)'\)")
+_UPPER_BOUND = re.compile(r"TO \('([^']+)'\)")
+
+
+def month_start(moment: datetime) -> datetime:
+    return datetime(moment.year, moment.month, 1, tzinfo=timezone.utc)
+
+
+def add_months(moment: datetime, months: int) -> datetime:
+    index = moment.year * 12 + (moment.month - 1) + months
+    return datetime(index // 12, index % 12 + 1, 1, tzinfo=timezone.utc)
+
+
+def partition_name(start: datetime) -> str:
+    return f"{PARENT_TABLE}_{start.year:04d}_{start.month:02d}"
+
+
+async def create_partition(conn: asyncpg.Connection, start: datetime) -> bool:
+    """Create the monthly partition starting at start, returns True if it was created
+
+    Nothing is created for a month an existing partition already covers,
+    such as the legacy partition of a converted table. Rows of the month that
+    reached the default partition first (device clocks running ahead) are
+    moved into the new partition, which PostgreSQL would refuse to create
+    otherwise.
+    """
+    name = partition_name(start)
+    exists = await conn.fetchval("SELECT to_regclass($1) IS NOT NULL", f'"{name}"')
+    if exists:
+        return False
+
+    end = add_months(start, 1)
+    for other, lower, upper in await partition_ranges(conn):
+        if (lower is None or lower < end) and (upper is None or upper > start):
+            logger.debug(f"Not creating telemetry partition {name}, {other} covers it")
+            return False
+
+    default = next((other for other, bound in await _partition_bounds(conn) if bound == "DEFAULT"), None)
+    stranded = default is not None and await conn.fetchval(f"""
+        SELECT EXISTS (SELECT 1 FROM "{default}" WHERE timestamp >= $1 AND timestamp < $2)
+    """, start, end)
+    if not stranded:
+        await conn.execute(f"""
+            CREATE TABLE IF NOT EXISTS "{name}"
+            PARTITION OF "{PARENT_TABLE}"
+            FOR VALUES FROM ('{start.isoformat()}') TO ('{end.isoformat()}')
+        """)
+        logger.info(f"Created telemetry partition {name}")
+        return True
+
+    # Writes to the table wait for the (small) default partition to be moved and re-attached
+    async with conn.transaction():
+        await conn.execute(f'ALTER TABLE "{PARENT_TABLE}" DETACH PARTITION "{default}"')
+        await conn.execute(f"""
+            CREATE TABLE "{name}"
+            PARTITION OF "{PARENT_TABLE}"
+            FOR VALUES FROM ('{start.isoformat()}') TO ('{end.isoformat()}')
+        """)
+        moved = await conn.execute(f"""
+            INSERT INTO "{name}"
+            SELECT * FROM "{default}" WHERE timestamp >= $1 AND timestamp < $2
+        """, start, end)
+        await conn.execute(f'DELETE FROM "{default}" WHERE timestamp >= $1 AND timestamp < $2', start, end)
+        await conn.execute(f'ALTER TABLE "{PARENT_TABLE}" ATTACH PARTITION "{default}" DEFAULT')
+    logger.info(f"Created telemetry partition {name}, moved {moved.split()[-1]} rows from {default}")
+    return True
+
+
+async def _partition_bounds(conn: asyncpg.Connection) -> List[Tuple[str, str]]:
+    """All partitions of the parent with their bound expression ("DEFAULT" for the default one)"""
+    rows = await conn.fetch("""
+        SELECT c.relname, pg_get_expr(c.relpartbound, c.oid) AS bound
+        FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = to_regclass($1)
+        ORDER BY c.relname
+    """, f'"{PARENT_TABLE}"')
+    return [(row["relname"], row["bound"] or "") for row in rows]
+
+
+def _bound(pattern: re.Pattern, bound: str) -> Optional[datetime]:
+    """A range bound as a datetime, None for MINVALUE / MAXVALUE or no match"""
+    match = pattern.search(bound)
+    return datetime.fromisoformat(match.group(1)) if match else None
+
+
+async def list_partitions(conn: asyncpg.Connection) -> List[Tuple[str, Optional[datetime]]]:
+    """All partitions of the parent with their exclusive upper bound (None for DEFAULT)"""
+    return [(name, _bound(_UPPER_BOUND, bound)) for name, bound in await _partition_bounds(conn)]
+
+
+async def partition_ranges(conn: asyncpg.Connection) -> List[Tuple[str, Optional[datetime], Optional[datetime]]]:
+    """Range partitions of the parent as (name, lower, upper), None for MINVALUE / MAXVALUE"""
+    return [
+        (name, _bound(_LOWER_BOUND, bound), _bound(_UPPER_BOUND, bound))
+        for name, bound in await _partition_bounds(conn)
+        if bound != "DEFAULT"
+    ]
+
+
+async def expire_partitions(
+    conn: asyncpg.Connection,
+    retention_months: int,
+    action: str = RETENTION_DETACH,
+    now: Optional[datetime] = None
+) -> List[str]:
+    """Detach (and optionally drop) partitions entirely older than the retention window"""
+    if retention_months <= 0:
+        return []
+
+    cutoff = add_months(month_start(now or datetime.now(timezone.utc)), -retention_months)
+    expired = []
+    for name, upper in await list_partitions(conn):
+        if upper is None or upper > cutoff:
+            continue
+
+        await conn.execute(f'ALTER TABLE "{PARENT_TABLE}" DETACH PARTITION "{name}"')
+        if action == RETENTION_DROP:
+            await conn.execute(f'DROP TABLE "{name}"')
+            logger.info(f"Dropped expired telemetry partition {name}")
+        else:
+            logger.info(f"Detached expired telemetry partition {name}")
+        expired.append(name)
+    return expired
+
+
+async def maintain_partitions(
+    conn: asyncpg.Connection,
+    months_ahead: int = 3,
+    retention_months: int = 0,
+    action: str = RETENTION_DETACH
+) -> bool:
+    """Create partitions through months_ahead and expire old ones
+
+    Guarded by an advisory lock so concurrent subscriber instances and API
+    workers never race each other's DDL. Returns False if another process
+    holds the lock. A month that fails to get its partition is logged and
+    skipped, so it never holds up the months after it or the expiry.
+    """
+    if not await conn.fetchval("SELECT pg_try_advisory_lock($1)", MAINTENANCE_LOCK_ID):
+        return False
+
+    try:
+        current = month_start(datetime.now(timezone.utc))
+        for offset in range(months_ahead + 1):
+            start = add_months(current, offset)
+            try:
+                async with conn.transaction():
+                    await create_partition(conn, start)
+            except asyncpg.PostgresError as e:
+                # E.g. a lock timeout; later months still get theirs and this one is retried next pass
+                logger.error(f"Failed to create telemetry partition {partition_name(start)}: {e}")
+
+        await expire_partitions(conn, retention_months, action)
+    finally:
+        await conn.execute("SELECT pg_advisory_unlock($1)", MAINTENANCE_LOCK_ID)
+    return True
+
+
+async def convert_legacy_table(conn: asyncpg.Connection) -> None:
+    """Convert an existing monolithic "TelemetryData" table into a partitioned one
+
+    The old table is renamed and attached as a single partition covering
+    everything before the start of next month, so no rows are copied. New
+    monthly partitions take over from there and the legacy partition ages out
+    under the normal retention policy.
+    """
+    relkind = await conn.fetchval(
+        "SELECT relkind FROM pg_class WHERE oid = to_regclass($1)", f'"{PARENT_TABLE}"'
+    )
+    if relkind is None:
+        raise RuntimeError(f'Table "{PARENT_TABLE}" does not exist')
+    if relkind == "p":
+        logger.info(f'"{PARENT_TABLE}" is already partitioned')
+        return
+
+    cutover = add_months(month_start(datetime.now(timezone.utc)), 1)
+
+    # Build the (id, timestamp) unique index the partitioned primary key needs without
+    # blocking writes, and validate the range CHECK up front, so ATTACH can reuse both
+    # instead of building an index and scanning the table under an exclusive lock
+    await conn.execute(f"""
+        CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS telemetry_legacy_id_timestamp
+        ON "{PARENT_TABLE}" (id, timestamp)
+    """)
+    await conn.execute(f'ALTER TABLE "{PARENT_TABLE}" DROP CONSTRAINT IF EXISTS telemetry_legacy_range')
+    await conn.execute(f"""
+        ALTER TABLE "{PARENT_TABLE}"
+        ADD CONSTRAINT telemetry_legacy_range CHECK (timestamp < '{cutover.isoformat()}') NOT VALID
+    """)
+    await conn.execute(f'ALTER TABLE "{PARENT_TABLE}" VALIDATE CONSTRAINT telemetry_legacy_range')
+
+    async with conn.transaction():
+        await conn.execute(f'LOCK TABLE "{PARENT_TABLE}" IN ACCESS EXCLUSIVE MODE')
+        await conn.execute(f'ALTER TABLE "{PARENT_TABLE}" RENAME TO "{LEGACY_PARTITION}"')
+        await conn.execute(f'ALTER INDEX IF EXISTS "{PARENT_TABLE}_pkey" RENAME TO "{LEGACY_PARTITION}_pkey"')
+        for index in ("idx_telemetry_timestamp", "idx_telemetry_device_id", "idx_telemetry_device_timestamp"):
+            await conn.execute(f'ALTER INDEX IF EXISTS {index} RENAME TO {index}_legacy')
+
+        # No foreign key here: attaching would have to validate it against every legacy row
+        await conn.execute(f"""
+            CREATE TABLE "{PARENT_TABLE}" (
+                LIKE "{LEGACY_PARTITION}" INCLUDING DEFAULTS,
+                PRIMARY KEY (id, timestamp)
+            ) PARTITION BY RANGE (timestamp)
+        """)
+        await conn.execute(f"""
+            CREATE INDEX idx_telemetry_device_timestamp
+            ON "{PARENT_TABLE}" (device_id, timestamp DESC)
+        """)
+        await conn.execute(f"""
+            CREATE INDEX idx_telemetry_timestamp
+            ON "{PARENT_TABLE}" (timestamp DESC)
+        """)
+        await conn.execute(f"""
+            ALTER TABLE "{PARENT_TABLE}" ATTACH PARTITION "{LEGACY_PARTITION}"
+            FOR VALUES FROM (MINVALUE) TO ('{cutover.isoformat()}')
+        """)
+        await conn.execute(f'ALTER TABLE "{LEGACY_PARTITION}" DROP CONSTRAINT telemetry_legacy_range')
+        await conn.execute(f"""
+            CREATE TABLE IF NOT EXISTS "{DEFAULT_PARTITION}"
+            PARTITION OF "{PARENT_TABLE}" DEFAULT
+        """)
+
+    logger.info(f'Converted "{PARENT_TABLE}" to a partitioned table, legacy rows end at {cutover.isoformat()}')
+
+
+async def _main(command: str) -> None:
+    from env import DB_HOST, DB_PORT, DB_NAME, DB_USER, DB_PASSWORD
+
+    conn = await asyncpg.connect(
+        host=DB_HOST,
+        port=int(DB_PORT),
+        database=DB_NAME,
+        user=DB_USER,
+        password=DB_PASSWORD
+    )
+    try:
+        if command == "convert":
+            await convert_legacy_table(conn)
+        await maintain_partitions(conn)
+    finally:
+        await conn.close()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    if len(sys.argv) != 2 or sys.argv[1] not in ("maintain", "convert"):
+        print(__doc__)
+        sys.exit(1)
+    asyncio.run(_main(sys.argv[1]))
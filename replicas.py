@@ -0,0 +1,191 @@
+"""
+replicas.py
+
+Created on: 2026-10-17
+Edited on: 2026-10-17
+Author: R. Andrew Ballard (c) 2025 "Andwardo"
+Version: v1.0.0
+
+Read-replica pools for the query endpoints, with lag-aware routing
+A background task measures each streaming replica's replay lag against the
+primary's WAL position; reads go to the least busy replica that is healthy
+and within the lag limit, and to the primary when none is.
+"""
+
+import asyncio
+import logging
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+import asyncpg
+
+from metrics import REPLICA_LAG_SECONDS
+
+logger = logging.getLogger(__name__)
+
+# Replay lag is only counted while the replica is behind the primary's WAL
+# position, so an idle primary doesn't make a caught-up replica look stale
+REPLICA_STATUS_SQL = """
+    SELECT pg_is_in_recovery() AS in_recovery,
+           pg_wal_lsn_diff($1::pg_lsn, pg_last_wal_replay_lsn()) AS behind_bytes,
+           EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()) AS replay_age
+"""
+
+
+def parse_replicas(value: str, default_port: int) -> List[Tuple[str, int]]:
+    """Comma-separated host[:port] list -> [(host, port)]"""
+    replicas = []
+    for entry in value.split(","):
+        entry = entry.strip()
+        if not entry:
+            continue
+        host, _, port = entry.partition(":")
+        replicas.append((host, int(port) if port else default_port))
+    return replicas
+
+
+class Replica:
+    """One read replica's pool and its last measured state"""
+
+    def __init__(self, host: str, port: int, pool: asyncpg.Pool):
+        self.name = f"{host}:{port}"
+        self.pool = pool
+        self.healthy = False
+        self.lag: Optional[float] = None
+        self.checked_at: Optional[float] = None
+        self.error: Optional[str] = None
+
+    @property
+    def in_use(self) -> int:
+        return self.pool.get_size() - self.pool.get_idle_size()
+
+
+class ReplicaRouter:
+    """Picks a replica for each read, or None to use the primary
+
+    Replicas start out unhealthy and only receive reads after their first
+    successful check, so a worker never routes to a replica it hasn't
+    measured. A replica that fails a check or a connection attempt is taken
+    out until the next successful check.
+    """
+
+    def __init__(self, max_lag: float = 5.0, check_interval: float = 2.0, check_timeout: float = 2.0):
+        self.max_lag = max_lag
+        self.check_interval = check_interval
+        self.check_timeout = check_timeout
+
+        self.replicas: List[Replica] = []
+        self._primary: Optional[asyncpg.Pool] = None
+        self._task: Optional[asyncio.Task] = None
+
+        self.replica_reads = 0
+        self.primary_fallbacks = 0
+
+    async def start(self, primary: asyncpg.Pool, hosts: List[Tuple[str, int]], **pool_kwargs) -> None:
+        """Create a pool per replica (asyncpg.create_pool() keyword arguments) and start checking them"""
+        self._primary = primary
+        for host, port in hosts:
+            # min_size=0: a replica that is down at startup must not stop the worker from booting
+            pool = await asyncpg.create_pool(host=host, port=port, **{**pool_kwargs, "min_size": 0})
+            self.replicas.append(Replica(host, port, pool))
+        if self.replicas:
+            await self.check()
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        for replica in self.replicas:
+            await replica.pool.close()
+        self.replicas = []
+
+    def choose(self) -> Optional[Replica]:
+        """Least busy healthy replica within the lag limit, None when the primary should serve"""
+        candidates = [
+            r for r in self.replicas
+            if r.healthy and r.lag is not None and r.lag <= self.max_lag
+        ]
+        if not candidates:
+            if self.replicas:
+                self.primary_fallbacks += 1
+            return None
+        self.replica_reads += 1
+        return min(candidates, key=lambda r: r.in_use)
+
+    def mark_failed(self, replica: Replica, error: BaseException) -> None:
+        """Take a replica out of rotation after a failed connection, until it passes a check"""
+        if replica.healthy:
+            logger.warning(f"Read replica {replica.name} failed, reading from primary: {error}")
+        replica.healthy = False
+        replica.error = str(error)
+
+    async def check(self) -> None:
+        """Measure every replica's replay lag against the primary's current WAL position"""
+        try:
+            async with self._primary.acquire(timeout=self.check_timeout) as conn:
+                primary_lsn = await conn.fetchval("SELECT pg_current_wal_lsn()::text", timeout=self.check_timeout)
+        except Exception as e:
+            # Without a reference position the lag can't be trusted
+            logger.error(f"Read replica check could not reach the primary: {e}")
+            for replica in self.replicas:
+                replica.healthy = False
+            return
+
+        await asyncio.gather(*(self._check_replica(r, primary_lsn) for r in self.replicas))
+
+    async def _check_replica(self, replica: Replica, primary_lsn: str) -> None:
+        try:
+            async with replica.pool.acquire(timeout=self.check_timeout) as conn:
+                status = await conn.fetchrow(REPLICA_STATUS_SQL, primary_lsn, timeout=self.check_timeout)
+        except Exception as e:
+            self.mark_failed(replica, e)
+            return
+
+        first_check = replica.checked_at is None
+        replica.checked_at = time.time()
+        if not status["in_recovery"]:
+            # Promoted (or misconfigured): no longer follows the primary
+            if replica.healthy or first_check:
+                logger.error(f"Read replica {replica.name} is not in recovery, not routing reads to it")
+            replica.healthy = False
+            replica.error = "not in recovery"
+            return
+
+        if status["behind_bytes"] is None or status["behind_bytes"] <= 0:
+            replica.lag = 0.0
+        else:
+            replica.lag = float(status["replay_age"]) if status["replay_age"] is not None else None
+        REPLICA_LAG_SECONDS.labels(replica.name).set(replica.lag if replica.lag is not None else float("inf"))
+
+        if not replica.healthy:
+            logger.info(f"Read replica {replica.name} is healthy (lag {replica.lag}s)")
+        replica.healthy = True
+        replica.error = None
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.check_interval)
+            try:
+                await self.check()
+            except Exception as e:
+                logger.error(f"Read replica check failed: {e}")
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "replica_reads": self.replica_reads,
+            "primary_fallbacks": self.primary_fallbacks,
+            "replicas": [
+                {
+                    "name": r.name,
+                    "healthy": r.healthy,
+                    "lag": r.lag,
+                    "in_use": r.in_use,
+                    "error": r.error,
+                }
+                for r in self.replicas
+            ],
+        }
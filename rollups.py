@@ -0,0 +1,289 @@
+"""
+rollups.py
+
+Created on: 2026-10-17
+Edited on: 2026-10-17
+Author: R. Andrew Ballard (c) 2025 "Andwardo"
+Version: v1.0.0
+
+Pre-aggregated per-device telemetry rollups (1-minute, 1-hour and 1-day buckets)
+Maintained incrementally by the ingest path and served by /api/data/aggregate
+
+Usage:
+    python rollups.py rebuild <start_epoch> <end_epoch>   # recompute from raw rows
+"""
+
+import asyncio
+import logging
+import sys
+from typing import Dict, Iterable, List, Tuple
+
+import asyncpg
+
+logger = logging.getLogger(__name__)
+
+# Bucket widths in seconds, keyed by the resolution name used in the API
+RESOLUTIONS = {
+    "1m": 60,
+    "1h": 3600,
+    "1d": 86400,
+}
+
+# Rebuilds and incremental writers of a day's rollups exclude each other through a
+# transaction-scoped advisory lock on (ROLLUP_LOCK_ID, epoch day): writers share it, a
+# rebuild holds it exclusively, so a rebuild never overwrites increments committed after
+# it read the raw rows. Days are always locked in ascending order
+ROLLUP_LOCK_ID = 7420004
+_DAY = RESOLUTIONS["1d"]
+
+LOCK_DAYS_SHARED_SQL = """
+    SELECT pg_advisory_xact_lock_shared($1, day) FROM unnest($2::integer[]) AS day
+"""
+
+LOCK_TABLE_DAYS_SHARED_SQL = """
+    SELECT pg_advisory_xact_lock_shared($1, day)
+    FROM (
+        SELECT DISTINCT floor(EXTRACT(EPOCH FROM timestamp) / $2)::integer AS day
+        FROM "{table}"
+        ORDER BY day
+    ) days
+"""
+
+LOCK_DAYS_EXCLUSIVE_SQL = """
+    SELECT pg_advisory_xact_lock($1, day) FROM generate_series($2::integer, $3::integer) AS day
+"""
+
+# Accumulator layout per (device_id, resolution, bucket_start)
+_COUNT = 0
+_BATTERY = 1    # min, max, sum, count
+_RSSI = 5
+_HEAP = 9
+_LEDS = 13      # power_on, water_on, pads_on
+_WIDTH = 16
+
+# Adds a new bucket's counts to the accumulated ones
+_ACCUMULATE_ROLLUPS = """
+    ON CONFLICT (device_id, resolution, bucket_start)
+    DO UPDATE SET
+        sample_count = "TelemetryRollups".sample_count + EXCLUDED.sample_count,
+        battery_min = LEAST("TelemetryRollups".battery_min, EXCLUDED.battery_min),
+        battery_max = GREATEST("TelemetryRollups".battery_max, EXCLUDED.battery_max),
+        battery_sum = "TelemetryRollups".battery_sum + EXCLUDED.battery_sum,
+        battery_count = "TelemetryRollups".battery_count + EXCLUDED.battery_count,
+        rssi_min = LEAST("TelemetryRollups".rssi_min, EXCLUDED.rssi_min),
+        rssi_max = GREATEST("TelemetryRollups".rssi_max, EXCLUDED.rssi_max),
+        rssi_sum = "TelemetryRollups".rssi_sum + EXCLUDED.rssi_sum,
+        rssi_count = "TelemetryRollups".rssi_count + EXCLUDED.rssi_count,
+        heap_min = LEAST("TelemetryRollups".heap_min, EXCLUDED.heap_min),
+        heap_max = GREATEST("TelemetryRollups".heap_max, EXCLUDED.heap_max),
+        heap_sum = "TelemetryRollups".heap_sum + EXCLUDED.heap_sum,
+        heap_count = "TelemetryRollups".heap_count + EXCLUDED.heap_count,
+        power_on = "TelemetryRollups".power_on + EXCLUDED.power_on,
+        water_on = "TelemetryRollups".water_on + EXCLUDED.water_on,
+        pads_on = "TelemetryRollups".pads_on + EXCLUDED.pads_on
+"""
+
+UPSERT_ROLLUPS_SQL = f"""
+    INSERT INTO "TelemetryRollups" (
+        device_id, resolution, bucket_start, sample_count,
+        battery_min, battery_max, battery_sum, battery_count,
+        rssi_min, rssi_max, rssi_sum, rssi_count,
+        heap_min, heap_max, heap_sum, heap_count,
+        power_on, water_on, pads_on
+    )
+    SELECT r.device_id, r.resolution, to_timestamp(r.bucket), r.sample_count,
+           r.battery_min, r.battery_max, r.battery_sum, r.battery_count,
+           r.rssi_min, r.rssi_max, r.rssi_sum, r.rssi_count,
+           r.heap_min, r.heap_max, r.heap_sum, r.heap_count,
+           r.power_on, r.water_on, r.pads_on
+    FROM unnest(
+        $1::varchar[], $2::varchar[], $3::bigint[], $4::integer[],
+        $5::real[], $6::real[], $7::float8[], $8::integer[],
+        $9::integer[], $10::integer[], $11::bigint[], $12::integer[],
+        $13::integer[], $14::integer[], $15::bigint[], $16::integer[],
+        $17::integer[], $18::integer[], $19::integer[]
+    ) AS r(device_id, resolution, bucket, sample_count,
+           battery_min, battery_max, battery_sum, battery_count,
+           rssi_min, rssi_max, rssi_sum, rssi_count,
+           heap_min, heap_max, heap_sum, heap_count,
+           power_on, water_on, pads_on){_ACCUMULATE_ROLLUPS}"""
+
+# Buckets of width $2 at resolution $1, from a table with the "TelemetryData" columns
+_AGGREGATE_ROWS = """
+    SELECT device_id, $1,
+           to_timestamp(floor(EXTRACT(EPOCH FROM timestamp) / $2) * $2) AS bucket_start,
+           COUNT(*),
+           MIN(battery_voltage), MAX(battery_voltage),
+           COALESCE(SUM(battery_voltage), 0), COUNT(battery_voltage),
+           MIN(wifi_rssi), MAX(wifi_rssi), COALESCE(SUM(wifi_rssi), 0), COUNT(wifi_rssi),
+           MIN(free_heap), MAX(free_heap), COALESCE(SUM(free_heap), 0), COUNT(free_heap),
+           COUNT(*) FILTER (WHERE led_power),
+           COUNT(*) FILTER (WHERE led_water),
+           COUNT(*) FILTER (WHERE led_pads)
+"""
+
+# Recompute rollups from raw rows, replacing whatever was accumulated
+REBUILD_ROLLUPS_SQL = f"""
+    INSERT INTO "TelemetryRollups" (
+        device_id, resolution, bucket_start, sample_count,
+        battery_min, battery_max, battery_sum, battery_count,
+        rssi_min, rssi_max, rssi_sum, rssi_count,
+        heap_min, heap_max, heap_sum, heap_count,
+        power_on, water_on, pads_on
+    )
+{_AGGREGATE_ROWS}    FROM "TelemetryData"
+    WHERE timestamp >= to_timestamp($3) AND timestamp < to_timestamp($4)
+    GROUP BY device_id, bucket_start
+    ON CONFLICT (device_id, resolution, bucket_start)
+    DO UPDATE SET
+        sample_count = EXCLUDED.sample_count,
+        battery_min = EXCLUDED.battery_min,
+        battery_max = EXCLUDED.battery_max,
+        battery_sum = EXCLUDED.battery_sum,
+        battery_count = EXCLUDED.battery_count,
+        rssi_min = EXCLUDED.rssi_min,
+        rssi_max = EXCLUDED.rssi_max,
+        rssi_sum = EXCLUDED.rssi_sum,
+        rssi_count = EXCLUDED.rssi_count,
+        heap_min = EXCLUDED.heap_min,
+        heap_max = EXCLUDED.heap_max,
+        heap_sum = EXCLUDED.heap_sum,
+        heap_count = EXCLUDED.heap_count,
+        power_on = EXCLUDED.power_on,
+        water_on = EXCLUDED.water_on,
+        pads_on = EXCLUDED.pads_on
+"""
+
+# Add the rows of a staging table (e.g. a bulk load) to the accumulated rollups,
+# in key order so concurrent writers lock rollup rows consistently
+MERGE_ROLLUPS_SQL = f"""
+    INSERT INTO "TelemetryRollups" (
+        device_id, resolution, bucket_start, sample_count,
+        battery_min, battery_max, battery_sum, battery_count,
+        rssi_min, rssi_max, rssi_sum, rssi_count,
+        heap_min, heap_max, heap_sum, heap_count,
+        power_on, water_on, pads_on
+    )
+{_AGGREGATE_ROWS}    FROM "{{table}}"
+    GROUP BY device_id, bucket_start
+    ORDER BY device_id, bucket_start{_ACCUMULATE_ROLLUPS}"""
+
+
+def _accumulate(acc: list, offset: int, value) -> None:
+    if value is None:
+        return
+    if acc[offset + 3] == 0:
+        acc[offset] = acc[offset + 1] = value
+    else:
+        acc[offset] = min(acc[offset], value)
+        acc[offset + 1] = max(acc[offset + 1], value)
+    acc[offset + 2] += value
+    acc[offset + 3] += 1
+
+
+def aggregate_rows(rows) -> Dict[Tuple[str, str, int], list]:
+    """Fold telemetry rows into per-(device, resolution, bucket) accumulators"""
+    buckets: Dict[Tuple[str, str, int], list] = {}
+    for row in rows:
+        device_id, ts = row[0], row[1]
+        for resolution, width in RESOLUTIONS.items():
+            key = (device_id, resolution, int(ts // width) * width)
+            acc = buckets.get(key)
+            if acc is None:
+                acc = buckets[key] = [0, None, None, 0, 0, None, None, 0, 0, None, None, 0, 0, 0, 0, 0]
+            acc[_COUNT] += 1
+            _accumulate(acc, _BATTERY, row[7])
+            _accumulate(acc, _RSSI, row[4])
+            _accumulate(acc, _HEAP, row[6])
+            acc[_LEDS] += row[8]
+            acc[_LEDS + 1] += row[9]
+            acc[_LEDS + 2] += row[10]
+    return buckets
+
+
+async def write_rollups(conn: asyncpg.Connection, rows) -> None:
+    """Merge a batch of telemetry rows into the rollup tables
+
+    Must run inside the same transaction as the raw insert so rollups never
+    count rows that were rolled back. Keys are sorted so concurrent writers
+    take row locks in the same order.
+    """
+    buckets = aggregate_rows(rows)
+    if not buckets:
+        return
+    days = sorted({bucket_start // _DAY for _, resolution, bucket_start in buckets if resolution == "1d"})
+    await conn.execute(LOCK_DAYS_SHARED_SQL, ROLLUP_LOCK_ID, days)
+
+    keys = sorted(buckets)
+    columns: List[list] = [[] for _ in range(3 + _WIDTH)]
+    for key in keys:
+        for index, value in enumerate(key):
+            columns[index].append(value)
+        for index, value in enumerate(buckets[key]):
+            columns[3 + index].append(value)
+
+    await conn.execute(UPSERT_ROLLUPS_SQL, *columns)
+
+
+async def merge_rollups(conn: asyncpg.Connection, table: str) -> None:
+    """Merge every row of table (with the "TelemetryData" columns) into the rollups, at all resolutions
+
+    Like write_rollups(), but aggregated in the database, for batches too large
+    to fold in Python. Must run in the transaction that inserted the rows.
+    """
+    await conn.execute(LOCK_TABLE_DAYS_SHARED_SQL.format(table=table), ROLLUP_LOCK_ID, _DAY)
+    for resolution, width in RESOLUTIONS.items():
+        await conn.execute(MERGE_ROLLUPS_SQL.format(table=table), resolution, width)
+
+
+async def rebuild_rollups(
+    conn: asyncpg.Connection,
+    start: int,
+    end: int,
+    resolutions: Iterable[str] = tuple(RESOLUTIONS)
+) -> None:
+    """Recompute rollups for [start, end) from raw telemetry (all resolutions by default)
+
+    start and end should be aligned to whole days so no 1d bucket is rebuilt
+    from a partial day. Live writers of the days in range wait for each
+    resolution's transaction, see lock_rollup_days().
+    """
+    for resolution in resolutions:
+        width = RESOLUTIONS[resolution]
+        async with conn.transaction():
+            await lock_rollup_days(conn, start, end)
+            result = await conn.execute(REBUILD_ROLLUPS_SQL, resolution, width, start, end)
+        logger.info(f"Rebuilt {resolution} rollups: {result}")
+
+
+async def lock_rollup_days(conn: asyncpg.Connection, start: int, end: int) -> None:
+    """Hold the days of [start, end) against incremental writers until the transaction ends
+
+    Must be taken before the raw rows are read, in the transaction that
+    replaces the buckets.
+    """
+    await conn.execute(LOCK_DAYS_EXCLUSIVE_SQL, ROLLUP_LOCK_ID, start // _DAY, (end - 1) // _DAY)
+
+
+async def _main(start: int, end: int) -> None:
+    from env import DB_HOST, DB_PORT, DB_NAME, DB_USER, DB_PASSWORD
+
+    conn = await asyncpg.connect(
+        host=DB_HOST,
+        port=int(DB_PORT),
+        database=DB_NAME,
+        user=DB_USER,
+        password=DB_PASSWORD
+    )
+    try:
+        await rebuild_rollups(conn, start, end)
+    finally:
+        await conn.close()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    if len(sys.argv) != 4 or sys.argv[1] != "rebuild":
+        print(__doc__)
+        sys.exit(1)
+    asyncio.run(_main(int(sys.argv[2]), int(sys.argv[3])))
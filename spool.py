@@ -0,0 +1,309 @@
+"""
+spool.py
+
+Created on: 2026-10-17
+Edited on: 2026-10-17
+Author: R. Andrew Ballard (c) 2025 "Andwardo"
+Version: v1.0.0
+
+Durable on-disk spool for telemetry that could not be written to PostgreSQL
+Rows are appended to segmented JSONL files and replayed in bulk once the
+database is healthy again
+"""
+
+import asyncio
+import json
+import logging
+import os
+import threading
+import time
+from typing import Callable, Iterable, List, Optional, Tuple
+
+import asyncpg
+
+from log_pipeline import log_limiter
+from metrics import ROWS_DUPLICATE, ROWS_FAILED, ROWS_STORED
+from telemetry_writer import TelemetryRow, write_batch
+
+logger = logging.getLogger(__name__)
+
+SEGMENT_SUFFIX = ".jsonl"
+POSITION_SUFFIX = ".pos"
+
+# Errors that mean "database unavailable" rather than "bad data"
+UNAVAILABLE_ERRORS = (
+    OSError,
+    asyncio.TimeoutError,
+    asyncpg.InterfaceError,
+    asyncpg.PostgresConnectionError,
+    asyncpg.OperatorInterventionError,
+    asyncpg.InsufficientResourcesError,
+)
+
+
+class Spool:
+    """Append-only segmented spool directory
+
+    Each segment is a JSONL file named by a zero-padded sequence number. Writers
+    only ever append to the newest (active) segment; the replayer only reads
+    sealed segments, and records its committed byte offset in a .pos sidecar so
+    a restart resumes where it left off instead of replaying the whole segment.
+    """
+
+    def __init__(self, directory: str, segment_max_bytes: int = 64 * 1024 * 1024, fsync: bool = False):
+        self.directory = directory
+        self.segment_max_bytes = segment_max_bytes
+        self.fsync = fsync
+
+        os.makedirs(directory, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._active = None
+        self._active_seq: Optional[int] = None
+        self._active_size = 0
+
+        existing = self._segments()
+        self._next_seq = (existing[-1] + 1) if existing else 1
+
+        self.rows_appended = 0
+
+    def _path(self, seq: int, suffix: str = SEGMENT_SUFFIX) -> str:
+        return os.path.join(self.directory, f"{seq:012d}{suffix}")
+
+    def _segments(self) -> List[int]:
+        return sorted(
+            int(name[:-len(SEGMENT_SUFFIX)])
+            for name in os.listdir(self.directory)
+            if name.endswith(SEGMENT_SUFFIX) and name[:-len(SEGMENT_SUFFIX)].isdigit()
+        )
+
+    def _seal_active(self) -> None:
+        if self._active:
+            self._active.close()
+            self._active = None
+            self._active_seq = None
+            self._active_size = 0
+
+    def append(self, rows: Iterable[TelemetryRow]) -> None:
+        """Append rows to the active segment, rotating it when it gets too big
+
+        Safe to call from any thread.
+        """
+        data = "".join(json.dumps(row, separators=(",", ":")) + "\n" for row in rows).encode()
+        if not data:
+            return
+
+        with self._lock:
+            if self._active and self._active_size >= self.segment_max_bytes:
+                self._seal_active()
+            if not self._active:
+                self._active_seq = self._next_seq
+                self._next_seq += 1
+                self._active = open(self._path(self._active_seq), "ab")
+                self._active_size = 0
+
+            self._active.write(data)
+            self._active.flush()
+            if self.fsync:
+                os.fsync(self._active.fileno())
+            self._active_size += len(data)
+            self.rows_appended += data.count(b"\n")
+
+    def seal(self) -> None:
+        """Close the active segment so the replayer can pick it up"""
+        with self._lock:
+            self._seal_active()
+
+    def sealed_segments(self) -> List[int]:
+        with self._lock:
+            return [seq for seq in self._segments() if seq != self._active_seq]
+
+    def has_data(self) -> bool:
+        with self._lock:
+            return bool(self._segments())
+
+    def size_bytes(self) -> int:
+        total = 0
+        for seq in self._segments():
+            try:
+                total += os.path.getsize(self._path(seq))
+            except FileNotFoundError:
+                pass
+        return total
+
+    def read_batch(self, seq: int, max_rows: int) -> Tuple[List[TelemetryRow], int]:
+        """Read up to max_rows from a sealed segment starting at its committed position
+
+        Returns the rows and the byte offset just past them.
+        """
+        offset = self.position(seq)
+        rows = []
+        with open(self._path(seq), "rb") as segment:
+            segment.seek(offset)
+            while len(rows) < max_rows:
+                line = segment.readline()
+                if not line:
+                    break
+                if not line.endswith(b"\n"):
+                    # Torn write from a crash mid-append, nothing after it is valid
+                    break
+                offset += len(line)
+                try:
+                    rows.append(tuple(json.loads(line)))
+                except ValueError:
+                    log_limiter.log(logger, logging.WARNING, "spool_corrupt", f"Skipping corrupt spool record in segment {seq}")
+        return rows, offset
+
+    def position(self, seq: int) -> int:
+        try:
+            with open(self._path(seq, POSITION_SUFFIX)) as position_file:
+                return int(position_file.read().strip() or 0)
+        except FileNotFoundError:
+            return 0
+
+    def commit(self, seq: int, offset: int) -> None:
+        """Record that everything before offset has been written to the database"""
+        if offset >= os.path.getsize(self._path(seq)):
+            self.remove(seq)
+            return
+        tmp_path = self._path(seq, POSITION_SUFFIX + ".tmp")
+        with open(tmp_path, "w") as position_file:
+            position_file.write(str(offset))
+        os.replace(tmp_path, self._path(seq, POSITION_SUFFIX))
+
+    def remove(self, seq: int) -> None:
+        for suffix in (SEGMENT_SUFFIX, POSITION_SUFFIX):
+            try:
+                os.remove(self._path(seq, suffix))
+            except FileNotFoundError:
+                pass
+
+    def close(self) -> None:
+        self.seal()
+
+
+class SpoolReplayer:
+    """Drains a Spool back into PostgreSQL in large batches, at a bounded rate
+
+    Replay only starts while the database answers a health check, and pauses
+    whenever the live ingest path is busy, so catching up never starves live
+    traffic.
+    """
+
+    def __init__(
+        self,
+        spool: Spool,
+        pool: asyncpg.Pool,
+        batch_size: int = 5000,
+        rows_per_second: float = 5000.0,
+        idle_interval: float = 5.0,
+        live_busy: Optional[Callable[[], bool]] = None
+    ):
+        self.spool = spool
+        self.pool = pool
+        self.batch_size = batch_size
+        self.rows_per_second = rows_per_second
+        self.idle_interval = idle_interval
+        self.live_busy = live_busy
+
+        self._stopping = False
+        self._wakeup = asyncio.Event()
+
+        self.rows_replayed = 0
+        self.rows_rejected = 0
+
+    async def _healthy(self) -> bool:
+        try:
+            async with self.pool.acquire(timeout=5) as conn:
+                await conn.fetchval("SELECT 1", timeout=5)
+            return True
+        except Exception:
+            return False
+
+    async def _sleep(self, seconds: float) -> None:
+        if self._stopping:
+            return
+        self._wakeup.clear()
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), timeout=seconds)
+        except asyncio.TimeoutError:
+            pass
+
+    async def run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while not self._stopping:
+            segments = await loop.run_in_executor(None, self.spool.sealed_segments)
+            if not segments:
+                if await loop.run_in_executor(None, self.spool.has_data):
+                    # Only the active segment has data - seal it so it can be drained
+                    await loop.run_in_executor(None, self.spool.seal)
+                    continue
+                await self._sleep(self.idle_interval)
+                continue
+
+            if (self.live_busy and self.live_busy()) or not await self._healthy():
+                await self._sleep(self.idle_interval)
+                continue
+
+            seq = segments[0]
+            rows, offset = await loop.run_in_executor(None, self.spool.read_batch, seq, self.batch_size)
+            started = time.monotonic()
+            try:
+                if rows:
+                    await self._write(rows)
+            except UNAVAILABLE_ERRORS as e:
+                # Database went away again - keep the rows spooled and retry later
+                log_limiter.log(logger, logging.WARNING, "spool_paused", f"Spool replay paused, database unavailable: {e}")
+                await self._sleep(self.idle_interval)
+                continue
+
+            await loop.run_in_executor(None, self.spool.commit, seq, offset)
+            self.rows_replayed += len(rows)
+            if rows:
+                logger.info(f"Replayed {len(rows)} spooled telemetry rows from segment {seq}")
+
+            # Rate limit: never replay faster than rows_per_second on average
+            budget = len(rows) / self.rows_per_second - (time.monotonic() - started)
+            if budget > 0:
+                await self._sleep(budget)
+
+    async def _write(self, rows: List[TelemetryRow]) -> None:
+        try:
+            async with self.pool.acquire() as conn:
+                inserted = await write_batch(conn, rows)
+            ROWS_STORED.inc(len(inserted))
+            ROWS_DUPLICATE.inc(len(rows) - len(inserted))
+            return
+        except UNAVAILABLE_ERRORS:
+            raise
+        except asyncpg.PostgresError as e:
+            logger.warning(f"Spooled batch rejected ({e}), retrying rows individually")
+
+        # A bad row poisons the whole bulk insert - isolate it and move on
+        async with self.pool.acquire() as conn:
+            for row in rows:
+                try:
+                    if await write_batch(conn, [row]):
+                        ROWS_STORED.inc()
+                    else:
+                        ROWS_DUPLICATE.inc()
+                except UNAVAILABLE_ERRORS:
+                    raise
+                except asyncpg.PostgresError as e:
+                    self.rows_rejected += 1
+                    ROWS_FAILED.inc()
+                    log_limiter.log(
+                        logger, logging.ERROR, "spool_rejected", f"Dropping spooled telemetry row for device {row[0]}: {e}"
+                    )
+
+    async def stop(self) -> None:
+        self._stopping = True
+        self._wakeup.set()
+
+    def stats(self) -> dict:
+        return {
+            "spool_bytes": self.spool.size_bytes(),
+            "rows_spooled": self.spool.rows_appended,
+            "rows_replayed": self.rows_replayed,
+            "rows_rejected": self.rows_rejected,
+        }
@@ -0,0 +1,114 @@
+"""
+telemetry_stream.py
+
+Created on: 2026-10-17
+Edited on: 2026-10-17
+Author: R. Andrew Ballard (c) 2025 "Andwardo"
+Version: v1.0.0
+
+Per-worker fan-out hub for live telemetry (/api/data/stream)
+Fed by the latest telemetry cache's LISTEN connection, so streaming adds no
+database connections or queries no matter how many clients are subscribed
+"""
+
+import asyncio
+import json
+import logging
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, Optional, Set
+
+logger = logging.getLogger(__name__)
+
+
+class Subscription:
+    """One client's pending records, at most one per subscribed device
+
+    A newer record for a device replaces the one still waiting to be sent, so
+    a slow client skips intermediate samples instead of growing a backlog or
+    holding up the hub.
+    """
+
+    def __init__(self, device_ids: Iterable[str]):
+        self.device_ids: Set[str] = set(device_ids)
+        self._pending: "OrderedDict[str, str]" = OrderedDict()
+        self._ready = asyncio.Event()
+        self.sent = 0
+        self.coalesced = 0
+
+    def offer(self, device_id: str, encoded: str) -> None:
+        if device_id in self._pending:
+            self.coalesced += 1
+        self._pending[device_id] = encoded
+        self._ready.set()
+
+    async def next(self, timeout: float) -> Optional[str]:
+        """Next encoded record, or None if nothing arrived within timeout"""
+        if not self._pending:
+            self._ready.clear()
+            try:
+                await asyncio.wait_for(self._ready.wait(), timeout)
+            except asyncio.TimeoutError:
+                return None
+        _, encoded = self._pending.popitem(last=False)
+        self.sent += 1
+        return encoded
+
+
+class TelemetryHub:
+    """device_id -> subscriptions, fanning each committed record out to its subscribers"""
+
+    def __init__(self, max_subscriptions: int = 1000):
+        self.max_subscriptions = max_subscriptions
+
+        self._by_device: Dict[str, Set[Subscription]] = {}
+        self._subscriptions: Set[Subscription] = set()
+        self.published = 0
+        self.delivered = 0
+        self._closed_coalesced = 0
+
+    def __len__(self) -> int:
+        return len(self._subscriptions)
+
+    @property
+    def full(self) -> bool:
+        return len(self._subscriptions) >= self.max_subscriptions
+
+    def subscribe(self, device_ids: Iterable[str]) -> Subscription:
+        subscription = Subscription(device_ids)
+        self._subscriptions.add(subscription)
+        for device_id in subscription.device_ids:
+            self._by_device.setdefault(device_id, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription) -> None:
+        if subscription not in self._subscriptions:
+            return
+        self._subscriptions.discard(subscription)
+        self._closed_coalesced += subscription.coalesced
+        for device_id in subscription.device_ids:
+            subscribers = self._by_device.get(device_id)
+            if subscribers is not None:
+                subscribers.discard(subscription)
+                if not subscribers:
+                    del self._by_device[device_id]
+
+    def publish(self, record: Dict[str, Any]) -> None:
+        """Hand a record to every subscriber of its device, encoded once for all of them"""
+        subscribers = self._by_device.get(record["device_id"])
+        if not subscribers:
+            return
+
+        encoded = json.dumps(record, separators=(",", ":"))
+        for subscription in subscribers:
+            subscription.offer(record["device_id"], encoded)
+        self.published += 1
+        self.delivered += len(subscribers)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "subscriptions": len(self._subscriptions),
+            "devices": len(self._by_device),
+            "published": self.published,
+            "delivered": self.delivered,
+            "coalesced": self._closed_coalesced + sum(s.coalesced for s in self._subscriptions),
+        }
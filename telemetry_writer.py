@@ -0,0 +1,436 @@
+"""
+telemetry_writer.py
+
+Created on: 2026-10-17
+Edited on: 2026-10-17
+Author: R. Andrew Ballard (c) 2025 "Andwardo"
+Version: v1.0.0
+
+Batched telemetry writer for PianoGuard ingest
+Drains parsed telemetry rows from the ingest queue and flushes them to
+PostgreSQL in one transaction per batch, when either the row count or the latency deadline is hit
+"""
+
+import asyncio
+import json
+import logging
+import math
+import struct
+import time
+from typing import Dict, Any, List, Optional, Sequence, Tuple
+
+import asyncpg
+
+from ingest_queue import IngestQueue
+from log_pipeline import excerpt, log_limiter
+from metrics import (
+    BATCH_SECONDS,
+    INGEST_LAG_SECONDS,
+    POOL_ACQUIRE_SECONDS,
+    ROWS_DUPLICATE,
+    ROWS_FAILED,
+    ROWS_SPOOLED,
+    ROWS_STORED,
+    ROWS_SUPPRESSED,
+)
+from rollups import write_rollups
+
+logger = logging.getLogger(__name__)
+
+# NOTIFY channel carrying each device's newest committed record, see latest_cache.py
+TELEMETRY_CHANNEL = "telemetry_latest"
+
+TelemetryRow = Tuple[
+    str, float, Optional[str], Optional[str], Optional[int], Optional[int],
+    Optional[int], Optional[float], bool, bool, bool
+]
+
+UPSERT_DEVICES_SQL = """
+    INSERT INTO "Devices" (device_id, last_seen, "createdAt", "updatedAt")
+    SELECT d.device_id, to_timestamp(d.ts), CURRENT_TIMESTAMP, CURRENT_TIMESTAMP
+    FROM unnest($1::varchar[], $2::float8[]) AS d(device_id, ts)
+    ON CONFLICT (device_id)
+    DO UPDATE SET
+        last_seen = GREATEST("Devices".last_seen, EXCLUDED.last_seen),
+        "updatedAt" = CURRENT_TIMESTAMP
+"""
+
+# Rows already stored under the same (device_id, timestamp) are skipped; returns the
+# 1-based positions of the rows that were inserted, so only those reach the rollups,
+# "LatestTelemetry" and listeners
+INSERT_TELEMETRY_SQL = """
+    WITH batch AS (
+        SELECT *
+        FROM unnest(
+            $1::varchar[], $2::float8[], $3::varchar[], $4::varchar[], $5::integer[],
+            $6::bigint[], $7::integer[], $8::real[],
+            $9::boolean[], $10::boolean[], $11::boolean[]
+        ) WITH ORDINALITY AS r(device_id, ts, fw_version, wifi_ssid, wifi_rssi,
+                               uptime_ms, free_heap, battery_voltage,
+                               led_power, led_water, led_pads, position)
+    ), inserted AS (
+        INSERT INTO "TelemetryData" (
+            device_id, timestamp, fw_version, wifi_ssid, wifi_rssi,
+            uptime_ms, free_heap, battery_voltage,
+            led_power, led_water, led_pads,
+            "createdAt", "updatedAt"
+        )
+        SELECT r.device_id, to_timestamp(r.ts), r.fw_version, r.wifi_ssid, r.wifi_rssi,
+               r.uptime_ms, r.free_heap, r.battery_voltage,
+               r.led_power, r.led_water, r.led_pads,
+               CURRENT_TIMESTAMP, CURRENT_TIMESTAMP
+        FROM batch r
+        ON CONFLICT (device_id, timestamp) DO NOTHING
+        RETURNING device_id, timestamp
+    )
+    SELECT r.position
+    FROM batch r
+    JOIN inserted i ON i.device_id = r.device_id AND i.timestamp = to_timestamp(r.ts)
+"""
+
+# Newest row per device; the WHERE keeps late or replayed rows from going backwards
+UPSERT_LATEST_SQL = """
+    INSERT INTO "LatestTelemetry" (
+        device_id, timestamp, fw_version, wifi_ssid, wifi_rssi,
+        uptime_ms, free_heap, battery_voltage,
+        led_power, led_water, led_pads, "updatedAt"
+    )
+    SELECT r.device_id, to_timestamp(r.ts), r.fw_version, r.wifi_ssid, r.wifi_rssi,
+           r.uptime_ms, r.free_heap, r.battery_voltage,
+           r.led_power, r.led_water, r.led_pads, CURRENT_TIMESTAMP
+    FROM unnest(
+        $1::varchar[], $2::float8[], $3::varchar[], $4::varchar[], $5::integer[],
+        $6::bigint[], $7::integer[], $8::real[],
+        $9::boolean[], $10::boolean[], $11::boolean[]
+    ) AS r(device_id, ts, fw_version, wifi_ssid, wifi_rssi,
+           uptime_ms, free_heap, battery_voltage,
+           led_power, led_water, led_pads)
+    ON CONFLICT (device_id)
+    DO UPDATE SET
+        timestamp = EXCLUDED.timestamp,
+        fw_version = EXCLUDED.fw_version,
+        wifi_ssid = EXCLUDED.wifi_ssid,
+        wifi_rssi = EXCLUDED.wifi_rssi,
+        uptime_ms = EXCLUDED.uptime_ms,
+        free_heap = EXCLUDED.free_heap,
+        battery_voltage = EXCLUDED.battery_voltage,
+        led_power = EXCLUDED.led_power,
+        led_water = EXCLUDED.led_water,
+        led_pads = EXCLUDED.led_pads,
+        "updatedAt" = CURRENT_TIMESTAMP
+    WHERE "LatestTelemetry".timestamp <= EXCLUDED.timestamp
+"""
+
+# Column limits of "TelemetryData" - one value outside them fails a whole bulk insert or COPY
+_VARCHAR_LIMITS = ((0, 255), (2, 50), (3, 255))     # device_id, fw_version, wifi_ssid
+_INT_LIMITS = ((4, 2 ** 31), (5, 2 ** 63), (6, 2 ** 31))  # wifi_rssi, uptime_ms, free_heap
+_REAL_MAX = 3.4e38
+
+# Delivered to listeners only when the transaction commits
+NOTIFY_TELEMETRY_SQL = """
+    SELECT pg_notify($1, payload) FROM unnest($2::text[]) AS payload
+"""
+
+
+def _optional(value: Any, cast) -> Any:
+    return None if value is None else cast(value)
+
+
+def telemetry_row(data: Dict[str, Any]) -> TelemetryRow:
+    """Convert a telemetry payload into a typed row tuple
+
+    Raises ValueError/TypeError (OverflowError for infinite integers) for
+    payloads that can't be converted; check_row() then rejects values outside
+    the column limits. Together they keep a single bad message from poisoning
+    a whole batch.
+    """
+    device_id = data.get("device_id")
+    if not device_id:
+        raise ValueError("device_id is required")
+
+    status = data.get("status")
+    if not isinstance(status, dict):
+        status = {}
+
+    return (
+        str(device_id),
+        float(data["timestamp"]),
+        _optional(data.get("fw_version"), str),
+        _optional(data.get("wifi_ssid"), str),
+        _optional(data.get("wifi_rssi"), int),
+        _optional(data.get("uptime_ms"), int),
+        _optional(data.get("free_heap"), int),
+        _optional(data.get("battery_voltage"), float),
+        bool(status.get("power", False)),
+        bool(status.get("water", False)),
+        bool(status.get("pads", False)),
+    )
+
+
+def check_row(row: TelemetryRow) -> None:
+    """Raise ValueError for a row PostgreSQL would reject (telemetry_row() has checked the types)"""
+    if not math.isfinite(row[1]) or not -62135596800 <= row[1] < 253402300800:
+        raise ValueError(f"timestamp out of range: {row[1]}")
+    for index, limit in _VARCHAR_LIMITS:
+        value = row[index]
+        if value is not None and (len(value) > limit or "\x00" in value):
+            raise ValueError(f"text field too long or containing NUL: {excerpt(value, 60)}")
+    for index, limit in _INT_LIMITS:
+        value = row[index]
+        if value is not None and not -limit <= value < limit:
+            raise ValueError(f"integer field out of range: {value}")
+    if row[7] is not None and not (math.isfinite(row[7]) and abs(row[7]) <= _REAL_MAX):
+        raise ValueError(f"battery_voltage out of range: {row[7]}")
+
+
+def row_key(row: TelemetryRow) -> Tuple[str, float]:
+    """(device_id, timestamp) identity of a row, at the microsecond precision PostgreSQL stores"""
+    return row[0], round(row[1], 6)
+
+
+def float4(value: float) -> float:
+    """value as a real column returns it in JSON: rounded to float4, printed as its shortest decimal"""
+    stored = struct.unpack("f", struct.pack("f", value))[0]
+    for digits in range(1, 9):
+        shortest = float(f"{stored:.{digits}g}")
+        if struct.pack("f", shortest) == struct.pack("f", stored):
+            return shortest
+    return float(f"{stored:.9g}")
+
+
+def telemetry_record(row: TelemetryRow) -> Dict[str, Any]:
+    """Telemetry row in the API response format (NULLs coalesced, LEDs nested under status)"""
+    return {
+        "device_id": row[0],
+        "timestamp": int(round(row[1])),
+        "fw_version": row[2] or "",
+        "wifi_ssid": row[3] or "",
+        "wifi_rssi": row[4] or 0,
+        "uptime_ms": row[5] or 0,
+        "free_heap": row[6] or 0,
+        # As the database returns it, so cached and queried records are identical
+        "battery_voltage": float4(row[7]) if row[7] else 0.0,
+        "status": {
+            "power": row[8],
+            "water": row[9],
+            "pads": row[10],
+        },
+    }
+
+
+def newest_per_device(rows: List[TelemetryRow]) -> Dict[str, TelemetryRow]:
+    newest: Dict[str, TelemetryRow] = {}
+    for row in rows:
+        current = newest.get(row[0])
+        if current is None or row[1] > current[1]:
+            newest[row[0]] = row
+    return newest
+
+
+async def write_batch(
+    conn: asyncpg.Connection,
+    rows: List[TelemetryRow],
+    seen: Sequence[TelemetryRow] = ()
+) -> List[TelemetryRow]:
+    """Write a batch of telemetry rows in a single transaction, returns the rows actually inserted
+
+    Rows whose (device_id, timestamp) is already stored, or repeated within the
+    batch, are skipped. Devices are upserted once per distinct device_id with
+    the newest timestamp in the batch, in sorted order so concurrent writers
+    lock rows consistently. For the inserted rows only, each device's newest
+    row is upserted into "LatestTelemetry" and NOTIFYed, and rollups are
+    merged, all in the same transaction so listeners only ever see committed data.
+
+    seen are rows that are not stored (suppressed by change_filter.py) but
+    otherwise count like inserted ones: they move "Devices".last_seen,
+    "LatestTelemetry" and the rollups and are NOTIFYed, so aggregates and the
+    latest state cover every message. No unique index skips repeats among
+    them, so they must not include rows already written; the subscriber's
+    recent-key filter drops redelivered messages before they get here.
+    """
+    unique: Dict[Tuple[str, float], TelemetryRow] = {}
+    for row in rows:
+        unique.setdefault(row_key(row), row)
+    rows = list(unique.values())
+
+    newest = newest_per_device([*rows, *seen])
+    device_ids = sorted(newest)
+    columns = [list(column) for column in zip(*rows)]
+
+    async with conn.transaction():
+        await conn.execute(
+            UPSERT_DEVICES_SQL,
+            device_ids,
+            [newest[device_id][1] for device_id in device_ids]
+        )
+        inserted = []
+        if rows:
+            positions = await conn.fetch(INSERT_TELEMETRY_SQL, *columns)
+            inserted = [rows[record["position"] - 1] for record in positions]
+        written = [*inserted, *seen]
+        if not written:
+            return inserted
+
+        newest = newest_per_device(written)
+        device_ids = sorted(newest)
+        latest_columns = [list(column) for column in zip(*(newest[device_id] for device_id in device_ids))]
+        await conn.execute(UPSERT_LATEST_SQL, *latest_columns)
+        await write_rollups(conn, written)
+        await conn.execute(
+            NOTIFY_TELEMETRY_SQL,
+            TELEMETRY_CHANNEL,
+            [json.dumps(telemetry_record(newest[device_id]), separators=(",", ":")) for device_id in device_ids]
+        )
+    return inserted
+
+
+class TelemetryBatchWriter:
+    """Pulls telemetry rows from an IngestQueue and flushes them in size/time-bounded batches
+
+    Flushes run one at a time and the writer only pulls from the queue between
+    flushes, so a slow database leaves rows in the bounded queue (where its
+    overflow policy applies) rather than in an unbounded buffer here. Batches
+    that fail to write are appended to the spool, if one is configured. With a
+    change filter, only rows it selects are stored, and only written batches
+    move its state. With an AckTracker, every batch is settled on it once
+    stored or spooled, releasing the MQTT acks of its messages; a batch that
+    could neither be stored nor spooled is abandoned, left for the broker to
+    redeliver, and its keys are dropped from the recent_keys filter so the
+    redelivered rows aren't mistaken for duplicates.
+    """
+
+    def __init__(
+        self,
+        pool: asyncpg.Pool,
+        queue: IngestQueue,
+        max_rows: int = 500,
+        max_latency: float = 1.0,
+        spool=None,
+        changes=None,
+        acks=None,
+        recent_keys=None
+    ):
+        self.pool = pool
+        self.queue = queue
+        self.max_rows = max_rows
+        self.max_latency = max_latency
+        self.spool = spool
+        self.changes = changes
+        self.acks = acks
+        self.recent_keys = recent_keys
+
+        self._stopping = False
+
+        self.rows_written = 0
+        self.rows_duplicate = 0
+        self.rows_suppressed = 0
+        self.rows_failed = 0
+        self.rows_spooled = 0
+        self.batches_written = 0
+        self.last_flush_seconds = 0.0
+
+    async def run(self) -> None:
+        """Flush loop - runs until stop() is called and the queue is drained"""
+        while not self._stopping or self.queue.depth:
+            batch = await self.queue.get(self.max_rows)
+            if not batch:
+                continue
+
+            # Top the batch up until it is full or the first row hits its deadline
+            deadline = time.monotonic() + self.max_latency
+            while not self._stopping and len(batch) < self.max_rows:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                batch.extend(await self.queue.get(self.max_rows - len(batch), timeout=remaining))
+
+            await self.flush(batch)
+
+    async def flush(self, batch: List[TelemetryRow]) -> None:
+        """Write one batch of rows as a single transaction"""
+        rows, suppressed = self.changes.split(batch) if self.changes is not None else (batch, [])
+
+        started = time.monotonic()
+        try:
+            async with self.pool.acquire() as conn:
+                POOL_ACQUIRE_SECONDS.labels("primary").observe(time.monotonic() - started)
+                inserted = await write_batch(conn, rows, seen=suppressed)
+        except Exception as e:
+            # Suppressed rows go too: they would otherwise be missing from the rollups.
+            # Replayed, they are simply stored
+            if not self.spool:
+                self.rows_failed += len(batch)
+                ROWS_FAILED.inc(len(batch))
+                log_limiter.log(logger, logging.ERROR, "batch_failed", f"Failed to store telemetry batch of {len(batch)} rows: {e}")
+                self._release(batch, settled=False)
+                return
+            try:
+                await asyncio.get_running_loop().run_in_executor(None, self.spool.append, batch)
+            except OSError as spool_error:
+                self.rows_failed += len(batch)
+                ROWS_FAILED.inc(len(batch))
+                log_limiter.log(
+                    logger, logging.ERROR, "batch_failed",
+                    f"Failed to store telemetry batch of {len(batch)} rows: {e}; spooling also failed: {spool_error}"
+                )
+                self._release(batch, settled=False)
+                return
+            self.rows_spooled += len(batch)
+            ROWS_SPOOLED.inc(len(batch))
+            log_limiter.log(
+                logger, logging.WARNING, "batch_spooled",
+                f"Failed to store telemetry batch of {len(batch)} rows, spooled for replay: {e}"
+            )
+            self._release(batch, settled=True)
+            return
+
+        if self.changes is not None:
+            self.changes.commit(rows, suppressed)
+        self.last_flush_seconds = time.monotonic() - started
+        self.rows_written += len(inserted)
+        self.rows_duplicate += len(rows) - len(inserted)
+        self.rows_suppressed += len(suppressed)
+        self.batches_written += 1
+
+        self._release(batch, settled=True)
+
+        committed = time.time()
+        BATCH_SECONDS.observe(self.last_flush_seconds)
+        ROWS_STORED.inc(len(inserted))
+        ROWS_DUPLICATE.inc(len(rows) - len(inserted))
+        ROWS_SUPPRESSED.inc(len(suppressed))
+        for row in inserted:
+            # Device clocks can run ahead of ours
+            INGEST_LAG_SECONDS.observe(max(0.0, committed - row[1]))
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(
+                f"Stored telemetry batch of {len(inserted)} rows ({len(rows) - len(inserted)} duplicates, "
+                f"{len(suppressed)} suppressed) in {self.last_flush_seconds:.3f}s"
+            )
+
+    def _release(self, batch: List[TelemetryRow], settled: bool) -> None:
+        """Hand the batch's MQTT acks back: sent if it was stored or spooled, held for redelivery if not"""
+        if not settled and self.recent_keys is not None:
+            self.recent_keys.discard(row_key(row) for row in batch)
+        if self.acks is None:
+            return
+        if settled:
+            self.acks.settle(len(batch))
+        else:
+            self.acks.abandon(len(batch))
+
+    async def stop(self) -> None:
+        """Stop waiting for new work and let run() drain the queue"""
+        self._stopping = True
+        self.queue.wake()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "rows_written": self.rows_written,
+            "rows_duplicate": self.rows_duplicate,
+            "rows_suppressed": self.rows_suppressed,
+            "rows_failed": self.rows_failed,
+            "rows_spooled": self.rows_spooled,
+            "batches_written": self.batches_written,
+            "last_flush_seconds": round(self.last_flush_seconds, 4),
+        }